@@ -18,19 +18,133 @@ class Settings(BaseSettings):
     MAX_TOKENS: int = 8192
     
     # Fraud detection thresholds
-    FRAUD_RISK_THRESHOLD: float = 0.7
+    FRAUD_RISK_THRESHOLD: float = 0.7  # pre-scores at or above this are decided High locally
+    FRAUD_PRESCORE_LOW_THRESHOLD: float = 0.2  # pre-scores below this are decided Low locally
     RETURN_FREQUENCY_THRESHOLD: int = 5  # returns per month
+    USER_HISTORY_RECENT_RETURNS: int = 10  # slim records kept in the per-user aggregate
     
     # Condition grading thresholds
     CONDITION_CONFIDENCE_THRESHOLD: float = 0.8
 
+    # Image ingestion
+    IMAGE_MAX_EDGE: int = 1024
+    IMAGE_MAX_TOTAL_PIXELS: int = 4_000_000  # across all images in one request
+    IMAGE_FORMAT: str = "JPEG"  # or "WEBP"
+    IMAGE_QUALITY: int = 85
+    IMAGE_PROCESS_WORKERS: int = 2
+
+    # Near-duplicate photo detection (64-bit pHash and dHash, Hamming distance)
+    IMAGE_MATCH_MAX_DISTANCE: int = 10  # reported as a match, and fed to the fraud check
+    IMAGE_REUSE_MAX_DISTANCE: int = 4  # practically identical: reuse the defect analysis; from another customer, decides fraud High
+    IMAGE_INDEX_LOAD_ON_STARTUP: bool = True  # load stored hashes in the background at startup
+
+    # Multi-image analysis
+    MULTI_IMAGE_MAX_IMAGES: int = 6
+    MULTI_IMAGE_MAX_PAYLOAD_BYTES: int = 15 * 1024 * 1024  # inline request limit is 20MB
+    MULTI_IMAGE_FALLBACK_CONCURRENCY: int = 3
+
+    # Persistence
+    PERSISTENCE_BACKEND: str = "firestore"  # "firestore", "sqlite" or "memory"
+    PERSISTENCE_SQLITE_PATH: str = "returns.sqlite3"
+    PERSISTENCE_THREADS: int = 8
+    WRITE_BEHIND_ENABLED: bool = True
+    WRITE_BEHIND_FLUSH_SIZE: int = 20
+    WRITE_BEHIND_FLUSH_INTERVAL: float = 0.5  # seconds
+    WRITE_BEHIND_MAX_ATTEMPTS: int = 5  # a write failing on its own this often is dead-lettered
+
+    # Read-through cache for GET /api/return/{return_id}
+    RETURN_CACHE_MAX_ENTRIES: int = 2048
+    RETURN_CACHE_TTL_SECONDS: float = 30
+
+    # Dashboard analytics: counters by reason/outcome/status/category/grade/fraud
+    # band and per-day value, updated on every committed write and spread over
+    # shards so concurrent writers rarely contend on one document
+    ANALYTICS_SHARDS: int = 8
+    ANALYTICS_RETENTION_DAYS: int = 400  # per-day buckets kept
+
+    # Bulk analysis
+    BATCH_MAX_CONCURRENCY: int = 8  # returns analyzed at once per batch request
+    BATCH_WRITE_SIZE: int = 50  # documents per Firestore batched write (max 500)
+
+    # Photo storage: uploads are hashed while they stream into a content-addressed
+    # store on local disk; return documents and queued jobs keep references only
+    BLOB_STORE_PATH: str = "blobs"
+    BLOB_MAX_BYTES: int = 25 * 1024 * 1024  # per photo
+
+    # Background analysis jobs (durable local queue)
+    JOB_QUEUE_PATH: str = "analysis_jobs.sqlite3"
+    JOB_MAX_ATTEMPTS: int = 3
+    JOB_WORKERS_IN_PROCESS: int = 2  # set to 0 when running `python -m app.worker` instead
+    JOB_WORKER_CONCURRENCY: int = 4  # concurrency of the standalone worker process
+    JOB_LEASE_SECONDS: float = 60  # a running job its worker has not renewed for this long is requeued
+
+    # Ask for the product category and the defect assessment in one request
+    DEFECT_SINGLE_PASS: bool = True
+
+    # Gemini call execution
+    GEMINI_EXECUTION_MODE: str = "native"  # "native" (SDK async) or "thread"
+    GEMINI_MAX_IN_FLIGHT: int = 8
+    GEMINI_THREAD_POOL_SIZE: int = 8
+    GEMINI_TIMEOUT_SECONDS: float = 30.0  # per attempt
+
+    # Request deadlines: every model call, admission wait and retry of an analysis
+    # shares this budget. Stages still running when it expires are cancelled and
+    # reported as timed_out; the rest of the result is returned. Clients may ask
+    # for less with ?deadline_seconds=
+    ANALYSIS_DEADLINE_SECONDS: float = 45.0
+    ANALYSIS_JOB_DEADLINE_SECONDS: float = 180.0  # background jobs
+    SKIP_GRADING_ON_FRAUD_REVIEW: bool = True  # cancel grading and pricing once fraud forces manual review
+
+    # Model call scheduling (size the buckets to the project's quota)
+    GEMINI_REQUESTS_PER_MINUTE: int = 1000
+    GEMINI_TOKENS_PER_MINUTE: int = 1_000_000
+    GEMINI_MAX_RETRIES: int = 4
+    GEMINI_RETRY_BASE_DELAY: float = 0.5
+    GEMINI_RETRY_MAX_DELAY: float = 8.0
+    HIGH_VALUE_PRICE_THRESHOLD: float = 200.0  # returns at or above this are high value (priority lane, fraud scoring)
+
+    # Prompt text budget (tokens, images excluded); payloads are trimmed lowest value first
+    PROMPT_TOKEN_BUDGET: int = 6000
+
+    # Return decisions: policy rules (category policies and exported rule canvas
+    # flows, as JSON) are compiled and evaluated locally; Gemini decides the rest
+    RETURN_POLICY_RULES_PATH: str = ""
+    POLICY_LLM_DESCRIPTIONS: bool = False  # ask Gemini for product_description on rule decisions
+
+    # Pricing by comparable past resales. Seed records come from a JSON / JSON
+    # lines file of {category, grade, original_price, sale_price, days_to_sell};
+    # the parsed seed is cached in the .npz snapshot and loaded from there.
+    # Recorded sales are appended to the sales log (JSON lines) as they come in
+    # and loaded on top of the seed, so they survive restarts
+    PRICING_COMPARABLES_PATH: str = ""
+    PRICING_SNAPSHOT_PATH: str = ""
+    PRICING_SALES_LOG_PATH: str = ""
+    PRICING_COMPARABLES_K: int = 25  # nearest-priced sales per lookup
+    PRICING_MIN_COMPARABLES: int = 5  # below this, fall back to the static condition factors
+    PRICING_SELL_SPEED_ELASTICITY: float = 0.1  # demand boost for categories that sell faster
+
+    # Voice assistant (python -m app.utils.voice_assistent)
+    VOICE_TTS_CACHE_DIR: str = ""  # prompt audio by content hash; defaults to <tmp>/return_assistant_tts
+    VOICE_LANGUAGE: str = "en"
+    VOICE_MIC_DEVICE_INDEX: int = 0
+    VOICE_LISTEN_TIMEOUT: float = 5
+
+    # Startup: build services and import the SDKs during startup instead of on first use
+    WARM_UP_ON_STARTUP: bool = False
+
+    # Observability (in-process; GET /metrics and /api/traces)
+    TRACE_BUFFER_SIZE: int = 256  # finished request traces kept in memory
+    TRACE_MAX_SPANS: int = 256  # spans recorded per trace before dropping
+
+    # Gemini response cache
+    RESPONSE_CACHE_ENABLED: bool = True
+    RESPONSE_CACHE_MAX_ENTRIES: int = 1024
+    RESPONSE_CACHE_TTL_SECONDS: float = 3600
+    RESPONSE_CACHE_DISK_PATH: str = ""  # e.g. /tmp/gemini_cache.sqlite3 to share across workers
+
     class Config:
         env_file = env_path
         env_file_encoding = "utf-8"
 
 # Initialize settings
 settings = Settings()
-
-# Debug: Check if variables are loaded correctly
-print("GOOGLE_API_KEY:", settings.GOOGLE_API_KEY)
-print("FIREBASE_CREDENTIALS:", settings.FIREBASE_CREDENTIALS)
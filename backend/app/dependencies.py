@@ -0,0 +1,125 @@
+"""
+Lazily constructed, process-wide service singletons.
+
+Nothing is built, and no service module (with its SDK, NumPy or PIL imports)
+is imported, until a getter is first called. Importing app.main therefore
+only costs FastAPI itself; warm_up() can pay the rest during startup instead
+of on the first request. Tests and benchmarks can swap an instance in with
+override() before the first call.
+"""
+import json
+import os
+import threading
+from typing import Callable, Dict, Optional
+
+from .config import settings
+
+_lock = threading.RLock()
+_instances: Dict[str, object] = {}
+
+
+def _shared(name: str, factory: Callable[[], object]):
+    instance = _instances.get(name)
+    if instance is None:
+        with _lock:
+            instance = _instances.get(name)
+            if instance is None:
+                instance = _instances[name] = factory()
+    return instance
+
+
+def peek(name: str) -> Optional[object]:
+    """The named singleton if it has been built, without building it"""
+    return _instances.get(name)
+
+
+def override(name: str, instance: object) -> None:
+    _instances[name] = instance
+
+
+def get_firebase():
+    from .utils.firebase_client import FirebaseClient
+    return _shared('firebase', FirebaseClient)
+
+
+def get_defect_service():
+    from .services.defect_detection import DefectDetectionService
+    return _shared('defect_service', DefectDetectionService)
+
+
+def get_fraud_service():
+    from .services.fraud_detection import FraudDetectionService
+    return _shared('fraud_service', FraudDetectionService)
+
+
+def get_condition_service():
+    from .services.condition_grading import ConditionGradingService
+    return _shared('condition_service', ConditionGradingService)
+
+
+def load_comparables():
+    """
+    The pricing comparables: the seed records (from the snapshot if one
+    exists, else parsed and snapshotted), plus every sale in the sales log
+    """
+    from .utils.comparables import ComparablesIndex, read_records
+    if settings.PRICING_SNAPSHOT_PATH and os.path.exists(settings.PRICING_SNAPSHOT_PATH):
+        index = ComparablesIndex.load(settings.PRICING_SNAPSHOT_PATH)
+    elif settings.PRICING_COMPARABLES_PATH:
+        index = ComparablesIndex.load(settings.PRICING_COMPARABLES_PATH)
+        if settings.PRICING_SNAPSHOT_PATH:
+            index.save(settings.PRICING_SNAPSHOT_PATH)
+    else:
+        index = ComparablesIndex()
+    if settings.PRICING_SALES_LOG_PATH and os.path.exists(settings.PRICING_SALES_LOG_PATH):
+        index.extend(read_records(settings.PRICING_SALES_LOG_PATH))
+    return index
+
+
+def get_pricing_service():
+    from .services.pricing import PricingService
+    return _shared('pricing_service', lambda: PricingService(load_comparables(), sales_log=settings.PRICING_SALES_LOG_PATH))
+
+
+def load_return_policy_rules() -> dict:
+    if not settings.RETURN_POLICY_RULES_PATH:
+        return {}
+    with open(settings.RETURN_POLICY_RULES_PATH) as f:
+        return json.load(f)
+
+
+def get_decision_service():
+    from .services.return_decision import ReturnDecisionService
+    return _shared('decision_service', lambda: ReturnDecisionService(load_return_policy_rules()))
+
+
+def get_blob_store():
+    from .utils.blob_store import BlobStore
+    return _shared('blob_store', lambda: BlobStore(settings.BLOB_STORE_PATH, settings.BLOB_MAX_BYTES))
+
+
+def get_image_preprocessor():
+    from .utils.image_processing import ImagePreprocessor
+    return _shared('image_preprocessor', lambda: ImagePreprocessor(blob_store=get_blob_store()))
+
+
+def get_job_queue():
+    from .utils.job_queue import JobQueue
+    return _shared('job_queue', lambda: JobQueue(settings.JOB_QUEUE_PATH, settings.JOB_MAX_ATTEMPTS))
+
+
+def warm_up() -> None:
+    """Build every singleton and load the heavy SDKs now (blocking; run it off the event loop)"""
+    from PIL import Image
+    from .utils.gemini_client import get_gemini_client, retryable_errors
+
+    Image.init()  # registers every PIL image plugin up front
+    retryable_errors()
+    get_gemini_client()
+    get_firebase()
+    get_defect_service()
+    get_fraud_service()
+    get_condition_service()
+    get_pricing_service()
+    get_decision_service()
+    get_image_preprocessor().warm_up()
@@ -1,15 +1,88 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException, Depends
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, File, Form, UploadFile, HTTPException, Depends, Request
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, Response, StreamingResponse
+from typing import List, Optional
+import asyncio
+import base64
+import binascii
+import hashlib
+import json
+import time
+import zipfile
 from PIL import Image
-import io
-from typing import List
-from .services.defect_detection import DefectDetectionService
-from .services.fraud_detection import FraudDetectionService
-from .services.condition_grading import ConditionGradingService
-from .services.pricing import PricingService
-from .utils.firebase_client import FirebaseClient
+from datetime import datetime
+from .config import settings
+from .models.schemas import ResaleReport
+from .dependencies import (
+    get_blob_store,
+    get_condition_service,
+    get_decision_service,
+    get_defect_service,
+    get_firebase,
+    get_fraud_service,
+    get_image_preprocessor,
+    get_job_queue,
+    get_pricing_service,
+    peek,
+    warm_up,
+)
+from .utils.blob_store import BlobTooLarge, is_blob_ref
+from .utils.deadline import Deadline, request_deadline
+from .utils.gemini_client import get_gemini_client, get_model_scheduler, peek_gemini_client
+from .utils.job_queue import JobWorkerPool
+from .utils.metrics import http_request_duration, http_requests_in_flight, registry
+from .utils.prompt_builder import prompt_token_stats, token_usage_scope
+from .utils.model_scheduler import CallPriority, LANE_HIGH, LANE_LOW, LANE_NORMAL, call_priority
+from .utils.return_analytics import summarize_rollup, value_series
+from .utils.return_history import to_datetime, to_float
+from .utils.stage_graph import StageGraph, stage_timing_stats
+from .utils.tracing import TraceRecorder
+
+# In-process job workers, started by the lifespan when JOB_WORKERS_IN_PROCESS > 0
+job_workers: Optional[JobWorkerPool] = None
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Services are built lazily on first use, so startup only does what is
+    configured: an optional warm-up (off the event loop), loading the photo
+    hash index in the background and the in-process job workers. Shutdown
+    only tears down what was actually built.
+    """
+    global job_workers
+    if settings.WARM_UP_ON_STARTUP:
+        await asyncio.get_running_loop().run_in_executor(None, warm_up)
+    image_index_loader = None
+    if settings.IMAGE_INDEX_LOAD_ON_STARTUP:
+        image_index_loader = asyncio.create_task(load_image_index())
+    if settings.JOB_WORKERS_IN_PROCESS > 0:
+        job_workers = JobWorkerPool(
+            get_job_queue(), process_analysis_job, settings.JOB_WORKERS_IN_PROCESS,
+            lease_seconds=settings.JOB_LEASE_SECONDS
+        )
+        job_workers.start()
+    try:
+        yield
+    finally:
+        if image_index_loader is not None:
+            image_index_loader.cancel()
+        if job_workers is not None:
+            await job_workers.stop()
+            job_workers = None
+        if peek('image_preprocessor') is not None:
+            peek('image_preprocessor').shutdown()
+        if peek('firebase') is not None:
+            # Commit anything still in the write-behind buffer before exiting
+            await peek('firebase').close()
+
+async def load_image_index() -> None:
+    """Fill the near-duplicate photo index so the first upload does not wait for it"""
+    firebase = await asyncio.get_running_loop().run_in_executor(None, get_firebase)
+    await firebase.load_image_index()
+
+app = FastAPI(lifespan=lifespan)
 
 # Add CORS middleware
 app.add_middleware(
@@ -20,70 +93,783 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Initialize services
-firebase = FirebaseClient()
-defect_service = DefectDetectionService()
-fraud_service = FraudDetectionService()
-condition_service = ConditionGradingService()
-pricing_service = PricingService()
+trace_recorder = TraceRecorder(settings.TRACE_BUFFER_SIZE)
+
+@app.middleware("http")
+async def instrument_request(request: Request, call_next):
+    """
+    Latency per route, in-flight count and a span trace for every request.
+    The trace id is returned in X-Trace-Id; GET /api/traces/{trace_id} dumps
+    it. Model tokens spent are attributed to the endpoint being served.
+    """
+    token_usage_scope.set(f"{request.method} {request.url.path}")
+    http_requests_in_flight.inc()
+    start = time.perf_counter()
+
+    def finished(status: int) -> None:
+        http_requests_in_flight.dec()
+        # Label by the matched route template so ids in paths do not explode cardinality
+        route = request.scope.get('route')
+        http_request_duration.observe(
+            time.perf_counter() - start,
+            method=request.method,
+            route=getattr(route, 'path', 'unmatched'),
+            status=status
+        )
+
+    try:
+        with trace_recorder.trace(
+            f"{request.method} {request.url.path}", settings.TRACE_MAX_SPANS
+        ) as trace:
+            response = await call_next(request)
+    except BaseException:
+        finished(500)
+        raise
+    response.headers['X-Trace-Id'] = trace.trace_id
+    body = response.body_iterator
+
+    async def timed_body():
+        # Streaming endpoints (SSE, NDJSON batches) do their work while the
+        # body is sent, so the request is only done once the body is
+        try:
+            async for chunk in body:
+                yield chunk
+        finally:
+            finished(response.status_code)
+
+    response.body_iterator = timed_body()
+    return response
+
+def collect_runtime_metrics():
+    """
+    Scrape-time gauges for state owned by the scheduler, caches, buffers and
+    queues. Services that have not been built yet are skipped, not built.
+    """
+    scheduler = get_model_scheduler().stats()
+    yield ('gemini_queue_depth', 'gauge', 'Model calls waiting for admission by priority lane',
+           [({'lane': lane}, depth) for lane, depth in scheduler['queue_depth'].items()])
+    yield ('gemini_in_flight', 'gauge', 'Model calls currently in flight', [({}, scheduler['in_flight'])])
+    yield ('gemini_retries_total', 'counter', 'Model call retries after retryable errors', [({}, scheduler['retries'])])
+    yield ('gemini_queue_wait_p99_seconds', 'gauge', 'p99 admission wait over the recent window',
+           [({}, scheduler['wait_p99_ms'] / 1000)])
+
+    gemini = peek_gemini_client()
+    if gemini is not None and gemini.cache is not None:
+        stats = gemini.cache.stats()
+        yield ('response_cache_hit_ratio', 'gauge', 'Gemini response cache hit ratio', [({}, stats['hit_rate'])])
+        yield ('response_cache_entries', 'gauge', 'Gemini response cache entries', [({}, stats['entries'])])
+    firebase = peek('firebase')
+    if firebase is not None:
+        return_cache = firebase.return_cache_stats()
+        yield ('return_cache_hit_ratio', 'gauge', 'GET /api/return cache hit ratio', [({}, return_cache['hit_rate'])])
+        yield ('image_index_photos', 'gauge', 'Photos in the near-duplicate hash index', [({}, len(firebase.image_index))])
+        if firebase.write_buffer is not None:
+            yield ('write_behind_pending', 'gauge', 'Buffered return writes not yet committed',
+                   [({}, firebase.write_buffer.stats()['pending'])])
+    fraud_service = peek('fraud_service')
+    if fraud_service is not None:
+        yield ('fraud_llm_calls_avoided_ratio', 'gauge', 'Fraud checks decided by the local pre-scorer',
+               [({}, fraud_service.pre_scorer.stats()['llm_calls_avoided_ratio'])])
+    decision_service = peek('decision_service')
+    if decision_service is not None:
+        yield ('policy_rule_hit_ratio', 'gauge', 'Return decisions made by the compiled policy rules',
+               [({}, decision_service.policy.stats()['rule_hit_ratio'])])
+    pricing_service = peek('pricing_service')
+    if pricing_service is not None:
+        pricing = pricing_service.stats()
+        yield ('pricing_comparables', 'gauge', 'Resale outcomes in the pricing comparables index',
+               [({}, pricing['comparables'])])
+        yield ('pricing_comparables_hit_ratio', 'gauge', 'Price recommendations based on comparables',
+               [({}, pricing['comparables_hit_ratio'])])
+    job_queue = peek('job_queue')
+    if job_queue is not None:
+        yield ('analysis_jobs', 'gauge', 'Analysis jobs by status',
+               [({'status': status}, count) for status, count in job_queue.counts().items()])
+
+registry.register_collector(collect_runtime_metrics)
+
+# Heavy fields dropped from GET /api/return/{return_id}?view=list
+LIST_VIEW_EXCLUDES = ['photos', 'stage_timings']
+
+# Stages whose results are stored on the return document
+ANALYSIS_STAGES = ['defect_analysis', 'fraud_analysis', 'condition_grade', 'price_recommendation', 'return_decision']
+
+async def process_analysis_job(job: dict) -> None:
+    """Run a queued analysis under its own trace and token-usage scope"""
+    token_usage_scope.set("job:analyze-return")
+    with trace_recorder.trace(
+        "job:analyze-return", settings.TRACE_MAX_SPANS, return_id=job['return_id'], job_id=job['id']
+    ):
+        await run_analysis_job(job)
+
+async def run_analysis_job(job: dict) -> None:
+    """Run a queued analysis, writing each stage's result to the return document as it lands"""
+    return_id = job['return_id']
+    return_data = job['payload']
+    firebase = get_firebase()
+    preprocessor = get_image_preprocessor()
+    if job['images']:
+        # Queued before photos moved to the blob store
+        pil_images = preprocessor.open_processed(job['images'])
+    else:
+        pil_images = preprocessor.open_refs(return_data['photos'], return_data.get('image_hashes'))
+
+    async def report_stage(name: str, result) -> None:
+        if name in ANALYSIS_STAGES:
+            await firebase.update_return_status(return_id, {f'stages.{name}': 'completed', name: result})
+
+    await firebase.update_return_status(return_id, {'status': 'processing'})
+    try:
+        # Background jobs yield to interactive requests unless high-value
+        analysis_result, stage_timings = await run_return_analysis(
+            return_data,
+            pil_images,
+            on_stage_done=report_stage,
+            lane=LANE_LOW,
+            return_id=return_id,
+            deadline=Deadline(settings.ANALYSIS_JOB_DEADLINE_SECONDS)
+        )
+    except Exception as e:
+        final_attempt = job['attempts'] >= get_job_queue().max_attempts
+        await firebase.update_return_status(return_id, {
+            'status': 'failed' if final_attempt else 'queued',
+            'error': str(e)
+        })
+        raise
+    stage_status = analysis_result['stage_status']
+    await firebase.update_return_status(return_id, {
+        'status': 'analyzed',
+        'image_matches': analysis_result['image_matches'],
+        'stage_timings': stage_timings,
+        'stage_status': stage_status,
+        # Stages that were skipped or timed out never reported themselves
+        **{f'stages.{name}': stage_status[name] for name in ANALYSIS_STAGES if stage_status.get(name) != 'completed'}
+    })
 
 @app.get("/")
 async def root():
     return {"message": "Welcome to Return AI API"}
 
+def needs_manual_review(fraud_analysis) -> bool:
+    """The fraud check alone sends this return to manual review"""
+    return isinstance(fraud_analysis, dict) and bool(
+        fraud_analysis.get('is_fraudulent') or fraud_analysis.get('risk_category') == 'High'
+    )
+
+def start_deadline(requested_seconds: Optional[float] = None, default: Optional[float] = None) -> Deadline:
+    """A client may ask for a shorter budget than the configured one, never a longer one"""
+    seconds = default or settings.ANALYSIS_DEADLINE_SECONDS
+    if requested_seconds is not None and requested_seconds > 0:
+        seconds = min(seconds, requested_seconds)
+    deadline = Deadline(seconds)
+    request_deadline.set(deadline)
+    return deadline
+
+async def run_return_analysis(
+    return_data: dict,
+    pil_images: list,
+    on_stage_done=None,
+    lane: int = LANE_NORMAL,
+    return_id: Optional[str] = None,
+    deadline: Optional[Deadline] = None
+) -> tuple:
+    """
+    Run the analysis stage graph for one return; returns (analysis_result,
+    stage_timings). return_id is set when the return is already saved, so it
+    is not matched against its own photos. Every model call shares the
+    deadline (ANALYSIS_DEADLINE_SECONDS when not given); analysis_result
+    carries stage_status with completed/skipped/timed_out per stage.
+    """
+    deadline = deadline or Deadline(settings.ANALYSIS_DEADLINE_SECONDS)
+    request_deadline.set(deadline)
+    # Model calls for high-value returns, and for the rest of a return once
+    # fraud is flagged, are served first by the shared model scheduler
+    if to_float(return_data.get('original_price')) >= settings.HIGH_VALUE_PRICE_THRESHOLD:
+        lane = LANE_HIGH
+    priority = CallPriority(lane)
+    call_priority.set(priority)
+    firebase = get_firebase()
+    defect_service = get_defect_service()
+    fraud_service = get_fraud_service()
+    condition_service = get_condition_service()
+    pricing_service = get_pricing_service()
+    decision_service = get_decision_service()
+    image_hashes = return_data.get('image_hashes') or [image.info.get('hashes') for image in pil_images]
+
+    async def defect_stage(image_matches: list) -> dict:
+        # The same photos were analyzed for an earlier return: reuse that result
+        prior = await reusable_defect_analysis(firebase, image_matches, len(pil_images))
+        if prior is not None:
+            return prior
+        return await defect_service.analyze_product_images(pil_images, return_data.get('product_category'))
+
+    async def fraud_stage(user_history: dict, image_matches: list) -> dict:
+        fraud_analysis = await fraud_service.analyze_return_pattern(return_data, user_history, image_matches)
+        if needs_manual_review(fraud_analysis):
+            priority.escalate()
+        return fraud_analysis
+
+    async def decision_stage(fraud_analysis: dict, defect_analysis: Optional[dict], price_recommendation: Optional[dict]) -> dict:
+        # A return going to manual review has no defect analysis; the policy
+        # rules decide it from the fraud result alone
+        decision = await decision_service.determine_final_outcome(defect_analysis, fraud_analysis, return_data)
+        if isinstance(decision, dict) and decision.get('final_outcome') == "Resell" and price_recommendation:
+            decision.setdefault('resale_details', {'price': price_recommendation['suggested_price']})
+        return decision
+
+    # Run parallel analysis: defect, fraud (after history) and condition
+    # branches run concurrently; only pricing waits on the condition grade
+    graph = StageGraph("analyze_return", on_stage_done=on_stage_done)
+    graph.add_stage(
+        'image_matches',
+        lambda: firebase.find_similar_images(image_hashes, exclude_return_id=return_id)
+    )
+    graph.add_stage(
+        'defect_analysis',
+        defect_stage,
+        depends_on=['image_matches']
+    )
+    graph.add_stage(
+        'user_history',
+        # A queued return is already saved; it must not count in its own history
+        lambda: firebase.get_user_history(return_data['user_id'], exclude_return_id=return_id)
+    )
+    graph.add_stage(
+        'fraud_analysis',
+        fraud_stage,
+        depends_on=['user_history', 'image_matches']
+    )
+    # Without a category from the client, grading and pricing use the one
+    # the defect analysis identified, and so wait for it
+    category_from = [] if return_data.get('product_category') else ['defect_analysis']
+
+    def product_category(defect_result: Optional[dict] = None) -> Optional[str]:
+        return return_data.get('product_category') or (defect_result or {}).get('product_category')
+
+    graph.add_stage(
+        'condition_grade',
+        lambda *defect_result: condition_service.grade_condition(
+            pil_images,
+            product_category(*defect_result)
+        ),
+        depends_on=category_from
+    )
+    # Get pricing and marketplace recommendations
+    graph.add_stage(
+        'price_recommendation',
+        lambda condition_grade, *defect_result: pricing_service.get_price_recommendation(
+            return_data['original_price'],
+            condition_grade['grade'],
+            product_category(*defect_result)
+        ),
+        depends_on=['condition_grade', *category_from]
+    )
+    # The policy rules (or the model, when they leave it open) decide the
+    # outcome once fraud, defects and pricing are known
+    graph.add_stage(
+        'return_decision',
+        decision_stage,
+        depends_on=['fraud_analysis'],
+        optional=['defect_analysis', 'price_recommendation']
+    )
+    if settings.SKIP_GRADING_ON_FRAUD_REVIEW:
+        # A return going to manual review is graded by a person; stop paying
+        # for model grading and pricing (pricing goes with the condition grade)
+        graph.skip_when('fraud_analysis', needs_manual_review, skip=['defect_analysis', 'condition_grade'])
+    results = await graph.run(deadline)
+
+    analysis_result = {
+        **return_data,
+        'image_hashes': image_hashes,
+        'image_matches': results['image_matches'],
+        'defect_analysis': results['defect_analysis'],
+        'fraud_analysis': results['fraud_analysis'],
+        'condition_grade': results['condition_grade'],
+        'price_recommendation': results['price_recommendation'],
+        'return_decision': results['return_decision'],
+        'stage_status': {name: graph.statuses.get(name, 'completed') for name in graph.stages}
+    }
+    return analysis_result, graph.timings
+
+async def reusable_defect_analysis(firebase, image_matches: list, image_count: int) -> Optional[dict]:
+    """The defect analysis of an earlier return whose photos near-duplicate every one of these"""
+    covered = {}
+    for match in image_matches:
+        if match['distance'] <= settings.IMAGE_REUSE_MAX_DISTANCE:
+            covered.setdefault(match['return_id'], set()).add(match['image'])
+    for prior_return_id, images in covered.items():
+        if len(images) < image_count:
+            continue
+        try:
+            prior = await firebase.get_return(prior_return_id)
+        except KeyError:
+            continue
+        defect_analysis = prior.get('defect_analysis')
+        if isinstance(defect_analysis, dict) and defect_analysis.get('condition_grade'):
+            return {**defect_analysis, 'reused_from': prior_return_id}
+    return None
+
+def parse_return_data(raw: str) -> dict:
+    """Decode the JSON-encoded return_data form field sent alongside the photos"""
+    try:
+        return_data = json.loads(raw)
+    except json.JSONDecodeError:
+        raise HTTPException(status_code=400, detail="return_data must be a JSON object")
+    if not isinstance(return_data, dict):
+        raise HTTPException(status_code=400, detail="return_data must be a JSON object")
+    return return_data
+
+async def store_uploads(images: List[UploadFile]) -> List[dict]:
+    """Copy spooled multipart uploads into the blob store chunk by chunk, hashing as they go"""
+    store = get_blob_store()
+    return list(await asyncio.gather(*[
+        asyncio.to_thread(store.put_file, image.file, image.content_type) for image in images
+    ]))
+
+async def referenced_photos(return_data: dict) -> List[dict]:
+    """
+    Photos listed in return_data["photos"]: references returned by POST
+    /api/blobs, or base64 strings, which are moved into the blob store
+    rather than kept in the document.
+    """
+    store = get_blob_store()
+    refs = []
+    for photo in return_data.pop('photos', None) or []:
+        if is_blob_ref(photo):
+            if not store.exists(photo['sha256']):
+                raise HTTPException(status_code=400, detail=f"Unknown photo {photo['sha256']}")
+            refs.append(photo)
+        elif isinstance(photo, str) and photo:
+            try:
+                # Accepts data URLs too
+                data = base64.b64decode(photo.split(",")[-1], validate=True)
+            except binascii.Error:
+                raise HTTPException(status_code=400, detail="photos must be blob references or base64 strings")
+            refs.append(await asyncio.to_thread(store.put_bytes, data))
+        else:
+            raise HTTPException(status_code=400, detail="photos must be blob references or base64 strings")
+    return refs
+
+async def collect_originals(return_data: dict, images: Optional[List[UploadFile]]) -> List[dict]:
+    """Blob references for every photo of the return, attached or listed in return_data"""
+    try:
+        originals = await store_uploads(images or []) + await referenced_photos(return_data)
+    except BlobTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    if not originals:
+        raise HTTPException(status_code=400, detail="At least one photo is required")
+    return originals
+
+async def ingest_photos(return_data: dict, originals: List[dict]) -> None:
+    """
+    Decode, orient, downscale and re-encode the originals off the event loop.
+    The processed photos go back into the blob store; return_data gets their
+    references ("photos") and perceptual hashes ("image_hashes").
+    """
+    processed = await get_image_preprocessor().process_blobs(originals)
+    return_data['photos'] = [ref for ref, _ in processed]
+    return_data['image_hashes'] = [hashes for _, hashes in processed]
+
+def open_photos(return_data: dict) -> list:
+    return get_image_preprocessor().open_refs(return_data['photos'], return_data['image_hashes'])
+
+async def prepare_photos(return_data: dict, originals: List[dict]) -> None:
+    """ingest_photos for a request: a photo that cannot be decoded is the client's error (400)"""
+    try:
+        await ingest_photos(return_data, originals)
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        raise HTTPException(status_code=400, detail=f"Could not read photo: {e}")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.post("/api/blobs")
+async def upload_blob(request: Request):
+    """
+    Stream one photo, sent as the raw request body, into the blob store. The
+    returned reference can be listed in return_data["photos"] instead of
+    attaching the file to the analysis request.
+    """
+    try:
+        return await get_blob_store().put_stream(request.stream(), request.headers.get('content-type'))
+    except BlobTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+
+@app.get("/api/blobs/{sha256}")
+async def get_blob(sha256: str):
+    """A stored photo by content address; immutable, so it may be cached forever"""
+    store = get_blob_store()
+    if not is_blob_ref({'sha256': sha256}) or not store.exists(sha256):
+        raise HTTPException(status_code=404, detail="Photo not found")
+    return FileResponse(store.path(sha256), headers={'Cache-Control': 'public, max-age=31536000, immutable'})
+
 @app.post("/api/analyze-return")
 async def analyze_return(
-    return_data: dict,
-    images: List[UploadFile] = File(...)
+    return_data: str = Form(...),
+    images: Optional[List[UploadFile]] = File(None),
+    mode: str = "sync",
+    deadline_seconds: Optional[float] = None
 ):
+    """
+    return_data is sent as a JSON-encoded form field next to the image files;
+    photos already uploaded to POST /api/blobs can be listed by reference in
+    return_data["photos"] instead. mode=sync (default) analyzes and saves
+    before responding, within deadline_seconds (at most
+    ANALYSIS_DEADLINE_SECONDS); stages cut off by the deadline, or made moot
+    by a manual-review fraud result, are reported in stage_status and the
+    rest is returned. mode=async saves the return immediately, queues the
+    analysis and responds 202 with the return_id; poll GET
+    /api/return/{return_id} for per-stage status.
+    """
+    deadline = start_deadline(deadline_seconds)
+    return_data = parse_return_data(return_data)
+    await prepare_photos(return_data, await collect_originals(return_data, images))
     try:
-        # Process images
-        pil_images = []
-        for image in images:
-            content = await image.read()
-            pil_image = Image.open(io.BytesIO(content))
-            pil_images.append(pil_image)
-        
-        # Run parallel analysis
-        defect_analysis = await defect_service.analyze_product_image(pil_images[0])
-        user_history = await firebase.get_user_history(return_data['user_id'])
-        fraud_analysis = await fraud_service.analyze_return_pattern(user_history)
-        condition_grade = await condition_service.grade_condition(
-            pil_images[0], 
-            return_data['product_category']
-        )
-        
-        # Get pricing and marketplace recommendations
-        price_recommendation = await pricing_service.get_price_recommendation(
-            return_data['original_price'],
-            condition_grade['grade'],
-            return_data['product_category'],
-            {}  # Add market data here
-        )
-        
+        if mode == "async":
+            return await enqueue_return_analysis(return_data)
+        pil_images = open_photos(return_data)
+
+        analysis_result, stage_timings = await run_return_analysis(return_data, pil_images, deadline=deadline)
+
         # Save results to Firebase
-        analysis_result = {
-            **return_data,
-            'defect_analysis': defect_analysis,
-            'fraud_analysis': fraud_analysis,
-            'condition_grade': condition_grade,
-            'price_recommendation': price_recommendation
-        }
-        
-        return_id = await firebase.save_return_request(analysis_result)
+        return_id = await get_firebase().save_return_request(analysis_result)
         
         return {
             'return_id': return_id,
-            **analysis_result
+            **analysis_result,
+            'stage_timings': stage_timings
         }
         
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+def format_sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+@app.post("/api/analyze-return/stream")
+async def analyze_return_stream(
+    return_data: str = Form(...),
+    images: Optional[List[UploadFile]] = File(None),
+    deadline_seconds: Optional[float] = None
+):
+    """
+    Server-sent-events variant of /api/analyze-return. Emits a `stage` event
+    with each stage's result as soon as it resolves, then a `complete` event
+    with the persisted return_id and stage_status (or an `error` event).
+    """
+    deadline = start_deadline(deadline_seconds)
+    return_data = parse_return_data(return_data)
+    await prepare_photos(return_data, await collect_originals(return_data, images))
+    try:
+        pil_images = open_photos(return_data)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    events = asyncio.Queue()
+
+    async def report_stage(name: str, result) -> None:
+        if name in ANALYSIS_STAGES:
+            await events.put(('stage', {'stage': name, 'result': result}))
+
+    async def run_analysis() -> None:
+        try:
+            analysis_result, stage_timings = await run_return_analysis(
+                return_data, pil_images, on_stage_done=report_stage, deadline=deadline
+            )
+            return_id = await get_firebase().save_return_request(analysis_result)
+            await events.put(('complete', {
+                'return_id': return_id,
+                'stage_status': analysis_result['stage_status'],
+                'stage_timings': stage_timings
+            }))
+        except Exception as e:
+            await events.put(('error', {'detail': str(e)}))
+
+    async def stream_events():
+        analysis = asyncio.create_task(run_analysis())
+        try:
+            while True:
+                event, data = await events.get()
+                yield format_sse(event, data)
+                if event in ('complete', 'error'):
+                    break
+        finally:
+            # Stops the analysis if the client disconnects early
+            analysis.cancel()
+
+    return StreamingResponse(
+        stream_events(),
+        media_type="text/event-stream",
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+async def enqueue_return_analysis(return_data: dict) -> JSONResponse:
+    """
+    The job carries the photo references in its payload, not the photos. The
+    return is committed before the job is queued: a standalone worker has its
+    own write-behind buffer and must find the document to update it.
+    """
+    return_id = await get_firebase().save_return_request({
+        **return_data,
+        'status': 'queued',
+        'stages': {name: 'pending' for name in ANALYSIS_STAGES}
+    }, durable=True)
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, get_job_queue().enqueue, return_id, return_data)
+    if job_workers is not None:
+        job_workers.notify()
+    return JSONResponse(status_code=202, content={'return_id': return_id, 'status': 'queued'})
+
+def read_batch_archive(source, store) -> tuple:
+    """
+    Split a zip upload into (manifest, {filename: blob reference}); each
+    entry is decompressed straight into the blob store. manifest.json lists
+    the returns.
+    """
+    with zipfile.ZipFile(source) as archive:
+        manifest = json.loads(archive.read("manifest.json"))
+        files = {}
+        for name in archive.namelist():
+            if name != "manifest.json" and not name.endswith("/"):
+                with archive.open(name) as entry:
+                    files[name] = store.put_file(entry)
+    return manifest, files
+
+@app.post("/api/analyze-returns/batch")
+async def analyze_returns_batch(
+    manifest: Optional[str] = Form(None),
+    images: Optional[List[UploadFile]] = File(None),
+    archive: Optional[UploadFile] = File(None),
+    deadline_seconds: Optional[float] = None
+):
+    """
+    Analyze many returns in one request. Send either a zip `archive` holding
+    manifest.json plus the photos, or a JSON `manifest` form field with the
+    photos as `images` files. Each manifest entry is a return_data dict whose
+    `images` key lists its photo filenames. One NDJSON line is streamed per
+    return as soon as it finishes (in completion order, tagged with its
+    manifest `index`), followed by a summary line. deadline_seconds bounds
+    each return's analysis, not the whole batch.
+    """
+    try:
+        if archive is not None:
+            items, files = await asyncio.to_thread(read_batch_archive, archive.file, get_blob_store())
+        elif manifest is not None:
+            items = json.loads(manifest)
+            uploads = images or []
+            files = dict(zip([image.filename for image in uploads], await store_uploads(uploads)))
+        else:
+            raise HTTPException(status_code=400, detail="Provide a manifest with images, or a zip archive")
+    except BlobTooLarge as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    if not isinstance(items, list):
+        raise HTTPException(status_code=400, detail="Manifest must be a JSON list of returns")
+
+    semaphore = asyncio.Semaphore(settings.BATCH_MAX_CONCURRENCY)
+    writer = get_firebase().batch_writer()
+
+    async def process(index: int, item: dict) -> dict:
+        async with semaphore:
+            # Each return gets its own budget from when its turn comes
+            deadline = start_deadline(deadline_seconds)
+            try:
+                return_data = dict(item)
+                filenames = return_data.pop('images', [])
+                # The same file may be shared by several manifest entries
+                originals = [files[filename] for filename in filenames] + await referenced_photos(return_data)
+                if not originals:
+                    raise ValueError("No images listed for this return")
+                await ingest_photos(return_data, originals)
+                pil_images = open_photos(return_data)
+                analysis_result, stage_timings = await run_return_analysis(return_data, pil_images, deadline=deadline)
+                return_id = await writer.add(analysis_result)
+                return {
+                    'index': index,
+                    'status': 'completed',
+                    'return_id': return_id,
+                    **analysis_result,
+                    'stage_timings': stage_timings
+                }
+            except Exception as e:
+                return {'index': index, 'status': 'error', 'error': str(e)}
+
+    async def stream_results():
+        tasks = [asyncio.create_task(process(index, item)) for index, item in enumerate(items)]
+        failed = 0
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                line = await next_done
+                if line['status'] == 'error':
+                    failed += 1
+                yield json.dumps(line, default=str) + "\n"
+            await writer.flush()
+            yield json.dumps({
+                'status': 'summary',
+                'total': len(items),
+                'failed': failed,
+                'committed': writer.committed
+            }) + "\n"
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(stream_results(), media_type="application/x-ndjson")
+
+@app.get("/api/stage-timings")
+async def get_stage_timings():
+    """p50/p99 latency per pipeline stage over the recent request window"""
+    return stage_timing_stats.summary()
+
+@app.get("/api/cache-stats")
+async def get_cache_stats():
+    """Hit/miss/eviction counters for the Gemini response cache"""
+    cache = get_gemini_client().cache
+    return cache.stats() if cache is not None else {'enabled': False}
+
+@app.get("/metrics")
+async def get_metrics():
+    """Prometheus text exposition of every metric and collector"""
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/api/traces")
+async def list_traces(limit: int = 20):
+    """Most recent request/job traces, newest first"""
+    return trace_recorder.recent(limit)
+
+@app.get("/api/traces/{trace_id}")
+async def get_trace(trace_id: str):
+    """Span tree of one recent request or job, as JSON"""
+    trace = trace_recorder.get(trace_id)
+    if trace is None:
+        raise HTTPException(status_code=404, detail="Trace not found")
+    return trace
+
+@app.get("/api/token-stats")
+async def get_token_stats():
+    """Estimated vs billed input/output tokens and latency per endpoint and prompt"""
+    return prompt_token_stats.summary()
+
+@app.get("/api/scheduler-stats")
+async def get_scheduler_stats():
+    """Model-call queue depth per priority lane, wait times, retries and rate-limit headroom"""
+    return get_model_scheduler().stats()
+
+@app.get("/api/fraud-stats")
+async def get_fraud_stats():
+    """How many fraud checks the local pre-scorer decided without Gemini"""
+    return get_fraud_service().pre_scorer.stats()
+
+@app.get("/api/policy-stats")
+async def get_policy_stats():
+    """Return decisions made by the compiled policy rules vs sent to Gemini, and hits per rule"""
+    return get_decision_service().policy.stats()
+
+@app.get("/api/pricing-stats")
+async def get_pricing_stats():
+    """Size of the comparables index and how many prices were based on it"""
+    return get_pricing_service().stats()
+
+@app.get("/api/persistence-stats")
+async def get_persistence_stats():
+    """Write-behind buffer depth and batching counters"""
+    firebase = get_firebase()
+    buffer = firebase.write_buffer
+    stats = buffer.stats() if buffer is not None else {'write_behind': False}
+    return {**stats, 'return_cache': firebase.return_cache_stats()}
+
+@app.get("/api/analytics/summary")
+async def get_analytics_summary():
+    """
+    Return counts by reason, outcome, status, category, grade and fraud risk
+    band, plus total and recovered value. Served from the materialized
+    rollups, so the cost does not grow with the number of returns.
+    """
+    return summarize_rollup(await get_firebase().get_analytics())
+
+@app.get("/api/analytics/value-recovered")
+async def get_value_recovered(period: str = "day", periods: int = 7):
+    """Returns, value and value recovered per day or week (period=day|week), oldest first"""
+    if period not in ("day", "week"):
+        raise HTTPException(status_code=400, detail="period must be 'day' or 'week'")
+    periods = max(1, min(periods, settings.ANALYTICS_RETENTION_DAYS // (7 if period == "week" else 1)))
+    return {
+        'period': period,
+        'series': value_series(await get_firebase().get_analytics(), period, periods),
+    }
+
+@app.post("/api/analytics/rebuild")
+async def rebuild_analytics():
+    """Recompute the rollups from every stored return (backfill or repair)"""
+    firebase = get_firebase()
+    await firebase.flush()
+    rollup = await asyncio.get_running_loop().run_in_executor(None, firebase.rebuild_analytics)
+    return {'returns': rollup['total']}
+
+@app.get("/api/jobs/stats")
+async def get_job_stats():
+    """Number of queued/running/done/failed analysis jobs"""
+    return get_job_queue().counts()
+
 @app.get("/api/return/{return_id}")
-async def get_return(return_id: str):
+async def get_return(
+    return_id: str,
+    request: Request,
+    view: str = "full",
+    exclude: Optional[str] = None
+):
+    """
+    view=list drops heavy fields (photos, stage timings) for list views;
+    exclude takes extra comma-separated top-level fields to drop. Responses
+    carry an ETag, and a matching If-None-Match gets 304 Not Modified.
+    """
     try:
-        return await firebase.get_return(return_id)
+        document, etag = await get_firebase().get_return_with_etag(return_id)
     except Exception as e:
         raise HTTPException(status_code=404, detail="Return not found")
-        
\ No newline at end of file
+
+    excluded = set(LIST_VIEW_EXCLUDES) if view == "list" else set()
+    if exclude:
+        excluded.update(field.strip() for field in exclude.split(",") if field.strip())
+    if excluded:
+        document = {key: value for key, value in document.items() if key not in excluded}
+        # Derived from the full document's ETag, so it still changes whenever the record does
+        projection = ",".join(sorted(excluded))
+        etag = '"' + hashlib.sha1(f"{etag}|{projection}".encode()).hexdigest() + '"'
+
+    headers = {'ETag': etag, 'Cache-Control': 'private, no-cache'}
+    if_none_match = request.headers.get('if-none-match')
+    if if_none_match and etag in [tag.strip() for tag in if_none_match.split(",")]:
+        return Response(status_code=304, headers=headers)
+    return JSONResponse(content=jsonable_encoder(document), headers=headers)
+        
+@app.post("/api/return/{return_id}/resale")
+async def record_resale(return_id: str, resale: ResaleReport):
+    """
+    Record what a returned item resold for. The sale is stored on the return
+    and added to the pricing comparables, so the next price recommendation
+    for a similar item already uses it.
+    """
+    firebase = get_firebase()
+    try:
+        document = await firebase.get_return(return_id)
+    except KeyError:
+        raise HTTPException(status_code=404, detail="Return not found")
+
+    grade = (document.get('condition_grade') or {}).get('grade') or (document.get('defect_analysis') or {}).get('condition_grade')
+    days_to_sell = resale.days_to_sell
+    if days_to_sell is None:
+        filed = to_datetime(document.get('timestamp'))
+        days_to_sell = (datetime.now() - filed).days if filed else 0
+    indexed = get_pricing_service().record_sale(
+        document.get('product_category'),
+        grade,
+        document.get('original_price'),
+        resale.sale_price,
+        days_to_sell
+    )
+    sale = {
+        'sale_price': resale.sale_price,
+        'days_to_sell': days_to_sell,
+        'platform': resale.platform,
+        'sold_at': datetime.now(),
+    }
+    await firebase.update_return_status(return_id, {'resale': sale})
+    return {'return_id': return_id, 'resale': sale, 'added_to_comparables': indexed}
@@ -2,6 +2,14 @@ from pydantic import BaseModel, Field
 from typing import List, Optional
 from datetime import datetime
 
+class PhotoRef(BaseModel):
+    sha256: str  # content address in the blob store
+    size: int
+    content_type: Optional[str] = None
+    width: Optional[int] = None
+    height: Optional[int] = None
+    original_sha256: Optional[str] = None  # the upload this processed photo was made from
+
 class ReturnRequest(BaseModel):
     return_id: str
     order_id: str
@@ -14,7 +22,7 @@ class ReturnRequest(BaseModel):
     date_of_purchase: datetime
     date_of_return: datetime
     return_reason: str  # E.g., Didn’t fit, defective, changed mind, wardrobing
-    photos: List[str]  # Base64 encoded images
+    photos: List[PhotoRef]  # References into the blob store, not the image bytes
     user_submitted_notes: Optional[str]
 
 class ProductCondition(BaseModel):
@@ -24,7 +32,7 @@ class ProductCondition(BaseModel):
     confidence_score: float
     condition_details: List[str]  # Additional wear, functionality, etc.
     estimated_value_retention: int  # Percentage (0-100)
-    recommended_action: str  # "Restock", "Repair", "Liquidate", "Recycle"
+    recommended_action: str  # "Resell", "Refurbish", "Donate", "Recycle", "Repurpose", "Compost", "Disposal"
 
 class FraudCheck(BaseModel):
     is_fraudulent: bool
@@ -40,6 +48,11 @@ class PricingRecommendation(BaseModel):
     condition_factor: float
     market_demand_factor: float
 
+class ResaleReport(BaseModel):
+    sale_price: float
+    days_to_sell: Optional[float] = None  # defaults to the days since the return was filed
+    platform: Optional[str] = None
+
 class ReturnDecision(BaseModel):
     final_outcome: str  # "Resold", "Refurbished", "Recycled/Donated", "Denied"
     resale_details: Optional[dict]  # Platform & price if applicable
@@ -0,0 +1,15 @@
+"""
+Backfill the dashboard analytics rollups from the returns collection.
+
+Run from the backend directory with `python -m app.rebuild_analytics` once
+after deploying, or whenever the rollups need repairing. It scans every
+return, so prefer a quiet period; POST /api/analytics/rebuild does the same.
+"""
+from .dependencies import get_firebase
+
+def rebuild() -> None:
+    rollup = get_firebase().rebuild_analytics()
+    print(f"Rebuilt return analytics from {rollup['total']} returns")
+
+if __name__ == "__main__":
+    rebuild()
@@ -0,0 +1,124 @@
+from ..utils.gemini_client import GeminiClient, get_gemini_client
+from ..utils.image_processing import estimate_payload_bytes
+from ..utils.prompt_builder import cached_section
+from ..config import settings
+from .defect_detection import GRADE_ORDER
+from PIL import Image
+from typing import List, Union
+import asyncio
+import json
+
+class ConditionGradingService:
+    def __init__(self, gemini: GeminiClient = None):
+        self.gemini = gemini or get_gemini_client()
+
+    async def grade_condition(
+        self,
+        images: Union[Image.Image, List[Image.Image]],
+        product_category: str
+    ) -> dict:
+        """
+        Grades the resale condition from one or more photos. Multiple photos
+        share one request when they fit in MULTI_IMAGE_MAX_PAYLOAD_BYTES,
+        otherwise each photo is graded separately with bounded concurrency.
+        The merged grade is the worst grade seen in any photo.
+        """
+        if not isinstance(images, list):
+            images = [images]
+        images = images[:settings.MULTI_IMAGE_MAX_IMAGES]
+
+        if len(images) == 1:
+            result = await self._run_prompt(build_grading_prompt(product_category, 1), images[0])
+            return merge_grades([{"index": 0, **result}], result)
+
+        if estimate_payload_bytes(images) <= settings.MULTI_IMAGE_MAX_PAYLOAD_BYTES:
+            result = await self._run_prompt(
+                build_grading_prompt(product_category, len(images)), images
+            )
+            per_image = result.get("images") if isinstance(result, dict) else None
+            if isinstance(per_image, list) and per_image:
+                return merge_grades(per_image, result)
+
+        semaphore = asyncio.Semaphore(settings.MULTI_IMAGE_FALLBACK_CONCURRENCY)
+
+        async def grade_one(index: int, image: Image.Image) -> dict:
+            async with semaphore:
+                result = await self._run_prompt(build_grading_prompt(product_category, 1), image)
+            return {"index": index, **result}
+
+        per_image = await asyncio.gather(*[
+            grade_one(index, image) for index, image in enumerate(images)
+        ])
+        return merge_grades(list(per_image))
+
+    async def _run_prompt(self, prompt: str, image) -> dict:
+        result = await self.gemini.analyze_content(prompt, image, prompt_name="condition.grade")
+        if isinstance(result, str):
+            return json.loads(result)
+        return result  # If already a dictionary/list, return as is
+
+
+@cached_section
+def build_grading_prompt(product_category: str, image_count: int) -> str:
+    if image_count == 1:
+        intro = f"Grade the resale condition of the {product_category} product in this photo."
+        per_image_format = ""
+    else:
+        intro = (
+            f"You are given {image_count} photos (indexed 0 to {image_count - 1}, in the order provided) "
+            f"of one {product_category} product. Grade each photo, then give an overall grade "
+            f"that accounts for defects visible in any photo."
+        )
+        per_image_format = """
+            "images": [
+                {"index": 0, "grade": "Like New|Used - Good|Salvage", "confidence": 0.0-1.0, "observations": ["..."]}
+            ],"""
+    return f"""
+        {intro}
+
+        Use one of the following grades:
+        - Like New: No visible defects, minimal signs of wear, fully functional.
+        - Used - Good: Minor defects (e.g., light stains, small scratches), but still wearable/usable.
+        - Salvage: Major defects (e.g., large tears, missing parts), significantly reducing usability.
+
+        Return the result in JSON format:
+        {{{per_image_format}
+            "grade": "Like New|Used - Good|Salvage",
+            "confidence": 0.0-1.0,
+            "observations": ["list of observations supporting the grade"]
+        }}
+        """
+
+
+def merge_grades(per_image: List[dict], combined: dict = None) -> dict:
+    """
+    The overall grade is the worse of the model's grade and the worst photo's,
+    as in merge_image_findings; a downgrade brings that photo's recommended
+    action along. Other missing fields are derived from the photos.
+    """
+    combined = dict(combined or {})
+    findings = [finding for finding in per_image if isinstance(finding, dict)]
+    graded = [f for f in findings if f.get("grade") in GRADE_ORDER]
+    worst = min(graded, key=lambda f: GRADE_ORDER.index(f["grade"]), default=None)
+
+    if worst is not None and (
+        combined.get("grade") not in GRADE_ORDER
+        or GRADE_ORDER.index(worst["grade"]) < GRADE_ORDER.index(combined["grade"])
+    ):
+        combined["grade"] = worst["grade"]
+        if worst.get("recommended_action"):
+            combined["recommended_action"] = worst["recommended_action"]
+    elif combined.get("grade") not in GRADE_ORDER:
+        combined["grade"] = "Unknown"
+    if "confidence" not in combined:
+        scores = [f["confidence"] for f in findings if isinstance(f.get("confidence"), (int, float))]
+        combined["confidence"] = min(scores) if scores else 0.0
+    if "observations" not in combined:
+        combined["observations"] = [
+            observation for finding in findings for observation in finding.get("observations", [])
+        ]
+    if len(findings) > 1:
+        combined["images"] = findings
+    else:
+        combined.pop("images", None)
+    return combined
@@ -1,16 +1,101 @@
-from ..utils.gemini_client import GeminiClient
+from ..utils.gemini_client import GeminiClient, get_gemini_client
+from ..utils.image_processing import estimate_payload_bytes
+from ..utils.prompt_builder import cached_section, compact_text
+from ..config import settings
 from PIL import Image
+from typing import List, Optional
+import asyncio
 import json
 
+# Worst grade first, so merged results take the lowest grade seen in any photo
+GRADE_ORDER = ["Salvage", "Used - Good", "Like New"]
+
 class DefectDetectionService:
-    def __init__(self):
-        self.gemini = GeminiClient()
+    def __init__(self, gemini: GeminiClient = None):
+        self.gemini = gemini or get_gemini_client()
 
     async def identify_product_category(self, image: Image.Image) -> str:
         """
         Uses AI to analyze the image and determine the product category.
         """
-        prompt = """
+        result = await self.gemini.analyze_content(
+            CATEGORY_PROMPT, image, prompt_name="defect.identify_category"
+        )
+        if isinstance(result, str):
+            return json.loads(result).get("product_category", "Unknown")
+        return result.get("product_category", "Unknown")
+
+    async def analyze_product_image(
+        self,
+        image: Image.Image,
+        product_category: Optional[str] = None,
+        single_pass: Optional[bool] = None
+    ) -> dict:
+        """
+        Analyzes defects and condition. A caller-supplied category skips
+        classification; otherwise the single-pass mode asks for the category
+        and the assessment in one request, falling back to the two-step path
+        (category first, then defects) when the category is missing.
+        """
+        if product_category:
+            return await self._assess_defects(image, product_category)
+
+        if single_pass is None:
+            single_pass = settings.DEFECT_SINGLE_PASS
+        if single_pass:
+            result = await self._run_prompt(build_combined_prompt(), image, "defect.combined")
+            if isinstance(result, dict) and result.get("product_category"):
+                return result
+
+        product_category = await self.identify_product_category(image)
+        return await self._assess_defects(image, product_category)
+
+    async def analyze_product_images(
+        self,
+        images: List[Image.Image],
+        product_category: Optional[str] = None
+    ) -> dict:
+        """
+        Analyzes every photo of a return. Up to MULTI_IMAGE_MAX_IMAGES photos
+        are packed into one request that returns per-image findings plus a
+        merged grade; payloads over MULTI_IMAGE_MAX_PAYLOAD_BYTES fall back to
+        per-image calls with bounded concurrency.
+        """
+        images = images[:settings.MULTI_IMAGE_MAX_IMAGES]
+        if len(images) == 1:
+            return await self.analyze_product_image(images[0], product_category)
+
+        if estimate_payload_bytes(images) <= settings.MULTI_IMAGE_MAX_PAYLOAD_BYTES:
+            result = await self._run_prompt(
+                build_multi_image_prompt(len(images), product_category), images, "defect.multi_image"
+            )
+            per_image = result.get("images") if isinstance(result, dict) else None
+            if isinstance(per_image, list) and per_image:
+                return merge_image_findings(per_image, result)
+
+        semaphore = asyncio.Semaphore(settings.MULTI_IMAGE_FALLBACK_CONCURRENCY)
+
+        async def analyze_one(index: int, image: Image.Image) -> dict:
+            async with semaphore:
+                finding = await self.analyze_product_image(image, product_category)
+            return {"index": index, **finding}
+
+        per_image = await asyncio.gather(*[
+            analyze_one(index, image) for index, image in enumerate(images)
+        ])
+        return merge_image_findings(list(per_image))
+
+    async def _assess_defects(self, image: Image.Image, product_category: str) -> dict:
+        return await self._run_prompt(build_defect_prompt(product_category), image, "defect.assess")
+
+    async def _run_prompt(self, prompt: str, image, prompt_name: str) -> dict:
+        result = await self.gemini.analyze_content(prompt, image, prompt_name=prompt_name)
+        if isinstance(result, str):
+            return json.loads(result)
+        return result  # If already a dictionary/list, return as is
+
+
+CATEGORY_PROMPT = compact_text("""
         Identify the specific type of apparel from this image. Examples include:
         - Shirt
         - Shoes
@@ -25,22 +110,10 @@ class DefectDetectionService:
         {
             "product_category": "identified_type"
         }
-        """
+        """)
 
-        result = await self.gemini.analyze_content(prompt, image)
-        if isinstance(result, str):
-            return json.loads(result).get("product_category", "Unknown")
-        return result.get("product_category", "Unknown")
-
-    async def analyze_product_image(self, image: Image.Image) -> dict:
-        """
-        Identifies the product category first, then analyzes defects and condition.
-        """
-        product_category = await self.identify_product_category(image)
-
-        prompt = f"""
-        Analyze this image of a {product_category} product and perform the following assessments:
 
+DEFECT_ASSESSMENT_STEPS = """
         1. Identify any visible defects, such as:
         - Scratches, stains, discoloration
         - Tears, holes, missing parts
@@ -69,10 +142,15 @@ class DefectDetectionService:
         - Repurpose: If the item cannot be worn but can be converted into another product (e.g., fabric for crafts).
         - Compost: If the item is fully biodegradable and no longer usable.
         - Disposal: If the item is severely damaged, non-recyclable, and cannot be repurposed.
+"""
 
+
+@cached_section
+def _defect_result_format(category_value: str) -> str:
+    return f"""
         Return the results in JSON format:
         {{
-            "product_category": "{product_category}",
+            "product_category": "{category_value}",
             "defects": ["list of defects found"],
             "condition_grade": "Like New|Used - Good|Salvage",
             "confidence_score": 0.0-1.0,
@@ -81,8 +159,109 @@ class DefectDetectionService:
             "recommended_action": "Resell|Refurbish|Donate|Recycle|Repurpose|Compost|Disposal"
         }}
         """
-        
-        result = await self.gemini.analyze_content(prompt, image)
-        if isinstance(result, str):
-            return json.loads(result)
-        return result  # If already a dictionary/list, return as is
+
+
+@cached_section
+def build_defect_prompt(product_category: str) -> str:
+    return (
+        f"""
+        Analyze this image of a {product_category} product and perform the following assessments:
+"""
+        + DEFECT_ASSESSMENT_STEPS
+        + _defect_result_format(product_category)
+    )
+
+
+@cached_section
+def build_multi_image_prompt(image_count: int, product_category: Optional[str] = None) -> str:
+    subject = f"a {product_category} product" if product_category else "an apparel product"
+    category_value = product_category or "identified_type"
+    return (
+        f"""
+        You are given {image_count} photos (indexed 0 to {image_count - 1}, in the order provided) of {subject}.
+        Assess every photo separately, then give an overall assessment that accounts for defects in any photo.
+        For each photo, perform the following assessments:
+"""
+        + DEFECT_ASSESSMENT_STEPS
+        + f"""
+        Return the results in JSON format:
+        {{
+            "product_category": "{category_value}",
+            "images": [
+                {{
+                    "index": 0,
+                    "defects": ["list of defects found in this photo"],
+                    "condition_grade": "Like New|Used - Good|Salvage",
+                    "confidence_score": 0.0-1.0,
+                    "condition_details": ["list of condition observations"]
+                }}
+            ],
+            "defects": ["all defects found across photos"],
+            "condition_grade": "Like New|Used - Good|Salvage",
+            "confidence_score": 0.0-1.0,
+            "condition_details": ["overall condition observations"],
+            "estimated_value_retention": 0-100,
+            "recommended_action": "Resell|Refurbish|Donate|Recycle|Repurpose|Compost|Disposal"
+        }}
+        """
+    )
+
+
+def merge_image_findings(per_image: List[dict], combined: Optional[dict] = None) -> dict:
+    """
+    Builds the overall assessment from per-image findings. Fields the model
+    already merged are kept and anything missing is derived locally, except
+    the grade: it is the worse of the model's grade and the worst photo's,
+    and a downgrade brings that photo's recommended action along.
+    """
+    combined = dict(combined or {})
+    findings = [finding for finding in per_image if isinstance(finding, dict)]
+
+    graded = [f for f in findings if f.get("condition_grade") in GRADE_ORDER]
+    worst = min(graded, key=lambda f: GRADE_ORDER.index(f["condition_grade"]), default=None)
+
+    if not combined.get("product_category"):
+        categories = [f.get("product_category") for f in findings if f.get("product_category")]
+        combined["product_category"] = categories[0] if categories else "Unknown"
+    if "defects" not in combined:
+        defects = []
+        for finding in findings:
+            for defect in finding.get("defects", []):
+                if defect not in defects:
+                    defects.append(defect)
+        combined["defects"] = defects
+    if worst is not None and (
+        combined.get("condition_grade") not in GRADE_ORDER
+        or GRADE_ORDER.index(worst["condition_grade"]) < GRADE_ORDER.index(combined["condition_grade"])
+    ):
+        combined["condition_grade"] = worst["condition_grade"]
+        if worst.get("recommended_action"):
+            combined["recommended_action"] = worst["recommended_action"]
+    if "confidence_score" not in combined:
+        scores = [f["confidence_score"] for f in findings if isinstance(f.get("confidence_score"), (int, float))]
+        combined["confidence_score"] = min(scores) if scores else 0.0
+    if "condition_details" not in combined:
+        combined["condition_details"] = [
+            detail for finding in findings for detail in finding.get("condition_details", [])
+        ]
+    if "estimated_value_retention" not in combined:
+        retention = [f["estimated_value_retention"] for f in findings if isinstance(f.get("estimated_value_retention"), (int, float))]
+        if retention:
+            combined["estimated_value_retention"] = min(retention)
+    if "recommended_action" not in combined and worst is not None and worst.get("recommended_action"):
+        combined["recommended_action"] = worst["recommended_action"]
+
+    combined["images"] = findings
+    return combined
+
+
+@cached_section
+def build_combined_prompt() -> str:
+    return (
+        """
+        Analyze this image of an apparel product. First identify the specific type of apparel
+        (e.g. Shirt, Shoes, Jacket, Pants, Dress, Hat, Sweater, Skirt), then perform the following assessments:
+"""
+        + DEFECT_ASSESSMENT_STEPS
+        + _defect_result_format("identified_type")
+    )
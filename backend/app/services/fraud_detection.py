@@ -1,12 +1,98 @@
-from ..utils.gemini_client import GeminiClient
+from ..utils.gemini_client import GeminiClient, get_gemini_client
+from ..utils.prompt_builder import PromptBuilder, compact_text
+from ..config import settings
+from .fraud_scoring import FraudPreScorer
 import json
 
+# Fields of the return and of the history aggregate that inform the fraud
+# check; photos, notes and analysis results are never sent
+RETURN_FIELDS = {
+    'product_category': None,
+    'original_price': None,
+    'date_of_purchase': None,
+    'date_of_return': None,
+    'days_until_return': None,
+    'return_reason': None,
+    'product': None,
+    'price': None,
+    'product_details': {'Name': None, 'Brand': None, 'Category': None, 'Price': None},
+}
+HISTORY_FIELDS = {
+    'total_returns': None,
+    'total_value': None,
+    'returns_30d': None,
+    'returns_90d': None,
+    'returns_365d': None,
+    'value_30d': None,
+    'value_90d': None,
+    'value_365d': None,
+    'days_to_return': None,
+    'category_counts': None,
+    'prior_fraud_flags': None,
+    'recent_returns': {
+        'date': None,
+        'category': None,
+        'price': None,
+        'days_until_return': None,
+        'return_reason': None,
+        'condition': None,
+        'fraud_flagged': None,
+        'status': None,
+    },
+}
+
+MATCH_FIELDS = {
+    'image': None,
+    'return_id': None,
+    'same_user': None,
+    'distance': None,
+}
+
 class FraudDetectionService:
-    def __init__(self):
-        self.gemini = GeminiClient()
+    def __init__(self, gemini: GeminiClient = None, pre_scorer: FraudPreScorer = None):
+        self.gemini = gemini or get_gemini_client()
+        self.pre_scorer = pre_scorer or FraudPreScorer()
 
-    async def analyze_return_pattern(self, return_data: dict, user_history: dict) -> dict:
-        prompt = f"""
+    async def analyze_return_pattern(self, return_data: dict, user_history: dict, image_matches: list = None) -> dict:
+        """
+        Clear low/high risk returns are decided by the local pre-scorer; only
+        the ambiguous middle band is sent to Gemini. image_matches are earlier
+        returns with near-duplicate photos (see ImageHashIndex).
+        """
+        prescore = self.pre_scorer.score(return_data, user_history, image_matches)
+        if prescore['decision'] is not None:
+            return self.pre_scorer.to_fraud_check(prescore)
+
+        builder = (
+            PromptBuilder(settings.PROMPT_TOKEN_BUDGET)
+            .add_text(FRAUD_CRITERIA)
+            .add_text("User & Return Data for Evaluation")
+            .add_payload("Current Return Data", return_data, RETURN_FIELDS, priority=3)
+            .add_text(f"Local Pre-Screen Score (0-1, ambiguous band): {prescore['score']}")
+            .add_payload(
+                "User History (totals, rolling 30/90/365-day return counts and values, category mix, "
+                "prior fraud flags and the most recent returns)",
+                user_history, HISTORY_FIELDS, priority=2
+            )
+        )
+        if image_matches:
+            builder.add_payload(
+                "Near-Duplicate Photos From Earlier Returns (Hamming distance of 64-bit perceptual hashes)",
+                [{**match, 'same_user': match.get('user_id') == return_data.get('user_id')} for match in image_matches],
+                MATCH_FIELDS, priority=1
+            )
+        prompt = builder.add_text(FRAUD_RESPONSE_FORMAT).build()
+
+        result = await self.gemini.analyze_content(prompt, prompt_name="fraud.pattern")
+        if isinstance(result, str):
+            result = json.loads(result)
+        if isinstance(result, dict):
+            result['pre_score'] = prescore['score']
+            result['scored_by'] = 'llm'
+        return result
+
+
+FRAUD_CRITERIA = compact_text("""
         Analyze the return request for potential fraudulent patterns by assessing the following key factors:
         
         Fraud Detection Criteria:
@@ -28,30 +114,23 @@ class FraudDetectionService:
         7. Previous Fraudulent Behavior:
             - Check for any historical fraud flags in past transactions.
             - Identify reselling exploits (e.g., buying discounted items and returning duplicates).
-        
-        User & Return Data for Evaluation
-        User History: {json.dumps(user_history)}
-        Current Return Data: {json.dumps(return_data)}
+        """)
 
+FRAUD_RESPONSE_FORMAT = compact_text("""
         Expected JSON Response Format:
-        {{
+        {
             "risk_category": "Low|Medium|High",  # Fraud risk classification
             "risk_score": float,  # AI-generated fraud risk score (0-100%)
             "flags": ["List of detected fraud patterns"],
             "fraud_reason": "Detailed explanation of why the return is flagged (e.g., excessive returns, counterfeit swap, receipt fraud).",
             "previous_returns_count": int,  # Total historical return count
-            "return_pattern_analysis": {{
+            "return_pattern_analysis": {
                 "frequent_returns": boolean,  # Has the user exceeded return frequency thresholds?
                 "expensive_items_only": boolean,  # Does the user primarily return high-value items?
                 "wardrobing_suspected": boolean,  # Short-term usage detected?
                 "receipt_fraud_suspected": boolean,  # Fake or altered receipt detected?
                 "counterfeit_substitution_suspected": boolean,  # Item mismatch with original purchase?
                 "reselling_exploits_suspected": boolean  # Pattern of purchasing and returning similar items?
-            }}
-        }}
-        """
-        
-        result = await self.gemini.analyze_content(prompt)
-        if isinstance(result, str):
-            return json.loads(result)
-        return result  # If already a dictionary/list, return as is
+            }
+        }
+        """)
@@ -0,0 +1,163 @@
+import numpy as np
+from datetime import datetime, timedelta
+from ..config import settings
+from ..utils.return_history import slim_return_record, to_float
+
+WARDROBING_DAYS = 7
+
+# Feature weights; they sum to 1.0 so the score stays in [0, 1]
+WEIGHTS = {
+    'return_frequency': 0.30,
+    'prior_fraud_flags': 0.25,
+    'short_usage': 0.15,
+    'high_value': 0.15,
+    'repeat_category': 0.15,
+}
+
+
+class FraudPreScorer:
+    """
+    Deterministic first fraud tier. Scores a return from the user's history
+    aggregate and the current return with a handful of vectorized features;
+    clear low and clear high risk returns are decided locally and only the
+    ambiguous middle band is sent to Gemini.
+    """
+
+    def __init__(
+        self,
+        low_threshold: float = None,
+        high_threshold: float = None,
+        frequency_threshold: int = None,
+        copied_photo_distance: int = None
+    ):
+        self.low_threshold = low_threshold if low_threshold is not None else settings.FRAUD_PRESCORE_LOW_THRESHOLD
+        self.high_threshold = high_threshold if high_threshold is not None else settings.FRAUD_RISK_THRESHOLD
+        self.frequency_threshold = frequency_threshold or settings.RETURN_FREQUENCY_THRESHOLD
+        # Only a practically identical photo from another customer decides High
+        # locally; looser matches (similar studio shots) go to Gemini as evidence
+        self.copied_photo_distance = (
+            copied_photo_distance if copied_photo_distance is not None else settings.IMAGE_REUSE_MAX_DISTANCE
+        )
+        self.decided_low = 0
+        self.decided_high = 0
+        self.escalated = 0
+
+    def _features(self, return_data: dict, user_history: dict) -> dict:
+        current = slim_return_record(return_data.get('return_id'), return_data)
+        price = current['price'] or to_float(return_data.get('price'))
+        days = current['days_until_return']
+        if days is None:
+            days = return_data.get('days_until_return')
+        category = current['category'] if current['category'] != "Unknown" else return_data.get('product', "Unknown")
+
+        history = user_history.get('recent_returns') or user_history.get('returns') or []
+        previous_count = user_history.get('total_returns', len(history))
+        returns_30d = user_history.get('returns_30d')
+
+        history_prices = np.array([to_float(r.get('price')) for r in history], dtype=np.float64)
+        history_days = np.array(
+            [r['days_until_return'] for r in history if isinstance(r.get('days_until_return'), (int, float))],
+            dtype=np.float64
+        )
+        history_categories = np.array([r.get('category') or r.get('product') or "" for r in history])
+
+        if returns_30d is None:
+            # Raw history lists carry no window totals; count entries dated in the last 30 days
+            cutoff = (datetime.now() - timedelta(days=30)).strftime("%Y-%m-%d")
+            returns_30d = sum(1 for r in history if str(r.get('date', '')) >= cutoff)
+        frequency = min(1.0, returns_30d / max(1, self.frequency_threshold))
+
+        short_usage_history = float(np.mean(history_days <= WARDROBING_DAYS)) if history_days.size else 0.0
+        short_usage = 0.5 * short_usage_history + (0.5 if days is not None and days <= WARDROBING_DAYS else 0.0)
+
+        high_value_history = (
+            float(np.mean(history_prices >= settings.HIGH_VALUE_PRICE_THRESHOLD)) if history_prices.size else 0.0
+        )
+        price_band = float(np.searchsorted([100.0, 200.0, 500.0], price, side='right')) / 3
+        high_value = 0.5 * high_value_history + 0.5 * price_band
+
+        repeat_category = float(np.mean(history_categories == category)) if history_categories.size else 0.0
+        prior_fraud = min(1.0, user_history.get('prior_fraud_flags', 0) / 2)
+
+        return {
+            'return_frequency': frequency,
+            'prior_fraud_flags': prior_fraud,
+            'short_usage': short_usage,
+            'high_value': high_value,
+            'repeat_category': repeat_category,
+            '_previous_returns_count': previous_count,
+        }
+
+    def score(self, return_data: dict, user_history: dict, image_matches: list = None) -> dict:
+        """
+        Return {'score', 'decision', 'features'}; decision is 'Low', 'High' or
+        None (ambiguous). A photo practically identical (within
+        copied_photo_distance) to another customer's decides High; any other
+        near-duplicate match rules out Low, so the return goes to Gemini.
+        """
+        features = self._features(return_data, user_history)
+        weights = np.array([WEIGHTS[name] for name in WEIGHTS])
+        values = np.array([features[name] for name in WEIGHTS])
+        score = float(weights @ values)
+        user_id = return_data.get('user_id')
+        reused = image_matches or []
+        from_others = [match for match in reused if match.get('user_id') != user_id]
+        features['_photos_from_other_users'] = len(from_others)
+        features['_photos_copied_from_other_users'] = sum(
+            1 for match in from_others if match.get('distance', 64) <= self.copied_photo_distance
+        )
+        features['_photos_reused'] = len(reused)
+
+        if features['_photos_copied_from_other_users']:
+            decision = "High"
+            self.decided_high += 1
+        elif score < self.low_threshold and not reused:
+            decision = "Low"
+            self.decided_low += 1
+        elif score >= self.high_threshold:
+            decision = "High"
+            self.decided_high += 1
+        else:
+            decision = None
+            self.escalated += 1
+        return {'score': round(score, 4), 'decision': decision, 'features': features}
+
+    def to_fraud_check(self, prescore: dict) -> dict:
+        """Fill the FraudCheck fields (plus risk_category) from a local decision."""
+        features = prescore['features']
+        pattern = {
+            'frequent_returns': features['return_frequency'] >= 1.0,
+            'expensive_items_only': features['high_value'] >= 0.75,
+            'wardrobing_suspected': features['short_usage'] >= 0.5,
+            'receipt_fraud_suspected': False,
+            'counterfeit_substitution_suspected': False,
+            'reselling_exploits_suspected': features['repeat_category'] >= 0.5 and features['return_frequency'] >= 0.6,
+            'reused_photos_suspected': features.get('_photos_reused', 0) > 0,
+            'copied_photos_suspected': features.get('_photos_copied_from_other_users', 0) > 0,
+        }
+        flags = [name for name, flagged in pattern.items() if flagged]
+        if features['prior_fraud_flags'] > 0:
+            flags.append('prior_fraud_flags')
+        is_high = prescore['decision'] == "High"
+        return {
+            'risk_category': prescore['decision'],
+            'risk_score': round(prescore['score'] * 100, 1),
+            'is_fraudulent': is_high,
+            'flags': flags,
+            'fraud_reason': (
+                "Local pre-screen: " + ", ".join(flags) if is_high
+                else "Local pre-screen found no significant fraud indicators."
+            ),
+            'previous_returns_count': features['_previous_returns_count'],
+            'return_pattern_analysis': pattern,
+            'scored_by': 'pre_scorer',
+        }
+
+    def stats(self) -> dict:
+        total = self.decided_low + self.decided_high + self.escalated
+        return {
+            'decided_low': self.decided_low,
+            'decided_high': self.decided_high,
+            'escalated_to_llm': self.escalated,
+            'llm_calls_avoided_ratio': round((self.decided_low + self.decided_high) / total, 4) if total else 0.0,
+        }
@@ -0,0 +1,286 @@
+from collections import namedtuple
+from ..utils.return_history import to_datetime
+
+# Tree nodes. A Branch tests one predicate, which answers True, False or None
+# (a fact it needs is missing); None leaves the whole decision to the LLM.
+Branch = namedtuple('Branch', ['rule', 'predicate', 'yes', 'no'])
+Decision = namedtuple('Decision', ['rule', 'outcome', 'reason'])
+CONTINUE = 'continue'  # this tree has no opinion, try the next one
+UNDECIDED = 'undecided'  # the rules cannot settle it; ask the LLM
+
+# Rule canvas "Assign outcome" values -> final outcomes
+CANVAS_OUTCOMES = {
+    'RESTOCK': "Resell",
+    'RESELL': "Resell",
+    'REFURBISH': "Refurbish",
+    'REPAIR': "Refurbish",
+    'DONATE': "Donate",
+    'RECYCLE': "Recycle",
+    'LIQUIDATE': "Recycle",
+    'REPURPOSE': "Repurpose",
+    'COMPOST': "Compost",
+    'DISPOSE': "Dispose",
+}
+# recommended_action from defect analysis (the defect prompt's vocabulary:
+# Resell|Refurbish|Donate|Recycle|Repurpose|Compost|Disposal) -> outcome for
+# a 'Used - Good' item; the other actions are left to the LLM
+USED_GOOD_ACTIONS = {
+    'Resell': "Resell",
+    'Refurbish': "Refurbish",
+}
+
+
+def extract_facts(return_data: dict, defect_analysis: dict, fraud_analysis: dict) -> dict:
+    """The handful of values the compiled predicates read, computed once per return"""
+    return_data = return_data or {}
+    defect_analysis = defect_analysis if isinstance(defect_analysis, dict) else {}
+    fraud_analysis = fraud_analysis if isinstance(fraud_analysis, dict) else {}
+    details = return_data.get('product_details') or {}
+
+    purchased = to_datetime(return_data.get('date_of_purchase') or return_data.get('purchaseDate'))
+    returned = to_datetime(return_data.get('date_of_return') or return_data.get('returnDate'))
+    days = (returned - purchased).days if purchased and returned else return_data.get('days_until_return')
+
+    grade = defect_analysis.get('condition_grade')
+    defects = defect_analysis.get('defects')
+    item_condition = return_data.get('item_condition') or return_data.get('itemCondition')
+    if item_condition:
+        unused = str(item_condition).lower() == 'unused'
+    elif grade:
+        unused = grade == "Like New" and not defects
+    else:
+        unused = None
+
+    packaging = return_data.get('original_packaging', return_data.get('originalPackaging'))
+    returns_count = fraud_analysis.get('previous_returns_count', return_data.get('customer_returns_count'))
+    category = (
+        return_data.get('product_category') or details.get('Category')
+        or defect_analysis.get('product_category') or ""
+    )
+    return {
+        'category': str(category).strip().lower(),
+        'days_since_purchase': days,
+        'item_unused': unused,
+        'original_packaging': packaging if isinstance(packaging, bool) else None,
+        'returns_count': returns_count,
+        'condition_grade': grade,
+        'recommended_action': defect_analysis.get('recommended_action'),
+        'risk_category': fraud_analysis.get('risk_category'),
+        'is_fraudulent': fraud_analysis.get('is_fraudulent'),
+    }
+
+
+def _fact_is(name: str, expected, missing=None):
+    def predicate(facts: dict):
+        value = facts.get(name)
+        return missing if value is None else value == expected
+    return predicate
+
+
+def _fact_at_most(name: str, limit: float):
+    def predicate(facts: dict):
+        value = facts.get(name)
+        return None if value is None else value <= limit
+    return predicate
+
+
+def _fact_above(name: str, limit: float, missing=None):
+    def predicate(facts: dict):
+        value = facts.get(name)
+        return missing if value is None else value > limit
+    return predicate
+
+
+def _suspected_fraud(facts: dict):
+    if facts['is_fraudulent'] is None and facts['risk_category'] is None:
+        return None
+    return bool(facts['is_fraudulent']) or facts['risk_category'] == "High"
+
+
+def _chain(*branches) -> object:
+    """Link (rule, predicate, outcome_if_true) steps into a tree that falls through to CONTINUE"""
+    node = CONTINUE
+    for rule, predicate, leaf in reversed(branches):
+        node = Branch(rule, predicate, leaf, node)
+    return node
+
+
+def compile_category_policy(name: str, policy: dict) -> object:
+    """
+    {"return_window": 30, "final_sale": false, "requires_original_box": true} -> tree.
+    A denial only applies when the return shows the violation; a return
+    without dates or packaging details is not denied on that rule.
+    """
+    steps = []
+    if policy.get('final_sale'):
+        steps.append((f"{name}.final_sale", lambda facts: True,
+                      Decision(f"{name}.final_sale", "Deny", "Final-sale items cannot be returned")))
+    window = policy.get('return_window')
+    if window is not None:
+        steps.append((f"{name}.return_window", _fact_above('days_since_purchase', int(window), missing=False),
+                      Decision(f"{name}.return_window", "Deny", f"Returned outside the {int(window)}-day return window")))
+    if policy.get('requires_original_box'):
+        steps.append((f"{name}.requires_original_box", _fact_is('original_packaging', False, missing=False),
+                      Decision(f"{name}.requires_original_box", "Deny", "Original packaging is required")))
+    return _chain(*steps)
+
+
+def _canvas_condition(data: dict):
+    block = data.get('id') or ""
+    config = data.get('config') or {}
+    if 'condition_days' in block:
+        return _fact_at_most('days_since_purchase', int(config.get('days') or 30))
+    if 'condition_unused' in block:
+        return _fact_is('item_unused', True)
+    if 'condition_packaging' in block:
+        return _fact_is('original_packaging', True)
+    if 'condition_excessive' in block:
+        return _fact_above('returns_count', int(config.get('threshold') or 3))
+    return None
+
+
+def _canvas_action(node_id: str, data: dict):
+    block = data.get('id') or ""
+    config = data.get('config') or {}
+    if 'action_reject' in block:
+        return Decision(node_id, "Deny", data.get('title') or "Rejected by return policy")
+    if 'action_review' in block:
+        return Decision(node_id, "Pending", data.get('title') or "Flagged for manual review by return policy")
+    if 'action_outcome' in block:
+        outcome = CANVAS_OUTCOMES.get(str(config.get('outcome') or 'RESTOCK').upper())
+        return Decision(node_id, outcome, data.get('title')) if outcome else UNDECIDED
+    # approve / notify / email accept the return; the disposition rules decide what happens to it
+    return CONTINUE
+
+
+def compile_canvas_flow(definition: dict) -> object:
+    """
+    A rule exported from the Next.js rule canvas ({"nodes", "edges"}, as read
+    by rule-execution-engine.js) -> tree. Unknown condition blocks and cycles
+    compile to UNDECIDED rather than guessing.
+    """
+    nodes = {node['id']: node for node in definition.get('nodes', [])}
+    edges = {(edge['source'], edge.get('sourceHandle')): edge['target'] for edge in definition.get('edges', [])}
+    trigger = next((node_id for node_id, node in nodes.items() if node.get('type') == 'trigger'), None)
+    if trigger is None:
+        print(f"Rule flow {definition.get('id')} has no trigger node; ignoring it")
+        return CONTINUE
+
+    def build(node_id, path: frozenset):
+        if node_id is None or node_id not in nodes:
+            return CONTINUE  # the flow ends without an action
+        if node_id in path:
+            print(f"Rule flow {definition.get('id')} loops at {node_id}; leaving it to the LLM")
+            return UNDECIDED
+        node = nodes[node_id]
+        data = node.get('data') or {}
+        path = path | {node_id}
+        if node.get('type') == 'trigger':
+            return build(edges.get((node_id, 'output')), path)
+        if node.get('type') == 'condition':
+            predicate = _canvas_condition(data)
+            if predicate is None:
+                print(f"Unknown rule condition {data.get('id')}; leaving it to the LLM")
+                return UNDECIDED
+            return Branch(
+                f"{definition.get('id', 'rule')}.{data.get('id')}",
+                predicate,
+                build(edges.get((node_id, 'yes')), path),
+                build(edges.get((node_id, 'no')), path)
+            )
+        if node.get('type') == 'action':
+            return _canvas_action(f"{definition.get('id', 'rule')}.{data.get('id')}", data)
+        return UNDECIDED
+
+    return build(trigger, frozenset())
+
+
+FRAUD_GATE = _chain(
+    ('fraud.suspected', _suspected_fraud,
+     Decision('fraud.suspected', "Pending", "Flagged for manual review due to suspected fraud")),
+)
+
+
+def _used_good_actions() -> object:
+    node = UNDECIDED
+    for action, outcome in reversed(list(USED_GOOD_ACTIONS.items())):
+        rule = f"condition.used_good.{action.lower()}"
+        node = Branch(rule, _fact_is('recommended_action', action), Decision(rule, outcome, None), node)
+    return node
+
+
+DISPOSITION = Branch(
+    'condition.like_new_low_risk',
+    lambda facts: None if facts['condition_grade'] is None else (
+        facts['condition_grade'] == "Like New" and facts['risk_category'] == "Low"
+    ),
+    Decision('condition.like_new_low_risk', "Resell", None),
+    Branch(
+        'condition.used_good',
+        _fact_is('condition_grade', "Used - Good"),
+        _used_good_actions(),
+        Branch(
+            'condition.salvage_recycle',
+            lambda facts: facts['condition_grade'] == "Salvage" and facts['recommended_action'] == "Recycle",
+            Decision('condition.salvage_recycle', "Recycle", None),
+            UNDECIDED
+        )
+    )
+)
+
+
+class PolicyEngine:
+    """
+    Return policy rules compiled once into predicate trees and evaluated
+    locally. Trees run in order: the policy for the return's category (looked
+    up by name), each rule canvas flow, the fraud gate, then the condition
+    disposition rules. The first decision wins; any tree that needs a fact
+    it does not have leaves the case to the LLM.
+    """
+
+    def __init__(self, return_policy_rules: dict = None):
+        rules = return_policy_rules or {}
+        flows = rules.get('flows') or ([rules] if 'nodes' in rules else [])
+        self.category_trees = {
+            name.strip().lower(): compile_category_policy(name, policy)
+            for name, policy in rules.items()
+            if isinstance(policy, dict) and name not in ('flows', 'nodes', 'edges')
+        }
+        self.default_tree = self.category_trees.pop('default', CONTINUE)
+        self.flow_trees = [compile_canvas_flow(flow) for flow in flows if flow.get('isActive', True)]
+        self.decided = 0
+        self.fallbacks = 0
+        self.rule_hits = {}
+
+    def _walk(self, node, facts: dict):
+        while isinstance(node, Branch):
+            answer = node.predicate(facts)
+            if answer is None:
+                return UNDECIDED
+            node = node.yes if answer else node.no
+        return node
+
+    def evaluate(self, return_data: dict, defect_analysis: dict, fraud_analysis: dict):
+        """A Decision, or None when the rules leave the case to the LLM"""
+        facts = extract_facts(return_data, defect_analysis, fraud_analysis)
+        trees = [self.category_trees.get(facts['category'], self.default_tree), *self.flow_trees, FRAUD_GATE, DISPOSITION]
+        for tree in trees:
+            result = self._walk(tree, facts)
+            if result == CONTINUE:
+                continue
+            if result == UNDECIDED:
+                break
+            self.decided += 1
+            self.rule_hits[result.rule] = self.rule_hits.get(result.rule, 0) + 1
+            return result
+        self.fallbacks += 1
+        return None
+
+    def stats(self) -> dict:
+        total = self.decided + self.fallbacks
+        return {
+            'decided_by_rules': self.decided,
+            'llm_fallbacks': self.fallbacks,
+            'rule_hit_ratio': round(self.decided / total, 4) if total else 0.0,
+            'rule_hits': dict(self.rule_hits),
+        }
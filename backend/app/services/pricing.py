@@ -0,0 +1,133 @@
+from typing import Optional
+from ..config import settings
+from ..utils.comparables import ComparablesIndex, append_record
+from ..utils.return_history import to_float
+
+# Share of the original price a returned item typically resells for, by grade
+CONDITION_FACTORS = {
+    "Like New": 0.85,
+    "Used - Good": 0.6,
+    "Salvage": 0.2,
+}
+DEFAULT_CONDITION_FACTOR = 0.5
+MARKET_DEMAND_RANGE = (0.5, 1.5)
+
+
+class PricingService:
+    """
+    Suggests a resale price from the original price, condition grade and
+    comparable past sales. condition_factor is what items of this grade and
+    a similar price recovered across all categories; market_demand_factor is
+    how this category's comparables did against that, nudged up when they
+    sold faster and down when slower. Without enough comparables the static
+    CONDITION_FACTORS and a neutral demand of 1.0 are used.
+    """
+
+    def __init__(
+        self,
+        comparables: Optional[ComparablesIndex] = None,
+        condition_factors: dict = None,
+        sales_log: Optional[str] = None
+    ):
+        self.comparables = comparables if comparables is not None else ComparablesIndex()
+        self.sales_log = sales_log
+        self.condition_factors = condition_factors or CONDITION_FACTORS
+        self.k = settings.PRICING_COMPARABLES_K
+        self.min_comparables = settings.PRICING_MIN_COMPARABLES
+        self.lookups = 0
+        self.priced_by_comparables = 0
+
+    def market_factors(self, original_price: float, condition_grade: str, product_category: str) -> dict:
+        """condition_factor, market_demand_factor and what they were based on"""
+        condition_factor = self.condition_factors.get(condition_grade, DEFAULT_CONDITION_FACTOR)
+        factors = {
+            'condition_factor': condition_factor,
+            'market_demand_factor': 1.0,
+            'comparables': 0,
+            'expected_days_to_sell': None,
+            'pricing_source': "static",
+        }
+        self.lookups += 1
+        found = self.comparables.query(product_category, condition_grade, original_price, self.k)
+        if not found or found['grade_comparables'] < self.min_comparables or found['grade_recovery'] <= 0:
+            return factors
+
+        self.priced_by_comparables += 1
+        factors.update({
+            'condition_factor': round(found['grade_recovery'], 4),
+            'comparables': found['grade_comparables'],
+            'expected_days_to_sell': round(found['grade_days_to_sell'], 1),
+            'pricing_source': "comparables",
+        })
+        if found['category_comparables'] >= self.min_comparables:
+            demand = found['category_recovery'] / found['grade_recovery']
+            if found['category_days_to_sell'] > 0 and found['grade_days_to_sell'] > 0:
+                speed = found['grade_days_to_sell'] / found['category_days_to_sell']
+                demand *= speed ** settings.PRICING_SELL_SPEED_ELASTICITY
+            low, high = MARKET_DEMAND_RANGE
+            factors.update({
+                'market_demand_factor': round(min(max(demand, low), high), 4),
+                'comparables': found['category_comparables'],
+                'expected_days_to_sell': round(found['category_days_to_sell'], 1),
+            })
+        return factors
+
+    async def get_price_recommendation(
+        self,
+        original_price,
+        condition_grade: str,
+        product_category: str,
+        market_data: dict = None
+    ) -> dict:
+        """
+        Returns a PricingRecommendation-shaped dict plus the comparables used.
+        A market_demand_factor in market_data overrides the computed one.
+        """
+        original_price = to_float(original_price)
+        factors = self.market_factors(original_price, condition_grade, product_category)
+        override = to_float((market_data or {}).get('market_demand_factor'))
+        if override:
+            factors['market_demand_factor'] = override
+        return {
+            'suggested_price': round(original_price * factors['condition_factor'] * factors['market_demand_factor'], 2),
+            'original_price': original_price,
+            **factors,
+        }
+
+    def record_sale(
+        self,
+        product_category: str,
+        condition_grade: str,
+        original_price,
+        sale_price,
+        days_to_sell
+    ) -> bool:
+        """
+        Add a resold return to the comparables; later lookups see it
+        immediately. With a sales log the sale is also appended there, so it
+        survives a restart and reaches the other workers when they next load.
+        """
+        record = {
+            'category': product_category,
+            'grade': condition_grade,
+            'original_price': to_float(original_price),
+            'sale_price': sale_price,
+            'days_to_sell': days_to_sell,
+        }
+        if not self.comparables.extend([record]):
+            return False
+        if self.sales_log:
+            try:
+                append_record(self.sales_log, record)
+            except Exception as e:
+                print(f"Error appending to the pricing sales log: {str(e)}")
+        return True
+
+    def stats(self) -> dict:
+        return {
+            'comparables': len(self.comparables),
+            'categories': len(self.comparables.categories),
+            'lookups': self.lookups,
+            'priced_by_comparables': self.priced_by_comparables,
+            'comparables_hit_ratio': round(self.priced_by_comparables / self.lookups, 4) if self.lookups else 0.0,
+        }
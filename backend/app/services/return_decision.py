@@ -1,13 +1,112 @@
-from ..utils.gemini_client import GeminiClient
+from ..utils.gemini_client import GeminiClient, get_gemini_client
+from ..utils.prompt_builder import PromptBuilder, compact_text
+from ..config import settings
+from .policy_rules import PolicyEngine
 import json
 
+# Per-image findings and free-text reasoning are left out; the merged fields
+# carry what the decision needs
+DEFECT_FIELDS = {
+    'product_category': None,
+    'defects': None,
+    'condition_grade': None,
+    'confidence_score': None,
+    'condition_details': None,
+    'estimated_value_retention': None,
+    'recommended_action': None,
+}
+FRAUD_FIELDS = {
+    'risk_category': None,
+    'risk_score': None,
+    'flags': None,
+    'fraud_reason': None,
+}
+
 class ReturnDecisionService:
-    def __init__(self, return_policy_rules: dict):
-        self.gemini = GeminiClient()
+    def __init__(self, return_policy_rules: dict, gemini: GeminiClient = None):
+        self.gemini = gemini or get_gemini_client()
         self.return_policy_rules = return_policy_rules
+        self.policy = PolicyEngine(return_policy_rules)
+
+    async def determine_final_outcome(
+        self,
+        defect_analysis: dict,
+        fraud_analysis: dict,
+        return_data: dict = None
+    ) -> dict:
+        """
+        The compiled policy rules decide most returns locally; Gemini is only
+        asked for the outcome when they leave the case undecided.
+        """
+        decision = self.policy.evaluate(return_data, defect_analysis, fraud_analysis)
+        if decision is not None:
+            return await self._rule_outcome(decision, defect_analysis)
+
+        prompt = (
+            PromptBuilder(settings.PROMPT_TOKEN_BUDGET)
+            .add_text(DECISION_CRITERIA)
+            .add_payload("Return Policy Rules", self.return_policy_rules, priority=3)
+            .add_payload("Defect Analysis", defect_analysis, DEFECT_FIELDS, priority=2)
+            .add_payload("Fraud Analysis", fraud_analysis, FRAUD_FIELDS, priority=1)
+            .add_text(DECISION_RESPONSE_FORMAT)
+            .build()
+        )
+
+        result = await self.gemini.analyze_content(prompt, prompt_name="decision.outcome")
+        if isinstance(result, str):
+            result = json.loads(result)
+        if isinstance(result, dict):
+            result['decided_by'] = 'llm'
+        return result  # If already a dictionary/list, return as is
+
+    async def _rule_outcome(self, decision, defect_analysis: dict) -> dict:
+        result = {
+            'final_outcome': decision.outcome,
+            'decided_by': 'rules',
+            'matched_rule': decision.rule,
+        }
+        if decision.outcome == "Pending":
+            result['pending_reason'] = decision.reason
+        elif decision.outcome == "Deny":
+            result['denial_reason'] = decision.reason
+        if settings.POLICY_LLM_DESCRIPTIONS:
+            result['product_description'] = await self.describe_product(defect_analysis)
+        else:
+            result['product_description'] = describe_product_locally(defect_analysis)
+        return result
+
+    async def describe_product(self, defect_analysis: dict) -> str:
+        prompt = (
+            PromptBuilder(settings.PROMPT_TOKEN_BUDGET)
+            .add_text(DESCRIPTION_PROMPT)
+            .add_payload("Defect Analysis", defect_analysis, DEFECT_FIELDS, priority=1)
+            .add_text(DESCRIPTION_RESPONSE_FORMAT)
+            .build()
+        )
+        result = await self.gemini.analyze_content(prompt, prompt_name="decision.description")
+        if isinstance(result, str):
+            result = json.loads(result)
+        if isinstance(result, dict) and result.get('product_description'):
+            return result['product_description']
+        return describe_product_locally(defect_analysis)
 
-    async def determine_final_outcome(self, defect_analysis: dict, fraud_analysis: dict) -> dict:
-        prompt = f"""
+
+def describe_product_locally(defect_analysis: dict) -> str:
+    """A plain summary of the item's condition and defects from the defect analysis"""
+    if not isinstance(defect_analysis, dict):
+        return ""
+    category = defect_analysis.get('product_category') or "Item"
+    grade = defect_analysis.get('condition_grade') or "ungraded"
+    parts = [f"{category} in {grade} condition."]
+    defects = defect_analysis.get('defects') or []
+    parts.append(f"Defects: {', '.join(map(str, defects))}." if defects else "No defects found.")
+    details = defect_analysis.get('condition_details') or []
+    if details:
+        parts.extend(str(detail)[:1].upper() + str(detail)[1:].rstrip('.') + "." for detail in details)
+    return " ".join(parts)
+
+
+DECISION_CRITERIA = compact_text("""
         Evaluate the return request based on the customized return policy rules, defect analysis, and fraud analysis.
 
         Decision Criteria:
@@ -19,24 +118,28 @@ class ReturnDecisionService:
         6. Compost - If the item is made of biodegradable material and cannot be reused, recommend composting.
         7. Dispose - If the item has no viable reuse, refurbishment, or recycling potential, recommend disposal as a last resort.
         8. Pending (Manual Review) - If fraud is suspected or the item's condition is unclear, flag for manual review.
+        """)
 
-        Return Policy Rules: {json.dumps(self.return_policy_rules)}
-        Defect Analysis: {json.dumps(defect_analysis)}
-        Fraud Analysis: {json.dumps(fraud_analysis)}
-
+DECISION_RESPONSE_FORMAT = compact_text("""
         Expected JSON Response Format:
-        {{
+        {
             "final_outcome": "Resell|Refurbish|Donate|Recycle|Repurpose|Compost|Dispose|Pending",
-            "resale_details": {{"platform": "platform_name", "price": float}} if applicable,
-            "refurbish_details": {{"condition": "condition_description", "cost": float}} if applicable,
-            "donation_details": {{"organization": "charity_name"}} if applicable,
-            "recycle_details": {{"facility": "recycling_center"}} if applicable,
+            "resale_details": {"platform": "platform_name", "price": float} if applicable,
+            "refurbish_details": {"condition": "condition_description", "cost": float} if applicable,
+            "donation_details": {"organization": "charity_name"} if applicable,
+            "recycle_details": {"facility": "recycling_center"} if applicable,
             "pending_reason": "Flagged for manual review due to suspected fraud or unclear condition" if applicable,
             "product_description": "Detailed summary of the item's condition and defects."
-        }}
-        """
-        
-        result = await self.gemini.analyze_content(prompt)
-        if isinstance(result, str):
-            return json.loads(result)
-        return result  # If already a dictionary/list, return as is
+        }
+        """)
+
+DESCRIPTION_PROMPT = compact_text("""
+        Write a short, factual resale listing description of the returned item's condition and defects from the defect analysis.
+        """)
+
+DESCRIPTION_RESPONSE_FORMAT = compact_text("""
+        Expected JSON Response Format:
+        {
+            "product_description": "Detailed summary of the item's condition and defects."
+        }
+        """)
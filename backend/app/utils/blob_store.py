@@ -0,0 +1,141 @@
+"""
+Content-addressed photo storage on local disk.
+
+A blob lives at <root>/<first two hex digits>/<sha256>. Writes go to a
+temporary file under <root>/tmp while the SHA-256 is computed over the same
+chunks, then are renamed into place, so identical photos are stored once and
+a blob is never visible half-written. Return documents and queued jobs only
+hold references: {"sha256", "size", "content_type"} for an upload, plus
+"width"/"height" for a processed photo.
+"""
+import asyncio
+import hashlib
+import mmap
+import os
+import re
+import tempfile
+from typing import AsyncIterator, BinaryIO, Optional
+
+CHUNK_SIZE = 1024 * 1024
+SHA256_HEX = re.compile(r"[0-9a-f]{64}")
+
+
+class BlobTooLarge(ValueError):
+    pass
+
+
+def blob_path(root: str, sha256: str) -> str:
+    return os.path.join(root, sha256[:2], sha256)
+
+
+def is_blob_ref(value) -> bool:
+    # Checked before a client-supplied reference is turned into a path
+    return isinstance(value, dict) and isinstance(value.get('sha256'), str) and bool(SHA256_HEX.fullmatch(value['sha256']))
+
+
+class BlobWriter:
+    """One blob being written chunk by chunk; commit() moves it into place"""
+
+    def __init__(self, root: str, max_bytes: Optional[int] = None):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.digest = hashlib.sha256()
+        self.size = 0
+        fd, self.temp_path = tempfile.mkstemp(dir=os.path.join(root, "tmp"))
+        self.file = os.fdopen(fd, "wb")
+
+    def write(self, chunk: bytes) -> None:
+        self.size += len(chunk)
+        if self.max_bytes and self.size > self.max_bytes:
+            self.abort()
+            raise BlobTooLarge(f"Upload exceeds {self.max_bytes} bytes")
+        self.digest.update(chunk)
+        self.file.write(chunk)
+
+    def commit(self, content_type: Optional[str] = None) -> dict:
+        self.file.close()
+        sha256 = self.digest.hexdigest()
+        path = blob_path(self.root, sha256)
+        if os.path.exists(path):
+            os.remove(self.temp_path)  # already stored
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(self.temp_path, path)
+        ref = {'sha256': sha256, 'size': self.size}
+        if content_type:
+            ref['content_type'] = content_type
+        return ref
+
+    def abort(self) -> None:
+        if not self.file.closed:
+            self.file.close()
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+
+def write_blob(root: str, data: bytes, content_type: Optional[str] = None) -> dict:
+    """Store bytes already in memory (e.g. a processed photo inside a worker process)"""
+    writer = BlobWriter(root)
+    try:
+        writer.write(data)
+        return writer.commit(content_type)
+    except BaseException:
+        writer.abort()
+        raise
+
+
+def open_blob(root: str, sha256: str) -> mmap.mmap:
+    """A read-only memory map of the blob; it is file-like, so PIL can open it directly"""
+    with open(blob_path(root, sha256), "rb") as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class BlobStore:
+    """Async front for the local content-addressed store"""
+
+    def __init__(self, root: str, max_bytes: Optional[int] = None, chunk_size: int = CHUNK_SIZE):
+        self.root = os.path.abspath(root)
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        os.makedirs(os.path.join(self.root, "tmp"), exist_ok=True)
+
+    def path(self, sha256: str) -> str:
+        return blob_path(self.root, sha256)
+
+    def exists(self, sha256: str) -> bool:
+        return os.path.exists(self.path(sha256))
+
+    def open(self, sha256: str) -> mmap.mmap:
+        return open_blob(self.root, sha256)
+
+    def read(self, sha256: str) -> bytes:
+        with open(self.path(sha256), "rb") as f:
+            return f.read()
+
+    async def put_stream(self, chunks: AsyncIterator[bytes], content_type: Optional[str] = None) -> dict:
+        """Store a request body as it arrives, hashing each chunk on the way to disk"""
+        writer = BlobWriter(self.root, self.max_bytes)
+        try:
+            async for chunk in chunks:
+                if chunk:
+                    await asyncio.to_thread(writer.write, chunk)
+            return await asyncio.to_thread(writer.commit, content_type)
+        except BaseException:
+            writer.abort()
+            raise
+
+    def put_file(self, source: BinaryIO, content_type: Optional[str] = None) -> dict:
+        """Copy an already spooled upload in chunks (blocking; run it off the event loop)"""
+        writer = BlobWriter(self.root, self.max_bytes)
+        try:
+            for chunk in iter(lambda: source.read(self.chunk_size), b""):
+                writer.write(chunk)
+            return writer.commit(content_type)
+        except BaseException:
+            writer.abort()
+            raise
+
+    def put_bytes(self, data: bytes, content_type: Optional[str] = None) -> dict:
+        if self.max_bytes and len(data) > self.max_bytes:
+            raise BlobTooLarge(f"Upload exceeds {self.max_bytes} bytes")
+        return write_blob(self.root, data, content_type)
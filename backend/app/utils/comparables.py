@@ -0,0 +1,203 @@
+"""
+Past resale outcomes as an in-memory column store, for pricing by comparables.
+
+Each sale is one row: category, condition grade, original price, sale price
+and days to sell. A lookup masks the rows with the item's grade (and
+category), picks the k sales with the closest original price on a log scale
+and takes medians, all as vectorized NumPy over the columns.
+"""
+import json
+import math
+import os
+import threading
+from typing import Dict, Iterable, Iterator, Optional
+import numpy as np
+
+GRADES = {"Like New": 1, "Used - Good": 2, "Salvage": 3}
+
+
+def _median(values: np.ndarray) -> float:
+    # k is small; sorting a list beats np.median's overhead
+    if not values.size:
+        return 0.0
+    values = sorted(values.tolist())
+    middle = len(values) // 2
+    return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2
+
+
+def _segment(category_code: int, grade_code: int) -> int:
+    return category_code * 4 + grade_code
+
+
+def append_record(path: str, record: dict) -> None:
+    """
+    Append one sale to a JSON lines log. Each record is a single short
+    write in append mode, so several workers can share the log.
+    """
+    with open(path, "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+
+def read_records(path: str) -> Iterator[dict]:
+    """Sale records from a JSON lines log; a line torn by a crash mid-append is skipped"""
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                print(f"Skipping unreadable sale record in {path}")
+
+
+class ComparablesIndex:
+    """
+    Growable columns of resale outcomes. Categories are interned to integer
+    codes (case-insensitive); rows with an unknown grade or a non-positive
+    price are skipped.
+    """
+
+    def __init__(self, capacity: int = 1024):
+        self._category = np.zeros(capacity, dtype=np.int32)
+        self._grade = np.zeros(capacity, dtype=np.int8)
+        self._segment = np.zeros(capacity, dtype=np.int32)  # category and grade in one column
+        self._log_price = np.zeros(capacity, dtype=np.float64)
+        self._recovery = np.zeros(capacity, dtype=np.float64)  # sale price / original price
+        self._days = np.zeros(capacity, dtype=np.float32)
+        self.size = 0
+        self.categories: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return self.size
+
+    def _grow(self) -> None:
+        capacity = len(self._category) * 2
+        self._category = np.resize(self._category, capacity)
+        self._grade = np.resize(self._grade, capacity)
+        self._segment = np.resize(self._segment, capacity)
+        self._log_price = np.resize(self._log_price, capacity)
+        self._recovery = np.resize(self._recovery, capacity)
+        self._days = np.resize(self._days, capacity)
+
+    def _category_code(self, category: str) -> int:
+        key = str(category or "").strip().lower()
+        code = self.categories.get(key)
+        if code is None:
+            code = self.categories[key] = len(self.categories)
+        return code
+
+    def add(self, category: str, grade: str, original_price: float, sale_price: float, days_to_sell: float) -> bool:
+        """Record one sale; returns False when the row cannot be used"""
+        grade_code = GRADES.get(grade)
+        try:
+            original_price, sale_price = float(original_price), float(sale_price)
+            days_to_sell = float(days_to_sell or 0)
+        except (TypeError, ValueError):
+            return False
+        if grade_code is None or original_price <= 0 or sale_price < 0:
+            return False
+        with self._lock:
+            if self.size == len(self._category):
+                self._grow()
+            row = self.size
+            self._category[row] = self._category_code(category)
+            self._grade[row] = grade_code
+            self._segment[row] = _segment(self._category[row], grade_code)
+            self._log_price[row] = math.log(original_price)
+            self._recovery[row] = sale_price / original_price
+            self._days[row] = max(days_to_sell, 0.0)
+            self.size += 1
+        return True
+
+    def extend(self, records: Iterable[dict]) -> int:
+        added = 0
+        for record in records:
+            added += self.add(
+                record.get('category'),
+                record.get('grade'),
+                record.get('original_price'),
+                record.get('sale_price'),
+                record.get('days_to_sell')
+            )
+        return added
+
+    def save(self, path: str) -> None:
+        """
+        Write a .npz snapshot that load() reads back without re-parsing
+        records. It is written aside and renamed into place, so a reader
+        never sees a partial file.
+        """
+        temporary = f"{path[:-4] if path.endswith('.npz') else path}.{os.getpid()}.tmp.npz"
+        with self._lock:
+            size = self.size
+            categories = sorted(self.categories, key=self.categories.get)
+            np.savez(
+                temporary,
+                category=self._category[:size],
+                grade=self._grade[:size],
+                log_price=self._log_price[:size],
+                recovery=self._recovery[:size],
+                days=self._days[:size],
+                categories=np.array(categories, dtype=str)
+            )
+        os.replace(temporary, path)
+
+    @classmethod
+    def load(cls, path: str) -> "ComparablesIndex":
+        """A .npz snapshot, a JSON list of sale records or JSON lines of them"""
+        if path.endswith(".npz"):
+            with np.load(path) as snapshot:
+                index = cls(max(len(snapshot['category']), 1024))
+                size = len(snapshot['category'])
+                index._category[:size] = snapshot['category']
+                index._grade[:size] = snapshot['grade']
+                index._segment[:size] = _segment(index._category[:size], index._grade[:size].astype(np.int32))
+                index._log_price[:size] = snapshot['log_price']
+                index._recovery[:size] = snapshot['recovery']
+                index._days[:size] = snapshot['days']
+                index.categories = {str(name): code for code, name in enumerate(snapshot['categories'])}
+                index.size = size
+            return index
+        index = cls()
+        if path.endswith(".jsonl"):
+            index.extend(read_records(path))
+            return index
+        with open(path) as f:
+            index.extend(json.load(f))
+        return index
+
+    def query(self, category: str, grade: str, original_price: float, k: int) -> Optional[dict]:
+        """
+        Medians over the k nearest-priced sales of the same grade, overall and
+        within the category. None when the grade or price is unusable.
+        """
+        grade_code = GRADES.get(grade)
+        if grade_code is None or not original_price or original_price <= 0:
+            return None
+        with self._lock:
+            size = self.size
+            category_code = self.categories.get(str(category or "").strip().lower(), -1)
+            segments = self._segment[:size]
+            grades = self._grade[:size]
+            log_prices = self._log_price[:size]
+            recovery = self._recovery[:size]
+            days = self._days[:size]
+        log_price = math.log(original_price)
+
+        def nearest(rows: np.ndarray) -> np.ndarray:
+            if rows.size > k:
+                distance = np.abs(log_prices[rows] - log_price)
+                rows = rows[np.argpartition(distance, k - 1)[:k]]
+            return rows
+
+        grade_rows = nearest(np.flatnonzero(grades == grade_code))
+        category_rows = nearest(np.flatnonzero(segments == _segment(category_code, grade_code)))
+        return {
+            'grade_comparables': int(grade_rows.size),
+            'grade_recovery': _median(recovery[grade_rows]),
+            'grade_days_to_sell': _median(days[grade_rows]),
+            'category_comparables': int(category_rows.size),
+            'category_recovery': _median(recovery[category_rows]),
+            'category_days_to_sell': _median(days[category_rows]),
+        }
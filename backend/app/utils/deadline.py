@@ -0,0 +1,45 @@
+"""
+Per-request time budgets.
+
+A request sets a Deadline once; every task spawned for it inherits the
+context variable, so model calls, admission waits and retries all shrink
+to whatever budget is left instead of each using its own full timeout.
+"""
+import time
+from contextvars import ContextVar
+from typing import Optional
+
+
+class Deadline:
+    """An absolute expiry on the monotonic clock"""
+
+    def __init__(self, seconds: float):
+        self.budget = seconds
+        self.expires_at = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    @property
+    def expired(self) -> bool:
+        return time.monotonic() >= self.expires_at
+
+    def elapsed_ms(self) -> float:
+        return round((self.budget - (self.expires_at - time.monotonic())) * 1000, 2)
+
+
+request_deadline: ContextVar[Optional[Deadline]] = ContextVar('request_deadline', default=None)
+
+
+def capped_timeout(timeout: Optional[float]) -> Optional[float]:
+    """timeout, shortened to the current request's remaining budget"""
+    deadline = request_deadline.get()
+    if deadline is None:
+        return timeout
+    remaining = deadline.remaining()
+    return remaining if timeout is None else min(timeout, remaining)
+
+
+def budget_exhausted() -> bool:
+    deadline = request_deadline.get()
+    return deadline is not None and deadline.expired
@@ -1,37 +1,358 @@
-import firebase_admin
-from firebase_admin import credentials, firestore
+import asyncio
+import hashlib
+import json
+import random
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from typing import List, Optional, Tuple
 from dotenv import load_dotenv
-import os
+from ..config import settings
+from .image_hashing import ImageHashIndex
+from .persistence import ReturnStore, WriteBehindBuffer, Write, apply_field_update, create_store
+from .metrics import observe_stage, persistence_commit_duration, persistence_commit_writes
+from .response_cache import LRUCache
+from .return_analytics import (
+    ANALYTICS_FIELDS,
+    analytics_record,
+    combine_shards,
+    merge_rollup,
+    new_rollup,
+    record_delta,
+)
+from .return_history import (
+    apply_return,
+    apply_status_update,
+    exclude_return,
+    new_aggregate,
+    slim_return_record,
+    summarize_aggregate,
+)
+from .tracing import span
 
 load_dotenv()
 
 class FirebaseClient:
-    def __init__(self):
-        if not firebase_admin._apps:
-            firebase_credentials = os.getenv("FIREBASE_CREDENTIALS")
-            if not firebase_credentials:
-                raise Exception("FIREBASE_CREDENTIALS environment variable not set")
-            cred = credentials.Certificate(firebase_credentials)
-            firebase_admin.initialize_app(cred)
-        self.db = firestore.client()
-
-    async def save_return_request(self, return_data: dict) -> str:
-        """Save return request to Firestore"""
-        doc_ref = self.db.collection('returns').document()
+    """
+    Async facade over a ReturnStore (Firestore by default). Blocking store
+    calls run on a dedicated thread pool, and with write-behind enabled,
+    save_return_request/update_return_status are buffered and committed in
+    batches by a WriteBehindBuffer. Reads of a return with buffered writes
+    flush first, so callers always read their own writes. Each committed
+    batch also updates the per-user aggregates and the analytics rollups.
+    """
+
+    def __init__(self, store: ReturnStore = None, write_behind: bool = None):
+        self.store = store or create_store(
+            settings.PERSISTENCE_BACKEND, settings.PERSISTENCE_SQLITE_PATH
+        )
+        self.recent_limit = settings.USER_HISTORY_RECENT_RETURNS
+        self._executor = ThreadPoolExecutor(
+            max_workers=settings.PERSISTENCE_THREADS, thread_name_prefix="persistence"
+        )
+        if write_behind is None:
+            write_behind = settings.WRITE_BEHIND_ENABLED
+        self.write_buffer = WriteBehindBuffer(
+            self._commit,
+            flush_size=settings.WRITE_BEHIND_FLUSH_SIZE,
+            flush_interval=settings.WRITE_BEHIND_FLUSH_INTERVAL,
+            max_attempts=settings.WRITE_BEHIND_MAX_ATTEMPTS
+        ) if write_behind else None
+        # Read-through cache for get_return: return_id -> (document, etag)
+        self.return_cache = LRUCache(
+            settings.RETURN_CACHE_MAX_ENTRIES, settings.RETURN_CACHE_TTL_SECONDS
+        )
+        self.return_cache_hits = 0
+        self.return_cache_misses = 0
+        # Near-duplicate photo index, loaded from the store once and then kept
+        # current by this process's saves
+        self.image_index = ImageHashIndex()
+        self._image_index_loaded = None
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    async def _commit(self, writes: List[Write]) -> None:
+        # Read before committing: the delta needs each updated return's prior state
+        analytics_delta = await self._run(self._analytics_delta, writes)
+        with persistence_commit_duration.time(), span("persistence.commit", writes=len(writes)):
+            await self._run(self.store.commit, writes)
+        persistence_commit_writes.inc(len(writes))
+        # Drop anything cached while the writes were in flight
+        for _, return_id, _ in writes:
+            self.return_cache.invalidate(return_id)
+        # The returns are committed now: failures below must not raise, or
+        # the write-behind buffer would commit (and count) the batch again
+        try:
+            await self._run(self._apply_aggregates, writes)
+        except Exception as e:
+            print(f"Error updating user aggregates for {len(writes)} writes: {str(e)}")
+        if analytics_delta is not None:
+            await self._run(self._apply_analytics, analytics_delta)
+
+    async def _write(self, op: str, return_id: str, data: dict) -> None:
+        self.return_cache.invalidate(return_id)
+        if self.write_buffer is not None:
+            await self.write_buffer.add(op, return_id, data)
+        else:
+            await self._commit([(op, return_id, data)])
+
+    def _update_aggregate(self, user_id: str, apply) -> dict:
+        """Read-modify-write the user's aggregate atomically"""
+        return self.store.update_aggregate(
+            user_id, lambda aggregate: apply(aggregate or new_aggregate(user_id))
+        )
+
+    def _apply_aggregates(self, writes: List[Write]) -> None:
+        """Fold committed writes into the per-user aggregates, one update per user"""
+        changes_by_user = {}
+        for op, return_id, data in writes:
+            if op == 'set':
+                user_id = data.get('user_id')
+                change = ('return', slim_return_record(return_id, data))
+            elif 'status' in data or 'fraud_analysis' in data:
+                # Progress-only updates (e.g. per-stage status) never change the user aggregate
+                document = self.store.get_return(return_id) or {}
+                user_id = document.get('user_id')
+                change = ('status', (return_id, data))
+            else:
+                continue
+            if user_id:
+                changes_by_user.setdefault(user_id, []).append(change)
+
+        for user_id, changes in changes_by_user.items():
+            def apply_all(aggregate, changes=changes):
+                for kind, change in changes:
+                    if kind == 'return':
+                        apply_return(aggregate, change, self.recent_limit)
+                    else:
+                        apply_status_update(aggregate, change[0], change[1], self.recent_limit)
+                return aggregate
+            self._update_aggregate(user_id, apply_all)
+
+    def _analytics_delta(self, writes: List[Write]):
+        """
+        The change these writes make to the analytics rollups, or None. Only
+        updates touching an analytics field read the stored document, and
+        only those fields are carried through the rest of the batch.
+        """
+        delta = new_rollup()
+        changed = False
+        documents = {}
+        for op, return_id, data in writes:
+            if op == 'set':
+                old = None
+                document = {field: data[field] for field in ANALYTICS_FIELDS if field in data}
+            else:
+                update = {path: value for path, value in data.items() if path.split('.')[0] in ANALYTICS_FIELDS}
+                if not update:
+                    continue
+                document = documents.get(return_id)
+                if document is None:
+                    stored = self.store.get_return(return_id)
+                    if stored is None:
+                        continue
+                    document = {field: stored[field] for field in ANALYTICS_FIELDS if field in stored}
+                old = analytics_record(document)
+                document = apply_field_update(json.loads(json.dumps(document, default=str)), update)
+            documents[return_id] = document
+            changed = record_delta(delta, old, analytics_record(document)) or changed
+        return delta if changed else None
+
+    def _apply_analytics(self, delta: dict) -> None:
+        # Any shard will do (only the sum is read), so writers spread across them
+        shard = random.randrange(max(1, settings.ANALYTICS_SHARDS))
+        try:
+            self.store.update_analytics_shard(
+                shard, lambda rollup: merge_rollup(rollup or new_rollup(), delta, settings.ANALYTICS_RETENTION_DAYS)
+            )
+        except Exception as e:
+            # The returns themselves are committed; a rebuild repairs the rollups
+            print(f"Error updating return analytics: {str(e)}")
+
+    def rebuild_analytics(self) -> dict:
+        """
+        Recompute the rollups from the raw returns collection (backfill, or
+        repair after drift). Writes committed while the scan runs may be
+        missed, so run it when traffic is quiet.
+        """
+        rollup = new_rollup()
+        for _, document in self.store.scan_returns(ANALYTICS_FIELDS):
+            record_delta(rollup, None, analytics_record(document))
+        rollup = merge_rollup(new_rollup(), rollup, settings.ANALYTICS_RETENTION_DAYS)
+        self.store.replace_analytics(rollup)
+        return rollup
+
+    async def get_analytics(self) -> dict:
+        """The analytics rollups summed over every shard; the first call backfills them"""
+        shards = await self._run(self.store.get_analytics_shards)
+        if not shards:
+            return await self._run(self.rebuild_analytics)
+        return combine_shards(shards, settings.ANALYTICS_RETENTION_DAYS)
+
+    async def save_return_request(self, return_data: dict, durable: bool = False) -> str:
+        """
+        Save return request to Firestore. durable=True commits before
+        returning instead of going through the write-behind buffer, for a
+        return another process is about to read or update.
+        """
+        return_id = self.store.new_return_id()
         return_data['timestamp'] = datetime.now()
-        doc_ref.set(return_data)
-        return doc_ref.id
+        with observe_stage("firestore_save"), span("stage.firestore_save"):
+            if durable:
+                # A new id has no buffered writes it could overtake
+                self.return_cache.invalidate(return_id)
+                await self._commit([('set', return_id, return_data)])
+            else:
+                await self._write('set', return_id, return_data)
+        self.index_return_images(return_id, return_data)
+        return return_id
+
+    def index_return_images(self, return_id: str, return_data: dict) -> None:
+        if return_data.get('image_hashes'):
+            self.image_index.add(return_id, return_data.get('user_id'), return_data['image_hashes'])
+
+    def _load_image_index(self) -> int:
+        for return_id, user_id, hashes in self.store.image_hash_records():
+            self.image_index.add(return_id, user_id, hashes)
+        return len(self.image_index)
+
+    async def load_image_index(self) -> None:
+        """Load every stored photo hash into the index (once; concurrent callers share the load)"""
+        if self._image_index_loaded is None:
+            self._image_index_loaded = asyncio.ensure_future(self._run(self._load_image_index))
+        try:
+            await asyncio.shield(self._image_index_loaded)
+        except Exception as e:
+            print(f"Error loading image hash index: {str(e)}")
+            self._image_index_loaded = None
 
-    async def get_user_history(self, user_id: str) -> dict:
-        """Retrieve user's return history"""
-        returns = self.db.collection('returns').where('user_id', '==', user_id).stream()
+    async def find_similar_images(
+        self,
+        image_hashes: list,
+        max_distance: int = None,
+        exclude_return_id: str = None
+    ) -> list:
+        """Earlier returns with near-duplicate photos, closest first"""
+        if not image_hashes:
+            return []
+        await self.load_image_index()
+        if max_distance is None:
+            max_distance = settings.IMAGE_MATCH_MAX_DISTANCE
+        with span("image_index.query", indexed=len(self.image_index)):
+            return self.image_index.query(image_hashes, max_distance, exclude_return_id)
+
+    def batch_writer(self, batch_size: int = None) -> "ReturnBatchWriter":
+        """Buffer many return documents and commit them as Firestore batched writes"""
+        return ReturnBatchWriter(self, batch_size or settings.BATCH_WRITE_SIZE)
+
+    async def get_user_history(self, user_id: str, exclude_return_id: Optional[str] = None) -> dict:
+        """
+        Retrieve user's return history as a compact aggregate (one document
+        read). exclude_return_id leaves out a return that is already saved,
+        so it is not counted in its own history.
+        """
+        aggregate = await self._run(self.store.get_aggregate, user_id)
+        if aggregate is None:
+            aggregate = await self._run(self.rebuild_user_aggregate, user_id)
+        if exclude_return_id is not None:
+            aggregate = exclude_return(aggregate, exclude_return_id)
+        return summarize_aggregate(aggregate)
+
+    def rebuild_user_aggregate(self, user_id: str) -> dict:
+        """Backfill the aggregate from the raw returns collection (one-off per user)"""
+        records = [
+            slim_return_record(return_id, document)
+            for return_id, document in self.store.returns_for_user(user_id)
+        ]
+        records.sort(key=lambda record: record['date'])
+        aggregate = new_aggregate(user_id)
+        for record in records:
+            apply_return(aggregate, record, self.recent_limit)
+        self.store.set_aggregate(user_id, aggregate)
+        return aggregate
+
+    async def get_return(self, return_id: str) -> dict:
+        """Fetch one return request by id"""
+        document, _ = await self.get_return_with_etag(return_id)
+        return document
+
+    async def get_return_with_etag(self, return_id: str) -> Tuple[dict, str]:
+        """
+        Read-through lookup returning (document, etag). Entries are invalidated
+        by this process's writes and expire after RETURN_CACHE_TTL_SECONDS,
+        which bounds staleness from writes made by other workers.
+        """
+        cached = self.return_cache.get(return_id)
+        if cached is not None:
+            self.return_cache_hits += 1
+            document, etag = cached
+            return dict(document), etag
+
+        self.return_cache_misses += 1
+        if self.write_buffer is not None and self.write_buffer.has_pending(return_id):
+            await self.write_buffer.flush()
+        document = await self._run(self.store.get_return, return_id)
+        if document is None:
+            raise KeyError(return_id)
+        document = {'return_id': return_id, **document}
+        serialized = json.dumps(document, sort_keys=True, default=str).encode()
+        etag = '"' + hashlib.sha1(serialized).hexdigest() + '"'
+        self.return_cache.set(return_id, (document, etag))
+        return dict(document), etag
+
+    def return_cache_stats(self) -> dict:
+        lookups = self.return_cache_hits + self.return_cache_misses
         return {
-            'user_id': user_id,
-            'returns': [doc.to_dict() for doc in returns]
+            'entries': len(self.return_cache),
+            'hits': self.return_cache_hits,
+            'misses': self.return_cache_misses,
+            'evictions': self.return_cache.evictions,
+            'hit_rate': round(self.return_cache_hits / lookups, 4) if lookups else 0.0,
         }
 
     async def update_return_status(self, return_id: str, status_update: dict) -> None:
         """Update return request status"""
-        doc_ref = self.db.collection('returns').document(return_id)
-        doc_ref.update(status_update)
\ No newline at end of file
+        await self._write('update', return_id, status_update)
+
+    async def flush(self) -> None:
+        """Commit any buffered writes now"""
+        if self.write_buffer is not None:
+            await self.write_buffer.flush()
+
+    async def close(self) -> None:
+        """Flush buffered writes durably and release the store's threads"""
+        await self.flush()
+        self._executor.shutdown(wait=True)
+
+
+class ReturnBatchWriter:
+    """
+    Collects return documents and commits them in batched writes of up to
+    batch_size documents (Firestore caps a batch at 500 writes). Document ids
+    are allocated client side, so callers get a return_id immediately.
+    """
+
+    def __init__(self, client: FirebaseClient, batch_size: int):
+        self.client = client
+        self.batch_size = min(batch_size, 500)
+        self.pending = []
+        self.committed = 0
+
+    async def add(self, return_data: dict) -> str:
+        return_id = self.client.store.new_return_id()
+        return_data['timestamp'] = datetime.now()
+        self.pending.append(('set', return_id, return_data))
+        self.client.index_return_images(return_id, return_data)
+        if len(self.pending) >= self.batch_size:
+            await self.flush()
+        return return_id
+
+    async def flush(self) -> int:
+        """Commit everything buffered so far; returns the number of documents written"""
+        if not self.pending:
+            return 0
+        pending, self.pending = self.pending, []
+        await self.client._commit(pending)
+        self.committed += len(pending)
+        return len(pending)
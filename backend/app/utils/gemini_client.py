@@ -1,60 +1,252 @@
 import os
 import json
-from typing import Union, List
-import google.generativeai as genai
+import asyncio
+import functools
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Union, List, Optional
 from PIL import Image
 from dotenv import load_dotenv
+from ..config import settings
+from ..dependencies import _shared, peek
+from .deadline import budget_exhausted, capped_timeout
+from .metrics import gemini_call_duration, gemini_calls, gemini_tokens
+from .model_scheduler import ModelCallScheduler
+from .prompt_builder import estimate_text_tokens, prompt_token_stats
+from .response_cache import ResponseCache, make_cache_key
+from .tracing import span
 
 load_dotenv()
 
+
+@functools.lru_cache(maxsize=None)
+def retryable_errors() -> tuple:
+    """Quota, transient server errors and timeouts are worth retrying with backoff"""
+    # Imported on first use; the Google SDKs take most of a cold start to import
+    from google.api_core import exceptions as api_exceptions
+    return (
+        api_exceptions.ResourceExhausted,
+        api_exceptions.TooManyRequests,
+        api_exceptions.InternalServerError,
+        api_exceptions.ServiceUnavailable,
+        api_exceptions.DeadlineExceeded,
+        asyncio.TimeoutError,
+    )
+
+# Gemini bills roughly 258 tokens per image at our preprocessed sizes
+IMAGE_TOKENS = 258
+EXPECTED_OUTPUT_TOKENS = 400
+
+
+def estimate_input_tokens(prompt: str, image_count: int = 0) -> int:
+    return estimate_text_tokens(prompt) + image_count * IMAGE_TOKENS
+
+
+def estimate_tokens(prompt: str, image_count: int = 0) -> int:
+    """Rough token count of a call (about 4 characters per token) for rate limiting"""
+    return estimate_input_tokens(prompt, image_count) + EXPECTED_OUTPUT_TOKENS
+
+
+def _usage_count(response, field: str) -> Optional[int]:
+    usage = getattr(response, "usage_metadata", None)
+    return getattr(usage, field, None) or None
+
+
+def _response_tokens(response) -> Optional[float]:
+    return _usage_count(response, "total_token_count")
+
+
 class GeminiClient:
-    def __init__(self):
+    def __init__(
+        self,
+        execution_mode: Optional[str] = None,
+        max_in_flight: Optional[int] = None,
+        timeout: Optional[float] = None,
+        cache: Optional[ResponseCache] = None,
+        scheduler: Optional[ModelCallScheduler] = None
+    ):
+        import google.generativeai as genai
+
         api_key = os.getenv("GOOGLE_API_KEY")
         if not api_key:
             raise Exception("GOOGLE_API_KEY environment variable not set")
         genai.configure(api_key=api_key)
-        self.model = genai.GenerativeModel('gemini-2.0-flash')
+        self.model_name = settings.MODEL_NAME
+        self.model = genai.GenerativeModel(self.model_name)
+
+        self.execution_mode = execution_mode or settings.GEMINI_EXECUTION_MODE
+        if self.execution_mode not in ("native", "thread"):
+            raise ValueError(f"Unknown Gemini execution mode: {self.execution_mode}")
+        self.max_in_flight = max_in_flight or settings.GEMINI_MAX_IN_FLIGHT
+        self.timeout = timeout if timeout is not None else settings.GEMINI_TIMEOUT_SECONDS
+        self._executor = None
+        if self.execution_mode == "thread":
+            self._executor = ThreadPoolExecutor(
+                max_workers=settings.GEMINI_THREAD_POOL_SIZE,
+                thread_name_prefix="gemini"
+            )
+        self.scheduler = scheduler or get_model_scheduler(self.max_in_flight)
+
+        self.cache = cache
+        if self.cache is None and settings.RESPONSE_CACHE_ENABLED:
+            self.cache = ResponseCache(
+                max_entries=settings.RESPONSE_CACHE_MAX_ENTRIES,
+                ttl_seconds=settings.RESPONSE_CACHE_TTL_SECONDS,
+                disk_path=settings.RESPONSE_CACHE_DISK_PATH or None
+            )
+
+    async def _generate(self, contents, temperature: float):
+        """Run one model call without blocking the event loop."""
+        generation_config = {"temperature": temperature}
+        if self.execution_mode == "native":
+            return await self.model.generate_content_async(
+                contents, generation_config=generation_config
+            )
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor,
+            functools.partial(
+                self.model.generate_content, contents, generation_config=generation_config
+            )
+        )
+
+    @staticmethod
+    def _parse_response(text: Optional[str]) -> Union[dict, str]:
+        if text is None:
+            return "{}"
+
+        # Clean the response by stripping any extraneous characters
+        cleaned_response = text.strip()
+
+        # Find the first occurrence of '{' and the last occurrence of '}'
+        start_index = cleaned_response.find('{')
+        end_index = cleaned_response.rfind('}')
+
+        # If both are found, extract the content between them
+        if start_index != -1 and end_index != -1:
+            cleaned_response = cleaned_response[start_index:end_index+1]
+        else:
+            print(f"Error: No valid JSON-like structure found in the response.")
+            return {}
+
+        # Attempt to parse the response text into a JSON object
+        try:
+            result_json = json.loads(cleaned_response)
+        except json.JSONDecodeError as e:
+            print(f"JSONDecodeError: Failed to decode. Response: {cleaned_response}")
+            return {}  # Return an empty dictionary if parsing fails
+
+        return result_json
 
     async def analyze_content(
-        self, 
-        prompt: str, 
-        image: Union[Image.Image, None] = None,
-        temperature: float = 0.7
+        self,
+        prompt: str,
+        image: Union[Image.Image, List[Image.Image], None] = None,
+        temperature: float = 0.7,
+        timeout: Optional[float] = None,
+        use_cache: bool = True,
+        prompt_name: str = "unnamed"
     ) -> dict:
+        """
+        prompt_name labels the call in prompt_token_stats, which tracks
+        estimated and billed tokens per endpoint and prompt. Raises
+        asyncio.TimeoutError once the request's deadline is exhausted; other
+        failures return "{}".
+        """
+        # A list of images is packed into the same multimodal request
+        images = image if isinstance(image, list) else ([image] if image else [])
+        estimated_input = estimate_input_tokens(prompt, len(images))
+
+        cache_key = None
+        if self.cache is not None and use_cache:
+            cache_key = make_cache_key(self.model_name, temperature, prompt, image)
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                prompt_token_stats.record(prompt_name, estimated_input, EXPECTED_OUTPUT_TOKENS, cached=True)
+                gemini_calls.inc(prompt=prompt_name, outcome="cache_hit")
+                return cached
+
+        if budget_exhausted():
+            # The request's deadline has passed; a call now could only be wasted
+            gemini_calls.inc(prompt=prompt_name, outcome="deadline")
+            raise asyncio.TimeoutError("the request deadline has passed")
+
+        contents = [prompt, *images] if images else prompt
+        timeout = self.timeout if timeout is None else timeout
+        started = time.perf_counter()
         try:
-            if image:
-                response = self.model.generate_content([prompt, image])
-            else:
-                response = self.model.generate_content(prompt)
-            
-            if response.text is None:
-                return "{}"
-            
-            # Clean the response by stripping any extraneous characters
-            cleaned_response = response.text.strip()
-
-            # Find the first occurrence of '{' and the last occurrence of '}'
-            start_index = cleaned_response.find('{')
-            end_index = cleaned_response.rfind('}')
-
-            # If both are found, extract the content between them
-            if start_index != -1 and end_index != -1:
-                cleaned_response = cleaned_response[start_index:end_index+1]
-            else:
-                print(f"Error: No valid JSON-like structure found in the response.")
-                return {}
-            
-            # Attempt to parse the response text into a JSON object
-            try:
-                result_json = json.loads(cleaned_response)
-            except json.JSONDecodeError as e:
-                print(f"JSONDecodeError: Failed to decode. Response: {cleaned_response}")
-                return {}  # Return an empty dictionary if parsing fails
-
-            return result_json
+            # The scheduler applies the QPM/TPM limits, priority lanes and
+            # retries; the timeout applies to each attempt, capped by what is
+            # left of the request's deadline
+            with span("gemini.call", prompt=prompt_name, images=len(images)):
+                response = await self.scheduler.run(
+                    lambda: asyncio.wait_for(self._generate(contents, temperature), timeout=capped_timeout(timeout)),
+                    estimated_tokens=estimate_tokens(prompt, len(images)),
+                    retryable=retryable_errors(),
+                    usage=_response_tokens
+                )
+            latency = time.perf_counter() - started
+            input_tokens = _usage_count(response, "prompt_token_count")
+            output_tokens = _usage_count(response, "candidates_token_count")
+            prompt_token_stats.record(
+                prompt_name,
+                estimated_input,
+                EXPECTED_OUTPUT_TOKENS,
+                input_tokens=input_tokens,
+                output_tokens=output_tokens,
+                latency=latency
+            )
+            gemini_calls.inc(prompt=prompt_name, outcome="ok")
+            gemini_call_duration.observe(latency, prompt=prompt_name)
+            gemini_tokens.inc(input_tokens or 0, prompt=prompt_name, direction="input")
+            gemini_tokens.inc(output_tokens or 0, prompt=prompt_name, direction="output")
+            result = self._parse_response(response.text)
+            # Only successful, non-empty parses are worth replaying
+            if cache_key is not None and isinstance(result, dict) and result:
+                self.cache.set(cache_key, result)
+            return result
+        except asyncio.TimeoutError:
+            gemini_calls.inc(prompt=prompt_name, outcome="timeout")
+            gemini_call_duration.observe(time.perf_counter() - started, prompt=prompt_name)
+            if budget_exhausted():
+                # Cut off by the request's deadline, not a failure of this call:
+                # the caller's stage reports it as timed out
+                raise
+            print(f"Error in Gemini analysis: call exceeded the {timeout}s timeout")
+            return "{}"
         except Exception as e:
+            gemini_calls.inc(prompt=prompt_name, outcome="error")
+            gemini_call_duration.observe(time.perf_counter() - started, prompt=prompt_name)
             print(f"Error in Gemini analysis: {str(e)}")
             return "{}"
 
     async def analyze_image(self, image, prompt):
-        return await self.analyze_content(prompt, image) 
\ No newline at end of file
+        return await self.analyze_content(prompt, image)
+
+    def close(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+        if self.cache is not None and self.cache.disk is not None:
+            self.cache.disk.close()
+
+
+def get_model_scheduler(max_in_flight: Optional[int] = None) -> ModelCallScheduler:
+    """Return the process-wide scheduler every model call goes through."""
+    return _shared('model_scheduler', lambda: ModelCallScheduler(
+        requests_per_minute=settings.GEMINI_REQUESTS_PER_MINUTE,
+        tokens_per_minute=settings.GEMINI_TOKENS_PER_MINUTE,
+        max_in_flight=max_in_flight or settings.GEMINI_MAX_IN_FLIGHT,
+        max_retries=settings.GEMINI_MAX_RETRIES,
+        base_delay=settings.GEMINI_RETRY_BASE_DELAY,
+        max_delay=settings.GEMINI_RETRY_MAX_DELAY
+    ))
+
+
+def peek_gemini_client() -> Optional[GeminiClient]:
+    """The shared client if it has been built, without building it"""
+    return peek('gemini_client')
+
+
+def get_gemini_client() -> GeminiClient:
+    """Return the process-wide GeminiClient shared by all services."""
+    return _shared('gemini_client', GeminiClient)
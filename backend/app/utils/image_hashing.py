@@ -0,0 +1,144 @@
+"""
+Perceptual image hashes and an in-memory near-duplicate index.
+
+Each photo gets a 64-bit pHash (low frequencies of a 32x32 DCT) and a 64-bit
+dHash (horizontal gradients of a 9x8 thumbnail), stored on the return as hex
+strings. Two photos are near-duplicates when both hashes are within a small
+Hamming distance, which survives re-encoding, resizing and light edits.
+"""
+import threading
+from typing import Iterable, List, Optional
+import numpy as np
+from PIL import Image
+
+PHASH_SIZE = 32
+PHASH_LOW_FREQ = 8
+
+
+def _dct_matrix(n: int) -> np.ndarray:
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    matrix = np.cos(np.pi * (2 * i + 1) * k / (2 * n)) * np.sqrt(2 / n)
+    matrix[0] /= np.sqrt(2)
+    return matrix
+
+
+DCT_MATRIX = _dct_matrix(PHASH_SIZE)
+
+
+def _bits_to_hex(bits: np.ndarray) -> str:
+    return np.packbits(bits.astype(np.uint8).ravel()).tobytes().hex()
+
+
+def _grayscale_thumbnail(image: Image.Image) -> Image.Image:
+    # A 64x64 grey copy is plenty for both hashes; shrinking first (with a
+    # box-reduce pass) keeps hashing well under a millisecond per photo
+    size = (2 * PHASH_SIZE, 2 * PHASH_SIZE)
+    return image.resize(size, Image.BILINEAR, reducing_gap=1.0).convert("L")
+
+
+def phash(image: Image.Image) -> str:
+    pixels = np.asarray(image.resize((PHASH_SIZE, PHASH_SIZE), Image.LANCZOS), dtype=np.float64)
+    low = (DCT_MATRIX @ pixels @ DCT_MATRIX.T)[:PHASH_LOW_FREQ, :PHASH_LOW_FREQ]
+    # The DC term only encodes overall brightness; leave it out of the median
+    return _bits_to_hex(low > np.median(low.ravel()[1:]))
+
+
+def dhash(image: Image.Image) -> str:
+    pixels = np.asarray(image.resize((9, 8), Image.LANCZOS), dtype=np.int16)
+    return _bits_to_hex(pixels[:, 1:] > pixels[:, :-1])
+
+
+def image_hashes(image: Image.Image) -> dict:
+    thumbnail = _grayscale_thumbnail(image)
+    return {'phash': phash(thumbnail), 'dhash': dhash(thumbnail)}
+
+
+if hasattr(np, 'bitwise_count'):
+    def _popcount(values: np.ndarray) -> np.ndarray:
+        return np.bitwise_count(values)
+else:
+    _POPCOUNT8 = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+    def _popcount(values: np.ndarray) -> np.ndarray:
+        return _POPCOUNT8[values.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+
+class ImageHashIndex:
+    """
+    Hashes of every indexed photo in two growable uint64 columns. A query is
+    an XOR plus popcount over the whole column, so a few hundred thousand
+    photos are searched in well under a millisecond without any tree.
+    """
+
+    def __init__(self, capacity: int = 1024):
+        self._phash = np.zeros(capacity, dtype=np.uint64)
+        self._dhash = np.zeros(capacity, dtype=np.uint64)
+        self.size = 0
+        # Row -> (return_id, user_id, image position within that return)
+        self.rows: List[tuple] = []
+        self.return_ids = set()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return self.size
+
+    def _grow(self) -> None:
+        capacity = len(self._phash) * 2
+        self._phash = np.resize(self._phash, capacity)
+        self._dhash = np.resize(self._dhash, capacity)
+
+    def add(self, return_id: str, user_id: Optional[str], hashes: Iterable[dict]) -> None:
+        """Index a return's photos; a return already in the index is skipped"""
+        with self._lock:
+            if return_id in self.return_ids:
+                return
+            self.return_ids.add(return_id)
+            for position, image_hash in enumerate(hashes or []):
+                if not image_hash:
+                    continue
+                if self.size == len(self._phash):
+                    self._grow()
+                self._phash[self.size] = int(image_hash['phash'], 16)
+                self._dhash[self.size] = int(image_hash['dhash'], 16)
+                self.rows.append((return_id, user_id, position))
+                self.size += 1
+
+    def query(
+        self,
+        hashes: List[dict],
+        max_distance: int,
+        exclude_return_id: Optional[str] = None,
+        limit: int = 10
+    ) -> List[dict]:
+        """Near-duplicates of each photo, closest first: both hashes within max_distance bits"""
+        with self._lock:
+            size = self.size
+            phashes = self._phash[:size]
+            dhashes = self._dhash[:size]
+            rows = self.rows
+        matches = []
+        for image, image_hash in enumerate(hashes or []):
+            if not image_hash or not size:
+                continue
+            # pHash narrows the column to a few candidates; dHash confirms them
+            p_distance = _popcount(phashes ^ np.uint64(int(image_hash['phash'], 16)))
+            candidates = np.flatnonzero(p_distance <= max_distance)
+            if not candidates.size:
+                continue
+            d_distance = _popcount(dhashes[candidates] ^ np.uint64(int(image_hash['dhash'], 16)))
+            distance = np.maximum(p_distance[candidates], d_distance)
+            close = distance <= max_distance
+            for row, row_distance in zip(candidates[close], distance[close]):
+                return_id, user_id, position = rows[row]
+                if return_id == exclude_return_id:
+                    continue
+                matches.append({
+                    'image': image,
+                    'return_id': return_id,
+                    'user_id': user_id,
+                    'matched_image': position,
+                    'distance': int(row_distance),
+                })
+        matches.sort(key=lambda match: match['distance'])
+        return matches[:limit]
@@ -0,0 +1,185 @@
+import asyncio
+import io
+import math
+from concurrent.futures import ProcessPoolExecutor
+from typing import BinaryIO, List, Optional, Tuple, Union
+from PIL import Image, ImageOps
+from ..config import settings
+from .blob_store import BlobStore, open_blob, write_blob
+from .image_hashing import image_hashes
+from .metrics import observe_stage
+from .tracing import span
+
+
+def preprocess_image_bytes(
+    content: Union[bytes, BinaryIO],
+    max_edge: int,
+    image_format: str = "JPEG",
+    quality: int = 85
+) -> Tuple[bytes, int, int, dict]:
+    """
+    Decode, fix EXIF orientation, shrink to max_edge, fingerprint (pHash and
+    dHash) and re-encode one upload, given as bytes or a file-like object.
+    Runs inside a worker process, so it only takes and returns plain values.
+    """
+    image = Image.open(io.BytesIO(content) if isinstance(content, bytes) else content)
+    # Let the JPEG decoder skip straight to a reduced scale (DCT scaling)
+    # instead of decoding every pixel of a 12MP phone photo
+    image.draft("RGB", (max_edge, max_edge))
+    image = ImageOps.exif_transpose(image)
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+
+    output = io.BytesIO()
+    image.save(output, format=image_format, quality=quality, optimize=True)
+    return output.getvalue(), image.width, image.height, image_hashes(image)
+
+
+def preprocess_blob(
+    root: str,
+    sha256: str,
+    max_edge: int,
+    image_format: str = "JPEG",
+    quality: int = 85
+) -> Tuple[dict, dict]:
+    """
+    preprocess_image_bytes for an original already in the blob store: it is
+    read through a memory map and the result is stored next to it, so only
+    references cross the process boundary. Returns (photo ref, hashes).
+    """
+    with open_blob(root, sha256) as original:
+        encoded, width, height, hashes = preprocess_image_bytes(original, max_edge, image_format, quality)
+    ref = write_blob(root, encoded, Image.MIME.get(image_format.upper()))
+    ref.update({'width': width, 'height': height, 'original_sha256': sha256})
+    return ref, hashes
+
+
+def _warm_worker(_: int) -> bool:
+    Image.init()
+    return True
+
+
+def estimate_payload_bytes(images: List[Image.Image]) -> int:
+    """Upload size of a set of images, using the encoded size when it is known."""
+    total = 0
+    for image in images:
+        encoded = image.info.get("encoded_bytes")
+        # Roughly what a quality-85 JPEG costs per pixel when the size is unknown
+        total += encoded if encoded else (image.width * image.height) // 4
+    return total
+
+
+class ImagePreprocessor:
+    """Off-loop image ingestion backed by a lazily started process pool."""
+
+    def __init__(
+        self,
+        max_edge: Optional[int] = None,
+        max_total_pixels: Optional[int] = None,
+        image_format: Optional[str] = None,
+        quality: Optional[int] = None,
+        workers: Optional[int] = None,
+        blob_store: Optional[BlobStore] = None
+    ):
+        self.max_edge = max_edge or settings.IMAGE_MAX_EDGE
+        self.max_total_pixels = max_total_pixels or settings.IMAGE_MAX_TOTAL_PIXELS
+        self.image_format = image_format or settings.IMAGE_FORMAT
+        self.quality = quality or settings.IMAGE_QUALITY
+        self.workers = workers or settings.IMAGE_PROCESS_WORKERS
+        self.blob_store = blob_store
+        self._pool = None
+
+    @property
+    def pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+        return self._pool
+
+    def edge_for(self, image_count: int) -> int:
+        """Largest edge that keeps the whole request under max_total_pixels."""
+        if image_count <= 0:
+            return self.max_edge
+        budget_edge = int(math.sqrt(self.max_total_pixels / image_count))
+        return max(64, min(self.max_edge, budget_edge))
+
+    async def process_bytes(self, contents: List[bytes]) -> List[Tuple[bytes, int, int, dict]]:
+        """Return (encoded_bytes, width, height, hashes) for each upload, in order."""
+        loop = asyncio.get_running_loop()
+        edge = self.edge_for(len(contents))
+        with observe_stage("image_decode"), span("stage.image_decode", images=len(contents)):
+            return await asyncio.gather(*[
+                loop.run_in_executor(
+                    self.pool,
+                    preprocess_image_bytes,
+                    content,
+                    edge,
+                    self.image_format,
+                    self.quality
+                )
+                for content in contents
+            ])
+
+    async def process(self, contents: List[bytes]) -> List[Image.Image]:
+        processed = await self.process_bytes(contents)
+        return self.open_processed(
+            [data for data, _, _, _ in processed],
+            [hashes for _, _, _, hashes in processed]
+        )
+
+    async def process_blobs(self, originals: List[dict]) -> List[Tuple[dict, dict]]:
+        """Preprocess uploads already in the blob store; returns (photo ref, hashes) for each, in order."""
+        loop = asyncio.get_running_loop()
+        edge = self.edge_for(len(originals))
+        with observe_stage("image_decode"), span("stage.image_decode", images=len(originals)):
+            return await asyncio.gather(*[
+                loop.run_in_executor(
+                    self.pool,
+                    preprocess_blob,
+                    self.blob_store.root,
+                    original['sha256'],
+                    edge,
+                    self.image_format,
+                    self.quality
+                )
+                for original in originals
+            ])
+
+    def open_refs(self, refs: List[dict], hashes: Optional[List[dict]] = None) -> List[Image.Image]:
+        """
+        Open stored photos through read-only memory maps, so the page cache
+        backs the bytes instead of a copy per request. Lazy like open_processed.
+        """
+        images = []
+        for position, ref in enumerate(refs):
+            image = Image.open(self.blob_store.open(ref['sha256']))
+            image.info["encoded_bytes"] = ref['size']
+            if hashes and hashes[position]:
+                image.info["hashes"] = hashes[position]
+            images.append(image)
+        return images
+
+    @staticmethod
+    def open_processed(encoded: List[bytes], hashes: Optional[List[dict]] = None) -> List[Image.Image]:
+        """
+        Open already preprocessed image bytes. Opening is lazy; the pixels are
+        only decoded when the Gemini SDK or the response cache touches them.
+        Perceptual hashes, when known, ride along in image.info["hashes"].
+        """
+        images = []
+        for position, data in enumerate(encoded):
+            image = Image.open(io.BytesIO(data))
+            image.info["encoded_bytes"] = len(data)
+            if hashes:
+                image.info["hashes"] = hashes[position]
+            images.append(image)
+        return images
+
+    def warm_up(self) -> None:
+        """Start the worker processes now so the first upload does not pay for their spawn"""
+        list(self.pool.map(_warm_worker, range(self.workers)))
+
+    def shutdown(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+            self._pool = None
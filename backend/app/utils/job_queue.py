@@ -0,0 +1,244 @@
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+from typing import Awaitable, Callable, List, Optional
+
+
+class JobQueue:
+    """
+    Durable FIFO of analysis jobs in a local SQLite file. Jobs survive restarts.
+    A claimed job is leased: its worker renews it with heartbeat(), and
+    requeue_stale() puts back a 'running' job whose lease has lapsed, e.g.
+    because its worker crashed. Several processes may share one file.
+    """
+
+    def __init__(self, path: str, max_attempts: int = 3):
+        self.path = path
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=10, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            "return_id TEXT NOT NULL,"
+            "payload TEXT NOT NULL,"
+            "status TEXT NOT NULL DEFAULT 'queued',"
+            "attempts INTEGER NOT NULL DEFAULT 0,"
+            "error TEXT,"
+            "created_at REAL NOT NULL,"
+            "updated_at REAL NOT NULL)"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS job_images ("
+            "job_id INTEGER NOT NULL, position INTEGER NOT NULL, data BLOB NOT NULL,"
+            "PRIMARY KEY (job_id, position))"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id)")
+
+    def enqueue(self, return_id: str, payload: dict, images: List[bytes] = ()) -> int:
+        """images holds encoded photos for callers that do not use the blob store"""
+        now = time.time()
+        with self._lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                cursor = self.conn.execute(
+                    "INSERT INTO jobs (return_id, payload, created_at, updated_at) VALUES (?, ?, ?, ?)",
+                    (return_id, json.dumps(payload, default=str), now, now)
+                )
+                job_id = cursor.lastrowid
+                self.conn.executemany(
+                    "INSERT INTO job_images (job_id, position, data) VALUES (?, ?, ?)",
+                    [(job_id, position, data) for position, data in enumerate(images)]
+                )
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+        return job_id
+
+    def claim(self) -> Optional[dict]:
+        """Atomically move the oldest queued job to 'running' and return it"""
+        with self._lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.conn.execute(
+                    "SELECT id, return_id, payload, attempts FROM jobs "
+                    "WHERE status = 'queued' ORDER BY id LIMIT 1"
+                ).fetchone()
+                if row is None:
+                    self.conn.execute("COMMIT")
+                    return None
+                job_id, return_id, payload, attempts = row
+                self.conn.execute(
+                    "UPDATE jobs SET status = 'running', attempts = ?, updated_at = ? WHERE id = ?",
+                    (attempts + 1, time.time(), job_id)
+                )
+                images = [
+                    data for (data,) in self.conn.execute(
+                        "SELECT data FROM job_images WHERE job_id = ? ORDER BY position", (job_id,)
+                    )
+                ]
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+        return {
+            'id': job_id,
+            'return_id': return_id,
+            'payload': json.loads(payload),
+            'images': images,
+            'attempts': attempts + 1,
+        }
+
+    def complete(self, job_id: int) -> None:
+        with self._lock:
+            self.conn.execute(
+                "UPDATE jobs SET status = 'done', error = NULL, updated_at = ? WHERE id = ?",
+                (time.time(), job_id)
+            )
+            # Photos are only needed until the analysis has run
+            self.conn.execute("DELETE FROM job_images WHERE job_id = ?", (job_id,))
+
+    def fail(self, job_id: int, error: str) -> str:
+        """Requeue the job, or mark it failed once max_attempts is reached; returns the new status"""
+        with self._lock:
+            (attempts,) = self.conn.execute("SELECT attempts FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            status = 'failed' if attempts >= self.max_attempts else 'queued'
+            self.conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, updated_at = ? WHERE id = ?",
+                (status, error, time.time(), job_id)
+            )
+        return status
+
+    def release(self, job_id: int) -> None:
+        """Put a job interrupted by shutdown back in the queue without counting the attempt"""
+        with self._lock:
+            self.conn.execute(
+                "UPDATE jobs SET status = 'queued', attempts = MAX(attempts - 1, 0), updated_at = ? WHERE id = ?",
+                (time.time(), job_id)
+            )
+
+    def heartbeat(self, job_id: int) -> None:
+        """Renew the lease on a running job"""
+        with self._lock:
+            self.conn.execute(
+                "UPDATE jobs SET updated_at = ? WHERE id = ? AND status = 'running'",
+                (time.time(), job_id)
+            )
+
+    def requeue_stale(self, older_than_seconds: float) -> int:
+        """
+        Requeue running jobs not renewed for older_than_seconds; the lost run
+        counts as an attempt, so a job that keeps killing its worker fails.
+        """
+        now = time.time()
+        with self._lock:
+            cursor = self.conn.execute(
+                "UPDATE jobs SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'queued' END, "
+                "error = 'worker stopped responding', updated_at = ? "
+                "WHERE status = 'running' AND updated_at < ?",
+                (self.max_attempts, now, now - older_than_seconds)
+            )
+        return cursor.rowcount
+
+    def counts(self) -> dict:
+        with self._lock:
+            rows = self.conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return {status: count for status, count in rows}
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+class JobWorkerPool:
+    """
+    Bounded pool of asyncio workers draining a JobQueue with an async handler.
+    Jobs being handled are renewed every lease_seconds / 3, and the pool
+    requeues jobs whose lease lapsed (any pool's, not just its own) every
+    lease_seconds / 2, starting when it starts.
+    """
+
+    def __init__(
+        self,
+        queue: JobQueue,
+        handler: Callable[[dict], Awaitable[None]],
+        concurrency: int = 2,
+        poll_interval: float = 1.0,
+        lease_seconds: float = 60.0
+    ):
+        self.queue = queue
+        self.handler = handler
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.requeued = 0
+        self._workers = []
+        self._wakeup = None
+
+    async def _call(self, func, *args):
+        # SQLite calls are short but blocking; keep them off the event loop
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, func, *args)
+
+    def notify(self) -> None:
+        """Wake an idle worker after a new job is enqueued"""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def _worker(self) -> None:
+        while True:
+            job = await self._call(self.queue.claim)
+            if job is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            heartbeat = asyncio.create_task(self._heartbeat(job['id']))
+            try:
+                await self.handler(job)
+            except asyncio.CancelledError:
+                await asyncio.shield(self._call(self.queue.release, job['id']))
+                raise
+            except Exception as e:
+                print(f"Job {job['id']} for return {job['return_id']} failed: {str(e)}")
+                await self._call(self.queue.fail, job['id'], str(e))
+            else:
+                await self._call(self.queue.complete, job['id'])
+            finally:
+                heartbeat.cancel()
+
+    async def _heartbeat(self, job_id: int) -> None:
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            try:
+                await self._call(self.queue.heartbeat, job_id)
+            except Exception as e:
+                print(f"Could not renew the lease on job {job_id}: {str(e)}")
+
+    async def _requeue_stale(self) -> None:
+        while True:
+            try:
+                requeued = await self._call(self.queue.requeue_stale, self.lease_seconds)
+                if requeued:
+                    self.requeued += requeued
+                    print(f"Requeued {requeued} jobs whose worker stopped responding")
+                    self.notify()
+            except Exception as e:
+                print(f"Error requeueing stale jobs: {str(e)}")
+            await asyncio.sleep(self.lease_seconds / 2)
+
+    def start(self) -> None:
+        self._wakeup = asyncio.Event()
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+        self._workers.append(asyncio.create_task(self._requeue_stale()))
+
+    async def stop(self) -> None:
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
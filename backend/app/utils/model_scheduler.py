@@ -0,0 +1,219 @@
+"""
+Central admission control for Gemini calls.
+
+Every model call waits here for (a) a request token and an estimated number
+of model tokens from QPM/TPM token buckets and (b) a free in-flight slot.
+Waiters are served strictly by priority lane, then FIFO, so high-value and
+fraud-flagged returns go first when the pipe is saturated. Retryable errors
+(quota, 5xx, timeouts) are retried with jittered exponential backoff, and
+each retry queues again like a fresh call. Under a request deadline, neither
+the admission wait nor a retry is allowed to outlast the budget.
+"""
+import asyncio
+import heapq
+import itertools
+import random
+import time
+from collections import deque
+from contextvars import ContextVar
+from typing import Awaitable, Callable, Optional, Tuple, Type
+from .deadline import request_deadline
+
+# Priority lanes, lowest value is served first
+LANE_HIGH = 0
+LANE_NORMAL = 1
+LANE_LOW = 2
+LANE_NAMES = {LANE_HIGH: 'high', LANE_NORMAL: 'normal', LANE_LOW: 'low'}
+
+
+class CallPriority:
+    """Mutable lane shared by every task of one request, so it can be raised mid-flight."""
+
+    def __init__(self, lane: int = LANE_NORMAL):
+        self.lane = lane
+
+    def escalate(self, lane: int = LANE_HIGH) -> None:
+        self.lane = min(self.lane, lane)
+
+
+# Set per request; tasks spawned for the request's stages inherit it
+call_priority: ContextVar[Optional[CallPriority]] = ContextVar('model_call_priority', default=None)
+
+
+def current_lane() -> int:
+    priority = call_priority.get()
+    return priority.lane if priority is not None else LANE_NORMAL
+
+
+class TokenBucket:
+    def __init__(self, per_minute: float, capacity: Optional[float] = None):
+        self.rate = per_minute / 60.0
+        self.capacity = capacity or per_minute
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until `amount` tokens are available (0 if they are now)"""
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount: float) -> None:
+        """Take tokens; negative amounts refund, and the balance may go into debt"""
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens - amount)
+
+
+class ModelCallScheduler:
+    def __init__(
+        self,
+        requests_per_minute: float,
+        tokens_per_minute: float,
+        max_in_flight: int,
+        max_retries: int = 4,
+        base_delay: float = 0.5,
+        max_delay: float = 8.0
+    ):
+        self.request_bucket = TokenBucket(requests_per_minute)
+        self.token_bucket = TokenBucket(tokens_per_minute)
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self.in_flight = 0
+        self._waiters = []  # heap of (lane, sequence, future, tokens, enqueued_at)
+        self._sequence = itertools.count()
+        self._timer = None
+
+        self.calls = 0
+        self.retries = 0
+        self.failures = 0
+        self.wait_samples = deque(maxlen=1000)
+        self.max_wait = 0.0
+
+    def _dispatch(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        while self._waiters and self.in_flight < self.max_in_flight:
+            lane, _, future, tokens, enqueued_at = self._waiters[0]
+            if future.done():  # cancelled while waiting
+                heapq.heappop(self._waiters)
+                continue
+            delay = max(self.request_bucket.wait_time(1), self.token_bucket.wait_time(tokens))
+            if delay > 0:
+                self._timer = asyncio.get_running_loop().call_later(delay, self._dispatch)
+                return
+            heapq.heappop(self._waiters)
+            self.request_bucket.consume(1)
+            self.token_bucket.consume(tokens)
+            self.in_flight += 1
+            waited = time.monotonic() - enqueued_at
+            self.wait_samples.append(waited)
+            self.max_wait = max(self.max_wait, waited)
+            future.set_result(None)
+
+    async def acquire(self, tokens: float, lane: int, timeout: Optional[float] = None) -> None:
+        """
+        Wait for a slot; raises asyncio.TimeoutError after timeout seconds.
+        asyncio.wait is used rather than wait_for, which on Python 3.11 can
+        swallow a cancellation that arrives as the slot is granted.
+        """
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (lane, next(self._sequence), future, tokens, time.monotonic()))
+        self._dispatch()
+        try:
+            await asyncio.wait([future], timeout=timeout)
+            if not future.done():
+                future.cancel()  # _dispatch drops it
+                raise asyncio.TimeoutError()
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # The slot was granted just before cancellation; hand it back
+                self.release()
+            else:
+                future.cancel()
+            raise
+
+    def release(self, actual_tokens: float = None, estimated_tokens: float = None) -> None:
+        self.in_flight -= 1
+        if actual_tokens is not None and estimated_tokens is not None:
+            self.token_bucket.consume(actual_tokens - estimated_tokens)
+        self._dispatch()
+
+    def _backoff(self, attempt: int) -> float:
+        # Full jitter: uniform in [0, min(max_delay, base * 2^attempt)]
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    async def run(
+        self,
+        call: Callable[[], Awaitable],
+        estimated_tokens: float,
+        retryable: Tuple[Type[BaseException], ...] = (),
+        lane: Optional[int] = None,
+        usage: Callable[[object], Optional[float]] = None
+    ):
+        """
+        Run `call` under the rate limits, retrying retryable errors. `usage`
+        may extract the real token count from the result so the TPM bucket
+        is corrected after the fact.
+        """
+        lane = current_lane() if lane is None else lane
+        deadline = request_deadline.get()
+        attempt = 0
+        while True:
+            # Raises TimeoutError if no slot frees up within the budget
+            await self.acquire(estimated_tokens, lane, None if deadline is None else deadline.remaining())
+            self.calls += 1
+            actual = None
+            try:
+                result = await call()
+                actual = usage(result) if usage is not None else None
+                return result
+            except retryable as e:
+                delay = self._backoff(attempt + 1)
+                if attempt >= self.max_retries or (deadline is not None and delay >= deadline.remaining()):
+                    self.failures += 1
+                    raise
+                self.retries += 1
+                attempt += 1
+                print(f"Retryable model error ({type(e).__name__}), retry {attempt} in {delay:.2f}s")
+            except Exception:
+                self.failures += 1
+                raise
+            finally:
+                self.release(actual, estimated_tokens if actual is not None else None)
+            await asyncio.sleep(delay)
+
+    def stats(self) -> dict:
+        waits = sorted(self.wait_samples)
+
+        def percentile(pct: float) -> float:
+            if not waits:
+                return 0.0
+            return round(waits[min(len(waits) - 1, int(pct / 100 * len(waits)))] * 1000, 2)
+
+        depth = {name: 0 for name in LANE_NAMES.values()}
+        for lane, _, future, _, _ in self._waiters:
+            if not future.done():
+                depth[LANE_NAMES.get(lane, str(lane))] += 1
+        return {
+            'queue_depth': depth,
+            'in_flight': self.in_flight,
+            'calls': self.calls,
+            'retries': self.retries,
+            'failures': self.failures,
+            'wait_p50_ms': percentile(50),
+            'wait_p99_ms': percentile(99),
+            'wait_max_ms': round(self.max_wait * 1000, 2),
+            'request_tokens_available': round(self.request_bucket.tokens, 1),
+            'model_tokens_available': round(self.token_bucket.tokens, 1),
+        }
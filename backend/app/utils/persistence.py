@@ -0,0 +1,458 @@
+"""
+Storage backends for FirebaseClient plus a write-behind buffer.
+
+Stores are plain blocking classes; FirebaseClient runs them on a dedicated
+thread pool so the event loop never waits on the network or disk. Besides
+Firestore there is a SQLite store (a file or ":memory:") with the same
+interface, so the persistence layer can be tested and benchmarked without
+the Firestore emulator or network access.
+"""
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Awaitable, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from .metrics import observe_stage, write_behind_write_latency
+
+# One buffered write: ('set' | 'update', return_id, data)
+Write = Tuple[str, str, dict]
+
+FIRESTORE_BATCH_LIMIT = 500
+
+
+def apply_field_update(document: dict, update: dict) -> dict:
+    """Apply a Firestore-style update, where dotted keys address nested fields"""
+    for path, value in update.items():
+        target = document
+        keys = path.split('.')
+        for key in keys[:-1]:
+            if not isinstance(target.get(key), dict):
+                target[key] = {}
+            target = target[key]
+        target[keys[-1]] = value
+    return document
+
+
+class ReturnStore:
+    """Blocking storage interface for return documents, per-user aggregates and analytics rollups."""
+
+    def new_return_id(self) -> str:
+        raise NotImplementedError
+
+    def get_return(self, return_id: str) -> Optional[dict]:
+        raise NotImplementedError
+
+    def commit(self, writes: List[Write]) -> None:
+        raise NotImplementedError
+
+    def returns_for_user(self, user_id: str) -> List[Tuple[str, dict]]:
+        raise NotImplementedError
+
+    def image_hash_records(self) -> List[Tuple[str, Optional[str], list]]:
+        """(return_id, user_id, image_hashes) for every return that has photo hashes"""
+        raise NotImplementedError
+
+    def get_aggregate(self, user_id: str) -> Optional[dict]:
+        raise NotImplementedError
+
+    def set_aggregate(self, user_id: str, aggregate: dict) -> None:
+        raise NotImplementedError
+
+    def update_aggregate(self, user_id: str, apply: Callable[[Optional[dict]], dict]) -> dict:
+        """Atomic read-modify-write; apply receives None when the user has no aggregate yet"""
+        raise NotImplementedError
+
+    def scan_returns(self, fields: Iterable[str]) -> Iterator[Tuple[str, dict]]:
+        """(return_id, document) for every return, with only the given top-level fields"""
+        raise NotImplementedError
+
+    def get_analytics_shards(self) -> List[dict]:
+        raise NotImplementedError
+
+    def update_analytics_shard(self, shard: int, apply: Callable[[Optional[dict]], dict]) -> dict:
+        """Atomic read-modify-write of one analytics rollup shard"""
+        raise NotImplementedError
+
+    def replace_analytics(self, rollup: dict) -> None:
+        """Drop every shard and store rollup as the only one (after a rebuild)"""
+        raise NotImplementedError
+
+
+class FirestoreStore(ReturnStore):
+    def __init__(self, credentials_path: str = None):
+        import firebase_admin
+        from firebase_admin import credentials, firestore
+
+        if not firebase_admin._apps:
+            firebase_credentials = credentials_path or os.getenv("FIREBASE_CREDENTIALS")
+            if not firebase_credentials:
+                raise Exception("FIREBASE_CREDENTIALS environment variable not set")
+            cred = credentials.Certificate(firebase_credentials)
+            firebase_admin.initialize_app(cred)
+        self.firestore = firestore
+        self.db = firestore.client()
+
+    def new_return_id(self) -> str:
+        return self.db.collection('returns').document().id
+
+    def get_return(self, return_id: str) -> Optional[dict]:
+        snapshot = self.db.collection('returns').document(return_id).get()
+        return snapshot.to_dict() if snapshot.exists else None
+
+    def commit(self, writes: List[Write]) -> None:
+        returns = self.db.collection('returns')
+        for start in range(0, len(writes), FIRESTORE_BATCH_LIMIT):
+            batch = self.db.batch()
+            for op, return_id, data in writes[start:start + FIRESTORE_BATCH_LIMIT]:
+                if op == 'set':
+                    batch.set(returns.document(return_id), data)
+                else:
+                    batch.update(returns.document(return_id), data)
+            batch.commit()
+
+    def returns_for_user(self, user_id: str) -> List[Tuple[str, dict]]:
+        returns = self.db.collection('returns').where('user_id', '==', user_id).stream()
+        return [(doc.id, doc.to_dict()) for doc in returns]
+
+    def image_hash_records(self) -> List[Tuple[str, Optional[str], list]]:
+        # Field projection: only the hashes and owner are read, not whole documents
+        returns = self.db.collection('returns').select(['user_id', 'image_hashes']).stream()
+        records = []
+        for doc in returns:
+            data = doc.to_dict() or {}
+            if data.get('image_hashes'):
+                records.append((doc.id, data.get('user_id'), data['image_hashes']))
+        return records
+
+    def get_aggregate(self, user_id: str) -> Optional[dict]:
+        snapshot = self.db.collection('user_return_stats').document(user_id).get()
+        return snapshot.to_dict() if snapshot.exists else None
+
+    def set_aggregate(self, user_id: str, aggregate: dict) -> None:
+        self.db.collection('user_return_stats').document(user_id).set(aggregate)
+
+    def update_aggregate(self, user_id: str, apply) -> dict:
+        aggregate_ref = self.db.collection('user_return_stats').document(user_id)
+
+        @self.firestore.transactional
+        def update_in_transaction(transaction):
+            snapshot = aggregate_ref.get(transaction=transaction)
+            aggregate = apply(snapshot.to_dict() if snapshot.exists else None)
+            transaction.set(aggregate_ref, aggregate)
+            return aggregate
+
+        return update_in_transaction(self.db.transaction())
+
+    def scan_returns(self, fields: Iterable[str]) -> Iterator[Tuple[str, dict]]:
+        # Field projection keeps photos, hashes and stage details off the wire
+        for doc in self.db.collection('returns').select(list(fields)).stream():
+            yield doc.id, doc.to_dict() or {}
+
+    def get_analytics_shards(self) -> List[dict]:
+        return [doc.to_dict() for doc in self.db.collection('return_analytics').stream()]
+
+    def update_analytics_shard(self, shard: int, apply) -> dict:
+        shard_ref = self.db.collection('return_analytics').document(f"shard-{shard}")
+
+        @self.firestore.transactional
+        def update_in_transaction(transaction):
+            snapshot = shard_ref.get(transaction=transaction)
+            rollup = apply(snapshot.to_dict() if snapshot.exists else None)
+            transaction.set(shard_ref, rollup)
+            return rollup
+
+        return update_in_transaction(self.db.transaction())
+
+    def replace_analytics(self, rollup: dict) -> None:
+        shards = self.db.collection('return_analytics')
+        batch = self.db.batch()
+        for doc in shards.stream():
+            batch.delete(doc.reference)
+        batch.set(shards.document("shard-0"), rollup)
+        batch.commit()
+
+
+class SQLiteStore(ReturnStore):
+    """Local stand-in for Firestore; documents are stored as JSON text."""
+
+    def __init__(self, path: str = ":memory:"):
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, timeout=10, check_same_thread=False)
+        if path != ":memory:":
+            self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS returns (id TEXT PRIMARY KEY, user_id TEXT, data TEXT NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS returns_user ON returns (user_id)")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS user_return_stats (user_id TEXT PRIMARY KEY, data TEXT NOT NULL)"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS return_analytics (shard INTEGER PRIMARY KEY, data TEXT NOT NULL)"
+        )
+        self.conn.commit()
+
+    @staticmethod
+    def _dumps(document: dict) -> str:
+        return json.dumps(document, default=str)
+
+    def new_return_id(self) -> str:
+        return uuid.uuid4().hex[:20]
+
+    def get_return(self, return_id: str) -> Optional[dict]:
+        with self._lock:
+            row = self.conn.execute("SELECT data FROM returns WHERE id = ?", (return_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def commit(self, writes: List[Write]) -> None:
+        with self._lock, self.conn:
+            for op, return_id, data in writes:
+                if op == 'set':
+                    document = data
+                else:
+                    row = self.conn.execute("SELECT data FROM returns WHERE id = ?", (return_id,)).fetchone()
+                    if row is None:
+                        raise KeyError(f"No return document {return_id} to update")
+                    document = apply_field_update(json.loads(row[0]), data)
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO returns (id, user_id, data) VALUES (?, ?, ?)",
+                    (return_id, document.get('user_id'), self._dumps(document))
+                )
+
+    def returns_for_user(self, user_id: str) -> List[Tuple[str, dict]]:
+        with self._lock:
+            rows = self.conn.execute("SELECT id, data FROM returns WHERE user_id = ?", (user_id,)).fetchall()
+        return [(return_id, json.loads(data)) for return_id, data in rows]
+
+    def image_hash_records(self) -> List[Tuple[str, Optional[str], list]]:
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT id, user_id, json_extract(data, '$.image_hashes') FROM returns "
+                "WHERE json_extract(data, '$.image_hashes') IS NOT NULL"
+            ).fetchall()
+        return [(return_id, user_id, json.loads(hashes)) for return_id, user_id, hashes in rows]
+
+    def get_aggregate(self, user_id: str) -> Optional[dict]:
+        with self._lock:
+            row = self.conn.execute("SELECT data FROM user_return_stats WHERE user_id = ?", (user_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set_aggregate(self, user_id: str, aggregate: dict) -> None:
+        with self._lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO user_return_stats (user_id, data) VALUES (?, ?)",
+                (user_id, self._dumps(aggregate))
+            )
+
+    def update_aggregate(self, user_id: str, apply) -> dict:
+        with self._lock, self.conn:
+            row = self.conn.execute("SELECT data FROM user_return_stats WHERE user_id = ?", (user_id,)).fetchone()
+            aggregate = apply(json.loads(row[0]) if row else None)
+            self.conn.execute(
+                "INSERT OR REPLACE INTO user_return_stats (user_id, data) VALUES (?, ?)",
+                (user_id, self._dumps(aggregate))
+            )
+        return aggregate
+
+    def scan_returns(self, fields: Iterable[str]) -> Iterator[Tuple[str, dict]]:
+        fields = list(fields)
+        with self._lock:
+            rows = self.conn.execute("SELECT id, data FROM returns").fetchall()
+        for return_id, data in rows:
+            document = json.loads(data)
+            yield return_id, {field: document[field] for field in fields if field in document}
+
+    def get_analytics_shards(self) -> List[dict]:
+        with self._lock:
+            rows = self.conn.execute("SELECT data FROM return_analytics").fetchall()
+        return [json.loads(data) for data, in rows]
+
+    def update_analytics_shard(self, shard: int, apply) -> dict:
+        with self._lock, self.conn:
+            row = self.conn.execute("SELECT data FROM return_analytics WHERE shard = ?", (shard,)).fetchone()
+            rollup = apply(json.loads(row[0]) if row else None)
+            self.conn.execute(
+                "INSERT OR REPLACE INTO return_analytics (shard, data) VALUES (?, ?)",
+                (shard, self._dumps(rollup))
+            )
+        return rollup
+
+    def replace_analytics(self, rollup: dict) -> None:
+        with self._lock, self.conn:
+            self.conn.execute("DELETE FROM return_analytics")
+            self.conn.execute("INSERT INTO return_analytics (shard, data) VALUES (0, ?)", (self._dumps(rollup),))
+
+
+def create_store(backend: str, sqlite_path: str = None) -> ReturnStore:
+    if backend == "firestore":
+        return FirestoreStore()
+    if backend == "sqlite":
+        return SQLiteStore(sqlite_path)
+    if backend == "memory":
+        return SQLiteStore(":memory:")
+    raise ValueError(f"Unknown persistence backend: {backend}")
+
+
+class WriteBehindBuffer:
+    """
+    Groups writes into batched commits. A batch is cut when flush_size
+    writes are pending or flush_interval seconds after the first pending
+    write, whichever comes first, and is committed by a background task, so
+    add() never waits on the store. Several batches may be in flight; one
+    that touches a return an earlier batch is still committing waits for
+    it, so writes to a return land in order. commit must only raise when
+    nothing was committed.
+
+    A batch whose commit raises is split in halves until the failing writes
+    are isolated, so one bad write cannot hold back the rest. Failed writes
+    (and later writes to the same returns) are retried first in the next
+    batch. A failure only counts as an attempt when other writes committed
+    since the write last failed (while nothing commits the store is taken to
+    be down); a write that uses up max_attempts is moved to dead_letters.
+    Call flush() on shutdown so nothing buffered is lost.
+
+    Saving only buffers, so the commit latency is recorded here: each commit
+    as the firestore_commit stage, and each write's time from add() to its
+    commit in write_behind_write_latency.
+    """
+
+    def __init__(
+        self,
+        commit: Callable[[List[Write]], Awaitable[None]],
+        flush_size: int = 20,
+        flush_interval: float = 0.5,
+        max_attempts: int = 5
+    ):
+        self.commit = commit
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_attempts = max_attempts
+        self.pending: List[Write] = []
+        self.failed: List[Write] = []  # writes whose commit raised, in order, retried first
+        self.dead_letters: List[Write] = []
+        self.flushes = 0
+        self.committed = 0
+        # id(write) -> (failed attempts, self.flushes at the last failure), for writes in self.failed
+        self._attempts: Dict[int, Tuple[int, int]] = {}
+        self._added: Dict[int, float] = {}  # id(write) -> when it was buffered
+        self._committing: Dict[str, asyncio.Task] = {}  # return_id -> batch committing its latest write
+        self._tasks: Set[asyncio.Task] = set()
+        self._timer = None
+
+    def has_pending(self, return_id: str) -> bool:
+        """Whether a write to this return is buffered or still being committed"""
+        return return_id in self._committing or any(
+            pending_id == return_id for _, pending_id, _ in self.failed + self.pending
+        )
+
+    async def add(self, op: str, return_id: str, data: dict) -> None:
+        write = (op, return_id, data)
+        self._added[id(write)] = time.perf_counter()
+        self.pending.append(write)
+        if len(self.pending) >= self.flush_size:
+            self._start_batch()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.flush_interval, self._start_batch)
+
+    def _start_batch(self) -> None:
+        """Hand everything buffered to a background commit"""
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self.failed and not self.pending:
+            return
+        writes = self.failed + self.pending
+        self.failed, self.pending = [], []
+        earlier = {self._committing[return_id] for _, return_id, _ in writes if return_id in self._committing}
+        task = asyncio.ensure_future(self._commit_batch(writes, earlier))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        for _, return_id, _ in writes:
+            self._committing[return_id] = task
+
+    async def _commit_batch(self, writes: List[Write], earlier: Set[asyncio.Task]) -> int:
+        task = asyncio.current_task()
+        try:
+            if earlier:
+                await asyncio.gather(*earlier)
+            # Writes to a return with a write still waiting for a retry wait behind it
+            waiting = {return_id for _, return_id, _ in self.failed}
+            held = [write for write in writes if write[1] in waiting]
+            committed, failed, blocked = await self._commit_split([write for write in writes if write[1] not in waiting])
+            self._retry(failed, blocked + held)
+            return committed
+        finally:
+            for _, return_id, _ in writes:
+                if self._committing.get(return_id) is task:
+                    del self._committing[return_id]
+
+    async def _commit_split(self, writes: List[Write]) -> Tuple[int, List[Write], List[Write]]:
+        """
+        Commit writes, bisecting on failure. Returns (writes committed, writes
+        that failed, later writes held back because their return failed).
+        """
+        if not writes:
+            return 0, [], []
+        try:
+            with observe_stage("firestore_commit"):
+                await self.commit(writes)
+        except Exception as e:
+            if len(writes) == 1:
+                print(f"Write-behind commit of {writes[0][0]} {writes[0][1]} failed: {str(e)}")
+                return 0, writes, []
+            middle = len(writes) // 2
+            committed, failed, blocked = await self._commit_split(writes[:middle])
+            stopped = {return_id for _, return_id, _ in failed + blocked}
+            rest = writes[middle:]
+            more_committed, more_failed, more_blocked = await self._commit_split(
+                [write for write in rest if write[1] not in stopped]
+            )
+            blocked = blocked + more_blocked + [write for write in rest if write[1] in stopped]
+            return committed + more_committed, failed + more_failed, blocked
+        self.flushes += 1
+        self.committed += len(writes)
+        now = time.perf_counter()
+        for write in writes:
+            self._attempts.pop(id(write), None)
+            write_behind_write_latency.observe(now - self._added.pop(id(write), now))
+        return len(writes), [], []
+
+    def _retry(self, failed: List[Write], held: List[Write] = ()) -> None:
+        for write in failed:
+            attempts, flushes = self._attempts.get(id(write), (0, -1))
+            if self.flushes != flushes:
+                # Other writes committed since this one last failed, so the
+                # store is up and this write is the problem
+                attempts += 1
+            if attempts >= self.max_attempts:
+                self._attempts.pop(id(write), None)
+                self._added.pop(id(write), None)
+                self.dead_letters.append(write)
+                print(f"Giving up on {write[0]} {write[1]} after {attempts} failed commits")
+                continue
+            self._attempts[id(write)] = (attempts, self.flushes)
+            self.failed.append(write)
+        self.failed.extend(held)
+        if self.failed and self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.flush_interval, self._start_batch)
+
+    async def flush(self) -> int:
+        """Commit everything buffered now and wait for every batch in flight; returns the writes committed"""
+        self._start_batch()
+        if not self._tasks:
+            return 0
+        return sum(await asyncio.gather(*list(self._tasks)))
+
+    def stats(self) -> dict:
+        return {
+            'pending': len(self.failed) + len(self.pending),
+            'batches_in_flight': len(self._tasks),
+            'flushes': self.flushes,
+            'committed_writes': self.committed,
+            'dead_letters': len(self.dead_letters),
+            'avg_batch_size': round(self.committed / self.flushes, 2) if self.flushes else 0.0,
+        }
@@ -0,0 +1,244 @@
+"""
+Shared prompt construction for the Gemini services.
+
+Static instruction blocks are compacted (indentation and blank lines
+stripped) once and cached. Dynamic payloads are serialized compactly through
+per-field whitelists, dropping nulls and empty values. PromptBuilder keeps
+each prompt within a token budget by shrinking its lowest-priority payloads
+first: long lists are halved (the dropped items become a "+N more" note)
+before any text is truncated. PromptTokenStats records estimated and actual
+tokens per prompt and endpoint so cost can be tracked.
+"""
+import functools
+import json
+import threading
+from contextvars import ContextVar
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+CHARS_PER_TOKEN = 4
+TRUNCATION_MARKER = "...[truncated]"
+
+# Field whitelist: field name -> None (keep the value as is) or a nested
+# whitelist applied to a dict value, or to each dict in a list value
+FieldSpec = Optional[Dict[str, Any]]
+
+
+def estimate_text_tokens(text: str) -> int:
+    """Rough token count of prompt text (about 4 characters per token)"""
+    return -(-len(text) // CHARS_PER_TOKEN)
+
+
+def compact_text(text: str) -> str:
+    """Strip per-line indentation and blank lines; the model does not need them"""
+    return "\n".join(line.strip() for line in text.splitlines() if line.strip())
+
+
+def cached_section(builder: Callable[..., str]) -> Callable[..., str]:
+    """Memoize a prompt section builder, compacting its output once per argument set"""
+    @functools.lru_cache(maxsize=256)
+    def build(*args) -> str:
+        return compact_text(builder(*args))
+    functools.update_wrapper(build, builder)
+    return build
+
+
+def _is_empty(value) -> bool:
+    return value is None or value == "" or value == [] or value == {}
+
+
+def compact_value(value, fields: FieldSpec = None, float_digits: int = 3):
+    """
+    Copy of `value` restricted to the whitelisted fields, with nulls and
+    empty values removed and floats rounded.
+    """
+    if isinstance(value, dict):
+        result = {}
+        for key, item in value.items():
+            if fields is not None and key not in fields:
+                continue
+            item = compact_value(item, fields.get(key) if fields is not None else None, float_digits)
+            if not _is_empty(item):
+                result[key] = item
+        return result
+    if isinstance(value, (list, tuple)):
+        items = [compact_value(item, fields, float_digits) for item in value]
+        return [item for item in items if not _is_empty(item)]
+    if isinstance(value, float):
+        return round(value, float_digits)
+    return value
+
+
+def compact_json(value, fields: FieldSpec = None) -> str:
+    return json.dumps(compact_value(value, fields), separators=(",", ":"), default=str)
+
+
+def _longest_list(value, best=None):
+    """Find the (container, key) of the longest list that still has more than one item"""
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if isinstance(item, list) and _shrinkable_length(item) > 1:
+                if best is None or _shrinkable_length(item) > _shrinkable_length(best[0][best[1]]):
+                    best = (value, key)
+            best = _longest_list(item, best)
+    elif isinstance(value, list):
+        for item in value:
+            best = _longest_list(item, best)
+    return best
+
+
+class MoreItems:
+    """
+    Stands in for the items dropped from a list; rendered as "+N more". The
+    count is kept on the marker, so a payload string that merely looks like
+    one is never mistaken for it.
+    """
+
+    def __init__(self, count: int):
+        self.count = count
+
+    def __str__(self) -> str:
+        return f"+{self.count} more"
+
+
+def _shrinkable_length(items: list) -> int:
+    return len(items) - (1 if items and _more_count(items[-1]) else 0)
+
+
+def _more_count(item) -> int:
+    return item.count if isinstance(item, MoreItems) else 0
+
+
+def halve_longest_list(value) -> bool:
+    """
+    Keep the first half of the payload's longest list, replacing the rest
+    with a "+N more" note. Returns False when no list can shrink further.
+    """
+    found = _longest_list(value)
+    if found is None:
+        return False
+    container, key = found
+    items = container[key]
+    dropped = _more_count(items[-1]) if items else 0
+    if dropped:
+        items = items[:-1]
+    keep = len(items) // 2
+    container[key] = items[:keep] + [MoreItems(dropped + len(items) - keep)]
+    return True
+
+
+class PromptBuilder:
+    """
+    Assembles a prompt from fixed text and labelled payload sections. Fixed
+    text is never trimmed; payloads carry a priority (higher is kept longer)
+    and are shrunk lowest priority first until the prompt fits the budget.
+    """
+
+    def __init__(self, budget_tokens: Optional[int] = None):
+        self.budget_tokens = budget_tokens
+        self.sections: List[dict] = []
+        self.truncated = False
+
+    def add_text(self, text: str) -> "PromptBuilder":
+        self.sections.append({'text': text, 'priority': None})
+        return self
+
+    def add_payload(self, label: str, payload, fields: FieldSpec = None, priority: int = 1) -> "PromptBuilder":
+        self.sections.append({
+            'label': label,
+            'value': compact_value(payload, fields),
+            'priority': priority,
+            'text': None,
+        })
+        return self
+
+    @staticmethod
+    def _render(section: dict) -> str:
+        if section['text'] is not None:
+            return section['text']
+        value = json.dumps(section['value'], separators=(",", ":"), default=str)
+        return f"{section['label']}: {value}"
+
+    def _total_tokens(self) -> int:
+        return sum(estimate_text_tokens(self._render(section)) + 1 for section in self.sections)
+
+    def build(self) -> str:
+        if self.budget_tokens is not None:
+            self._fit_budget()
+        return "\n".join(self._render(section) for section in self.sections)
+
+    def _fit_budget(self) -> None:
+        payloads = sorted(
+            (section for section in self.sections if section['priority'] is not None),
+            key=lambda section: section['priority']
+        )
+        # Summarize lists first, lowest value sections first
+        for section in payloads:
+            while self._total_tokens() > self.budget_tokens and halve_longest_list(section['value']):
+                self.truncated = True
+        # Then cut the serialized text of whatever is still too long
+        for section in payloads:
+            excess = self._total_tokens() - self.budget_tokens
+            if excess <= 0:
+                return
+            text = self._render(section)
+            keep = max(0, len(text) - excess * CHARS_PER_TOKEN - len(TRUNCATION_MARKER))
+            section['text'] = text[:keep] + TRUNCATION_MARKER
+            self.truncated = True
+
+
+# Set per request so model calls are attributed to the endpoint that made them
+token_usage_scope: ContextVar[str] = ContextVar('token_usage_scope', default='unscoped')
+
+
+class PromptTokenStats:
+    """Running token and latency totals per (endpoint, prompt) pair."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.totals: Dict[Tuple[str, str], dict] = {}  # (scope, prompt_name) -> totals
+
+    def record(
+        self,
+        prompt_name: str,
+        estimated_input: int,
+        estimated_output: int,
+        input_tokens: Optional[int] = None,
+        output_tokens: Optional[int] = None,
+        latency: float = 0.0,
+        cached: bool = False
+    ) -> None:
+        # Scopes such as "job:analyze-return" contain any separator we might pick
+        key = (token_usage_scope.get(), prompt_name)
+        with self._lock:
+            totals = self.totals.setdefault(key, {
+                'calls': 0,
+                'cache_hits': 0,
+                'estimated_input_tokens': 0,
+                'estimated_output_tokens': 0,
+                'input_tokens': 0,
+                'output_tokens': 0,
+                'latency_seconds': 0.0,
+            })
+            totals['calls'] += 1
+            totals['estimated_input_tokens'] += estimated_input
+            totals['estimated_output_tokens'] += estimated_output
+            if cached:
+                totals['cache_hits'] += 1
+                return
+            totals['input_tokens'] += input_tokens or 0
+            totals['output_tokens'] += output_tokens or 0
+            totals['latency_seconds'] += latency
+
+    def summary(self) -> dict:
+        result = {}
+        with self._lock:
+            for (scope, prompt_name), totals in self.totals.items():
+                model_calls = totals['calls'] - totals['cache_hits']
+                result.setdefault(scope, {})[prompt_name] = {
+                    **{name: value for name, value in totals.items() if name != 'latency_seconds'},
+                    'avg_latency_ms': round(totals['latency_seconds'] / model_calls * 1000, 2) if model_calls else 0.0,
+                }
+        return result
+
+
+prompt_token_stats = PromptTokenStats()
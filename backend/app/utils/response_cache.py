@@ -0,0 +1,162 @@
+import hashlib
+import json
+import sqlite3
+import time
+from collections import OrderedDict
+from typing import List, Optional, Union
+from PIL import Image
+
+
+def hash_image_pixels(image: Image.Image) -> str:
+    """Hash the decoded pixel data, so re-encoded copies of one photo share a key."""
+    digest = hashlib.sha256()
+    digest.update(f"{image.mode}:{image.size[0]}x{image.size[1]}:".encode())
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+
+def make_cache_key(
+    model_name: str,
+    temperature: float,
+    prompt: str,
+    image: Union[Image.Image, List[Image.Image], None] = None
+) -> str:
+    prompt_hash = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+    images = image if isinstance(image, list) else ([image] if image is not None else [])
+    image_hash = ",".join(hash_image_pixels(i) for i in images) or "-"
+    raw = f"{model_name}|{temperature:.3f}|{prompt_hash}|{image_hash}"
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+class LRUCache:
+    """In-process LRU with an entry cap and a per-entry TTL."""
+
+    def __init__(self, max_entries: int = 1024, ttl_seconds: float = 3600):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.entries = OrderedDict()  # key -> (stored_at, value)
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: str) -> Optional[str]:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        stored_at, value = entry
+        if self.ttl_seconds and time.time() - stored_at > self.ttl_seconds:
+            del self.entries[key]
+            self.expirations += 1
+            return None
+        self.entries.move_to_end(key)
+        return value
+
+    def set(self, key: str, value: str, stored_at: Optional[float] = None) -> None:
+        self.entries[key] = (stored_at or time.time(), value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key: str) -> bool:
+        return self.entries.pop(key, None) is not None
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+
+class SQLiteCacheTier:
+    """
+    Disk tier shared by every uvicorn worker on the host. WAL mode lets the
+    workers read concurrently while one of them writes.
+    """
+
+    def __init__(self, path: str, ttl_seconds: float = 3600):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.conn = sqlite3.connect(path, timeout=5, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS gemini_responses ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, stored_at REAL NOT NULL)"
+        )
+        self.conn.commit()
+
+    def get(self, key: str) -> Optional[tuple]:
+        row = self.conn.execute(
+            "SELECT stored_at, value FROM gemini_responses WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return None
+        if self.ttl_seconds and time.time() - row[0] > self.ttl_seconds:
+            self.conn.execute("DELETE FROM gemini_responses WHERE key = ?", (key,))
+            self.conn.commit()
+            return None
+        return row
+
+    def set(self, key: str, value: str) -> None:
+        self.conn.execute(
+            "INSERT OR REPLACE INTO gemini_responses (key, value, stored_at) VALUES (?, ?, ?)",
+            (key, value, time.time())
+        )
+        self.conn.commit()
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+class ResponseCache:
+    """Two-tier cache for parsed Gemini responses, keyed by make_cache_key."""
+
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        ttl_seconds: float = 3600,
+        disk_path: Optional[str] = None
+    ):
+        self.memory = LRUCache(max_entries, ttl_seconds)
+        self.disk = SQLiteCacheTier(disk_path, ttl_seconds) if disk_path else None
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[dict]:
+        value = self.memory.get(key)
+        if value is not None:
+            self.memory_hits += 1
+            return json.loads(value)
+        if self.disk is not None:
+            try:
+                row = self.disk.get(key)
+            except sqlite3.Error as e:
+                print(f"Response cache disk read failed: {str(e)}")
+                row = None
+            if row is not None:
+                stored_at, value = row
+                self.disk_hits += 1
+                self.memory.set(key, value, stored_at)
+                return json.loads(value)
+        self.misses += 1
+        return None
+
+    def set(self, key: str, result: dict) -> None:
+        value = json.dumps(result, separators=(",", ":"))
+        self.memory.set(key, value)
+        if self.disk is not None:
+            try:
+                self.disk.set(key, value)
+            except sqlite3.Error as e:
+                print(f"Response cache disk write failed: {str(e)}")
+
+    def stats(self) -> dict:
+        lookups = self.memory_hits + self.disk_hits + self.misses
+        return {
+            'entries': len(self.memory),
+            'memory_hits': self.memory_hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'evictions': self.memory.evictions,
+            'expirations': self.memory.expirations,
+            'hit_rate': round((self.memory_hits + self.disk_hits) / lookups, 4) if lookups else 0.0,
+            'disk_tier': self.disk is not None,
+        }
@@ -0,0 +1,180 @@
+"""
+Materialized return analytics for the dashboard.
+
+Every committed write is turned into a delta: the analytics record of the
+return before the write is subtracted and the record after it is added.
+Deltas are merged into one of a few rollup shards (counters by return
+reason, outcome, status, category, grade and fraud risk band, plus per-day
+counts and value), so concurrent writers rarely contend on one document.
+A dashboard query sums the shards, which costs O(shards x buckets) however
+many returns are stored.
+"""
+from datetime import datetime, timedelta
+from typing import Iterable, Optional
+
+from .return_history import to_datetime, to_float
+
+DIMENSIONS = ("reason", "outcome", "status", "category", "grade", "fraud_band")
+VALUE_FIELDS = ("value", "recovered", "estimated_recovery")
+
+# Top-level document fields the analytics record is derived from; writes that
+# touch none of them cannot change the rollups
+ANALYTICS_FIELDS = (
+    "return_reason", "final_outcome", "return_decision", "status", "product_category",
+    "product_details", "defect_analysis", "condition_grade", "fraud_analysis",
+    "original_price", "price_recommendation", "resale", "date_of_return", "timestamp",
+)
+MAX_LABEL_LENGTH = 60  # return reasons are free text
+
+
+def _label(value, default: str) -> str:
+    if value is None or not str(value).strip():
+        return default
+    return str(value).strip()[:MAX_LABEL_LENGTH]
+
+
+def fraud_band(fraud_analysis) -> str:
+    if not isinstance(fraud_analysis, dict):
+        return "Unknown"
+    if fraud_analysis.get("risk_category") in ("Low", "Medium", "High"):
+        return fraud_analysis["risk_category"]
+    score = fraud_analysis.get("risk_score")
+    if not isinstance(score, (int, float)):
+        return "Unknown"
+    return "High" if score >= 0.7 else "Medium" if score >= 0.3 else "Low"
+
+
+def analytics_record(document: dict) -> dict:
+    """The dimensions and values one return contributes to the rollups"""
+    details = document.get("product_details") or {}
+    defect_analysis = document.get("defect_analysis") or {}
+    condition_grade = document.get("condition_grade") or {}
+    decision = document.get("return_decision") or {}
+    pricing = document.get("price_recommendation") or {}
+    resale = document.get("resale") or {}
+    returned = to_datetime(document.get("date_of_return")) or to_datetime(document.get("timestamp")) or datetime.now()
+    return {
+        "date": returned.strftime("%Y-%m-%d"),
+        "reason": _label(document.get("return_reason"), "Unknown"),
+        "outcome": _label(document.get("final_outcome") or decision.get("final_outcome"), "Pending"),
+        "status": _label(document.get("status"), "received"),
+        "category": _label(document.get("product_category") or details.get("Category") or defect_analysis.get("product_category"), "Unknown"),
+        "grade": _label(condition_grade.get("grade") or defect_analysis.get("condition_grade"), "Ungraded"),
+        "fraud_band": fraud_band(document.get("fraud_analysis")),
+        "value": to_float(document.get("original_price", details.get("Price"))),
+        "recovered": to_float(resale.get("sale_price")) if resale else 0.0,
+        "estimated_recovery": to_float(pricing.get("suggested_price")) if pricing else 0.0,
+    }
+
+
+def new_rollup() -> dict:
+    return {
+        "total": 0,
+        **{field: 0.0 for field in VALUE_FIELDS},
+        "counts": {dimension: {} for dimension in DIMENSIONS},
+        "daily": {},  # "YYYY-MM-DD" -> {"count": int, "value": float, "recovered": float, "estimated_recovery": float}
+    }
+
+
+def _add_record(rollup: dict, record: dict, sign: int) -> None:
+    rollup["total"] += sign
+    for field in VALUE_FIELDS:
+        rollup[field] = round(rollup[field] + sign * record[field], 2)
+    for dimension in DIMENSIONS:
+        counts = rollup["counts"][dimension]
+        counts[record[dimension]] = counts.get(record[dimension], 0) + sign
+    bucket = rollup["daily"].setdefault(record["date"], {"count": 0, **{field: 0.0 for field in VALUE_FIELDS}})
+    bucket["count"] += sign
+    for field in VALUE_FIELDS:
+        bucket[field] = round(bucket[field] + sign * record[field], 2)
+
+
+def record_delta(delta: dict, old: Optional[dict], new: Optional[dict]) -> bool:
+    """Add the change from record old to record new (either may be None) to delta; False if none"""
+    if old == new:
+        return False
+    if old is not None:
+        _add_record(delta, old, -1)
+    if new is not None:
+        _add_record(delta, new, 1)
+    return True
+
+
+def merge_rollup(rollup: dict, delta: dict, retention_days: int, now: Optional[datetime] = None) -> dict:
+    """
+    Fold a delta into a rollup shard. Counters that reach zero are dropped.
+    A shard may hold negative counts (a return counted in one shard and
+    retracted in another); only the sum over all shards is meaningful.
+    """
+    now = now or datetime.now()
+    rollup["total"] += delta["total"]
+    for field in VALUE_FIELDS:
+        rollup[field] = round(rollup[field] + delta[field], 2)
+    for dimension in DIMENSIONS:
+        counts = rollup["counts"].setdefault(dimension, {})
+        for key, count in delta["counts"][dimension].items():
+            counts[key] = counts.get(key, 0) + count
+            if counts[key] == 0:
+                del counts[key]
+    for day, change in delta["daily"].items():
+        bucket = rollup["daily"].setdefault(day, {"count": 0, **{field: 0.0 for field in VALUE_FIELDS}})
+        bucket["count"] += change["count"]
+        for field in VALUE_FIELDS:
+            bucket[field] = round(bucket[field] + change[field], 2)
+        if bucket["count"] == 0 and not any(bucket[field] for field in VALUE_FIELDS):
+            del rollup["daily"][day]
+    cutoff = (now - timedelta(days=retention_days)).strftime("%Y-%m-%d")
+    rollup["daily"] = {day: bucket for day, bucket in rollup["daily"].items() if day >= cutoff}
+    return rollup
+
+
+def combine_shards(shards: Iterable[dict], retention_days: int) -> dict:
+    combined = new_rollup()
+    for shard in shards:
+        merge_rollup(combined, shard, retention_days)
+    return combined
+
+
+def _breakdown(counts: dict, total: int, dimension: str) -> list:
+    rows = sorted(((key, count) for key, count in counts.items() if count > 0), key=lambda row: (-row[1], row[0]))
+    return [
+        {dimension: key, "count": count, "percentage": round(100 * count / total, 1) if total else 0.0}
+        for key, count in rows
+    ]
+
+
+def summarize_rollup(rollup: dict) -> dict:
+    """Totals and per-dimension breakdowns, largest first, shaped like the dashboard's statistics"""
+    total = rollup["total"]
+    return {
+        "total": total,
+        "total_value": rollup["value"],
+        "value_recovered": rollup["recovered"],
+        "estimated_recovery": rollup["estimated_recovery"],
+        **{f"by_{dimension}": _breakdown(rollup["counts"][dimension], total, dimension) for dimension in DIMENSIONS},
+    }
+
+
+def value_series(rollup: dict, period: str = "day", periods: int = 7, now: Optional[datetime] = None) -> list:
+    """Returns and value per day or ISO week (keyed by its Monday), oldest first, gaps filled with zeros"""
+    today = (now or datetime.now()).date()
+    if period == "week":
+        step = timedelta(weeks=1)
+        end = today - timedelta(days=today.weekday())
+    else:
+        step = timedelta(days=1)
+        end = today
+    starts = [end - step * offset for offset in range(periods - 1, -1, -1)]
+    series = {start.isoformat(): {"count": 0, **{field: 0.0 for field in VALUE_FIELDS}} for start in starts}
+    first = starts[0].isoformat()
+    for day, bucket in rollup["daily"].items():
+        if day < first:
+            continue
+        date = datetime.strptime(day, "%Y-%m-%d").date()
+        key = (date - timedelta(days=date.weekday()) if period == "week" else date).isoformat()
+        if key not in series:
+            continue  # dated in the future
+        series[key]["count"] += bucket["count"]
+        for field in VALUE_FIELDS:
+            series[key][field] = round(series[key][field] + bucket[field], 2)
+    return [{"period_start": key, **values} for key, values in series.items()]
@@ -0,0 +1,204 @@
+"""
+Compact per-user return aggregates.
+
+Instead of streaming every past return for a user, FirebaseClient keeps one
+aggregate document per user that is updated on every write. Rolling window
+counts are derived from per-day buckets (pruned to the longest window), so a
+fraud check costs a single document read regardless of history length.
+"""
+import json
+from datetime import datetime, timedelta
+from typing import Optional
+
+WINDOWS_DAYS = (30, 90, 365)
+FRAUD_STATUSES = ("Denied", "Fraud")
+
+
+def to_datetime(value) -> Optional[datetime]:
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        return value.replace(tzinfo=None)
+    try:
+        return datetime.fromisoformat(str(value)).replace(tzinfo=None)
+    except ValueError:
+        return None
+
+
+def to_float(value) -> float:
+    try:
+        return float(str(value).replace("$", "").replace(",", ""))
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def _is_fraud_flagged(fraud_analysis: dict) -> bool:
+    if not isinstance(fraud_analysis, dict):
+        return False
+    return bool(
+        fraud_analysis.get("is_fraudulent")
+        or fraud_analysis.get("risk_category") == "High"
+    )
+
+
+def slim_return_record(return_id: str, return_data: dict) -> dict:
+    """The few fields of a return that fraud scoring needs; photos and notes are dropped."""
+    details = return_data.get("product_details") or {}
+    purchased = to_datetime(return_data.get("date_of_purchase"))
+    returned = to_datetime(return_data.get("date_of_return")) or to_datetime(return_data.get("timestamp")) or datetime.now()
+    fraud_analysis = return_data.get("fraud_analysis") or {}
+    defect_analysis = return_data.get("defect_analysis") or {}
+    return {
+        "return_id": return_id,
+        "date": returned.strftime("%Y-%m-%d"),
+        "category": return_data.get("product_category") or details.get("Category") or defect_analysis.get("product_category") or "Unknown",
+        "price": to_float(return_data.get("original_price", details.get("Price"))),
+        "days_until_return": (returned - purchased).days if purchased else None,
+        "return_reason": return_data.get("return_reason"),
+        "condition": defect_analysis.get("condition_grade"),
+        "fraud_risk_score": fraud_analysis.get("risk_score"),
+        "fraud_flagged": _is_fraud_flagged(fraud_analysis) or return_data.get("status") in FRAUD_STATUSES,
+        "status": return_data.get("status"),
+    }
+
+
+def new_aggregate(user_id: str) -> dict:
+    return {
+        "user_id": user_id,
+        "total_returns": 0,
+        "total_value": 0.0,
+        "days_to_return": {"count": 0, "sum": 0, "min": None, "max": None},
+        "category_counts": {},
+        "daily": {},  # "YYYY-MM-DD" -> {"count": int, "value": float}
+        "fraud_flagged_return_ids": [],
+        "prior_fraud_flags": 0,
+        "recent_returns": [],
+    }
+
+
+def _prune_daily(aggregate: dict, now: datetime) -> None:
+    cutoff = (now - timedelta(days=max(WINDOWS_DAYS))).strftime("%Y-%m-%d")
+    aggregate["daily"] = {day: bucket for day, bucket in aggregate["daily"].items() if day >= cutoff}
+
+
+def _mark_fraud(aggregate: dict, return_id: str, recent_limit: int) -> None:
+    if return_id in aggregate["fraud_flagged_return_ids"]:
+        return
+    aggregate["prior_fraud_flags"] += 1
+    # Only ids are needed to avoid double counting a return that is re-flagged
+    aggregate["fraud_flagged_return_ids"] = (aggregate["fraud_flagged_return_ids"] + [return_id])[-recent_limit * 10:]
+
+
+def apply_return(aggregate: dict, record: dict, recent_limit: int = 10, now: Optional[datetime] = None) -> dict:
+    """Fold one newly saved return into the aggregate."""
+    now = now or datetime.now()
+    aggregate["total_returns"] += 1
+    aggregate["total_value"] = round(aggregate["total_value"] + record["price"], 2)
+
+    days = record["days_until_return"]
+    if days is not None:
+        stats = aggregate["days_to_return"]
+        stats["count"] += 1
+        stats["sum"] += days
+        stats["min"] = days if stats["min"] is None else min(stats["min"], days)
+        stats["max"] = days if stats["max"] is None else max(stats["max"], days)
+
+    category = record["category"]
+    aggregate["category_counts"][category] = aggregate["category_counts"].get(category, 0) + 1
+
+    bucket = aggregate["daily"].setdefault(record["date"], {"count": 0, "value": 0.0})
+    bucket["count"] += 1
+    bucket["value"] = round(bucket["value"] + record["price"], 2)
+    _prune_daily(aggregate, now)
+
+    if record["fraud_flagged"]:
+        _mark_fraud(aggregate, record["return_id"], recent_limit)
+
+    aggregate["recent_returns"] = (aggregate["recent_returns"] + [record])[-recent_limit:]
+    return aggregate
+
+
+def apply_status_update(aggregate: dict, return_id: str, status_update: dict, recent_limit: int = 10) -> dict:
+    """Reflect a status change (e.g. a later fraud decision) in the aggregate."""
+    fraud_analysis = status_update.get("fraud_analysis")
+    flagged = _is_fraud_flagged(fraud_analysis) or status_update.get("status") in FRAUD_STATUSES
+
+    for record in aggregate["recent_returns"]:
+        if record["return_id"] == return_id:
+            if "status" in status_update:
+                record["status"] = status_update["status"]
+            if isinstance(fraud_analysis, dict):
+                record["fraud_risk_score"] = fraud_analysis.get("risk_score", record["fraud_risk_score"])
+            record["fraud_flagged"] = record["fraud_flagged"] or flagged
+
+    if flagged:
+        _mark_fraud(aggregate, return_id, recent_limit)
+    return aggregate
+
+
+def exclude_return(aggregate: dict, return_id: str) -> dict:
+    """
+    A copy of the aggregate without one of its recent returns, e.g. the return
+    being analyzed when it was saved before the analysis ran. min and max days
+    to return cannot be unwound and are kept unless no return is left.
+    """
+    record = next((r for r in aggregate["recent_returns"] if r["return_id"] == return_id), None)
+    if record is None:
+        return aggregate
+    aggregate = json.loads(json.dumps(aggregate))
+    aggregate["total_returns"] -= 1
+    aggregate["total_value"] = round(aggregate["total_value"] - record["price"], 2)
+
+    days = record["days_until_return"]
+    stats = aggregate["days_to_return"]
+    if days is not None and stats["count"]:
+        stats["count"] -= 1
+        stats["sum"] -= days
+        if not stats["count"]:
+            stats["min"] = stats["max"] = None
+
+    counts = aggregate["category_counts"]
+    if counts.get(record["category"]):
+        counts[record["category"]] -= 1
+        if not counts[record["category"]]:
+            del counts[record["category"]]
+
+    bucket = aggregate["daily"].get(record["date"])
+    if bucket:
+        bucket["count"] -= 1
+        bucket["value"] = round(bucket["value"] - record["price"], 2)
+        if bucket["count"] <= 0:
+            del aggregate["daily"][record["date"]]
+
+    if return_id in aggregate["fraud_flagged_return_ids"]:
+        aggregate["fraud_flagged_return_ids"].remove(return_id)
+        aggregate["prior_fraud_flags"] -= 1
+    aggregate["recent_returns"] = [r for r in aggregate["recent_returns"] if r["return_id"] != return_id]
+    return aggregate
+
+
+def summarize_aggregate(aggregate: dict, now: Optional[datetime] = None) -> dict:
+    """Compact history payload for fraud scoring, with rolling window totals."""
+    now = now or datetime.now()
+    windows = {}
+    for days in WINDOWS_DAYS:
+        cutoff = (now - timedelta(days=days)).strftime("%Y-%m-%d")
+        buckets = [bucket for day, bucket in aggregate["daily"].items() if day >= cutoff]
+        windows[f"returns_{days}d"] = sum(bucket["count"] for bucket in buckets)
+        windows[f"value_{days}d"] = round(sum(bucket["value"] for bucket in buckets), 2)
+
+    stats = aggregate["days_to_return"]
+    return {
+        "user_id": aggregate["user_id"],
+        "total_returns": aggregate["total_returns"],
+        "total_value": aggregate["total_value"],
+        **windows,
+        "days_to_return": {
+            "mean": round(stats["sum"] / stats["count"], 1) if stats["count"] else None,
+            "min": stats["min"],
+            "max": stats["max"],
+        },
+        "category_counts": aggregate["category_counts"],
+        "prior_fraud_flags": aggregate["prior_fraud_flags"],
+        "recent_returns": aggregate["recent_returns"],
+    }
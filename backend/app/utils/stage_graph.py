@@ -0,0 +1,208 @@
+import asyncio
+import time
+from collections import defaultdict, deque
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence
+from .deadline import Deadline
+from .metrics import observe_stage
+from .tracing import span
+
+
+class StageTimingStats:
+    """Keeps a rolling window of stage durations so p50/p99 can be reported."""
+
+    def __init__(self, window: int = 1000):
+        self.window = window
+        self.samples = defaultdict(lambda: deque(maxlen=self.window))
+
+    def record(self, stage: str, seconds: float) -> None:
+        self.samples[stage].append(seconds)
+
+    @staticmethod
+    def _percentile(values: List[float], pct: float) -> float:
+        ordered = sorted(values)
+        index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+        return ordered[index]
+
+    def summary(self) -> dict:
+        """Return count/p50/p99 (in milliseconds) for every recorded stage."""
+        result = {}
+        for stage, values in self.samples.items():
+            if not values:
+                continue
+            result[stage] = {
+                'count': len(values),
+                'p50_ms': round(self._percentile(list(values), 50) * 1000, 2),
+                'p99_ms': round(self._percentile(list(values), 99) * 1000, 2),
+            }
+        return result
+
+
+# Shared across requests so the endpoint latency distribution can be inspected
+stage_timing_stats = StageTimingStats()
+
+
+# Stage outcomes reported in StageGraph.statuses
+COMPLETED = 'completed'
+SKIPPED = 'skipped'  # made moot by an earlier result (see skip_when)
+TIMED_OUT = 'timed_out'  # still running when the deadline expired
+
+
+class StageGraph:
+    """
+    Runs named async stages concurrently, starting each stage as soon as the
+    stages it depends on have resolved. Results of the dependencies are passed
+    to the stage function as positional arguments, in declaration order.
+
+    With a deadline, stages still pending when it expires are cancelled and
+    marked timed_out, as are stages that raise asyncio.TimeoutError once it
+    has expired (a model call cut short by it); skip_when() cancels stages an earlier result makes
+    moot. Either way the stage's result is None, stages that depend on it are
+    given the same status, and run() still returns the partial results.
+    A stage may also wait for optional dependencies, whose results it is
+    given as None when they were skipped or timed out.
+    """
+
+    def __init__(
+        self,
+        name: str = "pipeline",
+        stats: StageTimingStats = stage_timing_stats,
+        on_stage_done: Optional[Callable[[str, Any], Awaitable[None]]] = None
+    ):
+        self.name = name
+        self.stats = stats
+        # Awaited with (stage_name, result) as each stage succeeds, e.g. to report progress
+        self.on_stage_done = on_stage_done
+        self.stages: Dict[str, tuple] = {}
+        self.short_circuits: Dict[str, List[tuple]] = {}
+        self.timings: Dict[str, dict] = {}
+        self.statuses: Dict[str, str] = {}
+
+    def add_stage(
+        self,
+        name: str,
+        func: Callable[..., Awaitable[Any]],
+        depends_on: Sequence[str] = (),
+        optional: Sequence[str] = ()
+    ) -> "StageGraph":
+        """func is called with the results of depends_on, then of optional"""
+        if name in self.stages:
+            raise ValueError(f"Stage '{name}' is already defined")
+        self.stages[name] = (func, tuple(depends_on), tuple(optional))
+        return self
+
+    def skip_when(
+        self,
+        stage: str,
+        predicate: Callable[[Any], bool],
+        skip: Sequence[str]
+    ) -> "StageGraph":
+        """Once `stage` completes with a result the predicate accepts, cancel the `skip` stages"""
+        self.short_circuits.setdefault(stage, []).append((predicate, tuple(skip)))
+        return self
+
+    def _topological_order(self) -> List[str]:
+        order, visiting, done = [], set(), set()
+
+        def visit(name: str):
+            if name in done:
+                return
+            if name in visiting:
+                raise ValueError(f"Stage graph has a cycle through '{name}'")
+            if name not in self.stages:
+                raise ValueError(f"Unknown stage dependency '{name}'")
+            visiting.add(name)
+            for dependency in self.stages[name][1] + self.stages[name][2]:
+                visit(dependency)
+            visiting.discard(name)
+            done.add(name)
+            order.append(name)
+
+        for name in self.stages:
+            visit(name)
+        return order
+
+    async def run(self, deadline: Optional[Deadline] = None) -> Dict[str, Any]:
+        """
+        Execute every stage and return a mapping of stage name to result
+        (None for stages that were skipped or timed out).
+        """
+        tasks: Dict[str, asyncio.Task] = {}
+        callbacks: List[asyncio.Task] = []
+        graph_start = time.perf_counter()
+
+        def cancel(names, status: str) -> None:
+            for name in names:
+                if name not in self.statuses and not tasks[name].done():
+                    self.statuses[name] = status
+                    tasks[name].cancel()
+
+        async def notify(name: str, result):
+            try:
+                await self.on_stage_done(name, result)
+            except Exception as e:
+                print(f"Stage progress callback failed for '{name}': {str(e)}")
+
+        async def run_stage(name: str):
+            func, dependencies, optional = self.stages[name]
+            dependency_results = []
+            for dependency in dependencies:
+                await asyncio.wait([tasks[dependency]])
+                if tasks[dependency].cancelled() or self.statuses.get(dependency) == TIMED_OUT:
+                    # Nothing to run on; inherit why the dependency did not finish
+                    self.statuses[name] = self.statuses.get(dependency, SKIPPED)
+                    return None
+                dependency_results.append(tasks[dependency].result())
+            for dependency in optional:
+                await asyncio.wait([tasks[dependency]])
+                finished = not tasks[dependency].cancelled() and self.statuses.get(dependency) == COMPLETED
+                dependency_results.append(tasks[dependency].result() if finished else None)
+            start = time.perf_counter()
+            try:
+                with observe_stage(name, self.name), span(f"stage.{name}"):
+                    result = await func(*dependency_results)
+            except asyncio.TimeoutError:
+                if deadline is None or not deadline.expired:
+                    raise
+                self.statuses[name] = TIMED_OUT
+                return None
+            finally:
+                end = time.perf_counter()
+                self.timings[name] = {
+                    'started_at_ms': round((start - graph_start) * 1000, 2),
+                    'duration_ms': round((end - start) * 1000, 2),
+                }
+                self.stats.record(f"{self.name}.{name}", end - start)
+            self.statuses[name] = COMPLETED
+            for predicate, skip in self.short_circuits.get(name, ()):
+                if predicate(result):
+                    cancel(skip, SKIPPED)
+            if self.on_stage_done is not None:
+                # Reported in the background so dependent stages are not delayed
+                callbacks.append(asyncio.create_task(notify(name, result)))
+            return result
+
+        for name in self._topological_order():
+            tasks[name] = asyncio.create_task(run_stage(name))
+
+        try:
+            timeout = deadline.remaining() if deadline is not None else None
+            if not tasks:
+                return {}
+            _, pending = await asyncio.wait(tasks.values(), timeout=timeout, return_when=asyncio.FIRST_EXCEPTION)
+            failed = [task for task in tasks.values() if task.done() and not task.cancelled() and task.exception()]
+            if failed:
+                raise failed[0].exception()
+            if pending:
+                cancel([name for name, task in tasks.items() if task in pending], TIMED_OUT)
+                await asyncio.wait(pending)
+        except BaseException:
+            for task in tasks.values():
+                task.cancel()
+            raise
+        finally:
+            total = time.perf_counter() - graph_start
+            self.timings['total'] = {'started_at_ms': 0.0, 'duration_ms': round(total * 1000, 2)}
+            self.stats.record(f"{self.name}.total", total)
+            await asyncio.gather(*callbacks, return_exceptions=True)
+
+        return {name: None if task.cancelled() else task.result() for name, task in tasks.items()}
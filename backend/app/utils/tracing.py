@@ -0,0 +1,121 @@
+"""
+Lightweight per-request span tracing.
+
+A Trace is attached to the request through a ContextVar, so tasks spawned
+while serving the request (pipeline stages, model calls) add their spans to
+it and pick up the enclosing span as their parent. Finished traces are kept
+in a bounded in-memory buffer and can be dumped as JSON by trace id.
+"""
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import List, Optional
+
+
+class Trace:
+    def __init__(self, name: str, max_spans: int = 256, **attributes):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.name = name
+        self.attributes = attributes
+        self.max_spans = max_spans
+        self.started_at = time.time()
+        self._start = time.perf_counter()
+        self.duration_ms = None
+        self.spans: List[dict] = []
+        self.dropped_spans = 0
+        self._next_span_id = 0
+
+    def elapsed_ms(self) -> float:
+        return round((time.perf_counter() - self._start) * 1000, 3)
+
+    def new_span_id(self) -> int:
+        self._next_span_id += 1
+        return self._next_span_id
+
+    def add_span(self, span: dict) -> None:
+        if len(self.spans) < self.max_spans:
+            self.spans.append(span)
+        else:
+            self.dropped_spans += 1
+
+    def finish(self) -> None:
+        self.duration_ms = self.elapsed_ms()
+
+    def to_dict(self) -> dict:
+        return {
+            'trace_id': self.trace_id,
+            'name': self.name,
+            'attributes': self.attributes,
+            'started_at': self.started_at,
+            'duration_ms': self.duration_ms,
+            'spans': sorted(self.spans, key=lambda span: span['start_ms']),
+            'dropped_spans': self.dropped_spans,
+        }
+
+
+current_trace: ContextVar[Optional[Trace]] = ContextVar('current_trace', default=None)
+current_span_id: ContextVar[Optional[int]] = ContextVar('current_span_id', default=None)
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """Record a span on the current trace; a no-op outside a traced request"""
+    trace = current_trace.get()
+    if trace is None:
+        yield
+        return
+    span_id = trace.new_span_id()
+    record = {
+        'span_id': span_id,
+        'parent_id': current_span_id.get(),
+        'name': name,
+        'start_ms': trace.elapsed_ms(),
+        'attributes': attributes,
+    }
+    token = current_span_id.set(span_id)
+    try:
+        yield record['attributes']
+    except BaseException as e:
+        record['error'] = type(e).__name__
+        raise
+    finally:
+        record['duration_ms'] = round(trace.elapsed_ms() - record['start_ms'], 3)
+        current_span_id.reset(token)
+        trace.add_span(record)
+
+
+class TraceRecorder:
+    """Keeps the most recent finished traces for inspection."""
+
+    def __init__(self, max_traces: int = 256):
+        self.max_traces = max_traces
+        self._traces: "OrderedDict[str, Trace]" = OrderedDict()
+
+    @contextmanager
+    def trace(self, name: str, max_spans: int = 256, **attributes):
+        """Start a trace for the current context and keep it once it finishes"""
+        trace = Trace(name, max_spans, **attributes)
+        token = current_trace.set(trace)
+        span_token = current_span_id.set(None)
+        try:
+            yield trace
+        finally:
+            trace.finish()
+            current_span_id.reset(span_token)
+            current_trace.reset(token)
+            self._traces[trace.trace_id] = trace
+            while len(self._traces) > self.max_traces:
+                self._traces.popitem(last=False)
+
+    def get(self, trace_id: str) -> Optional[dict]:
+        trace = self._traces.get(trace_id)
+        return trace.to_dict() if trace is not None else None
+
+    def recent(self, limit: int = 20) -> List[dict]:
+        traces = list(self._traces.values())[-limit:]
+        return [
+            {'trace_id': t.trace_id, 'name': t.name, 'duration_ms': t.duration_ms, 'spans': len(t.spans)}
+            for t in reversed(traces)
+        ]
@@ -1,126 +1,381 @@
-import os
-import json
+"""
+Voice front end for customer returns.
+
+Prompts are synthesized once with gTTS and kept under a content-hashed temp
+directory, so a phrase is fetched from the network at most once per machine
+and every session plays the same file without writing or deleting anything.
+The fixed prompts are prewarmed at startup, and the next prompt is
+synthesized while the microphone is still listening for the current answer.
+Dates are parsed locally and only sent to Gemini when that fails. Sessions
+are coroutines over a channel (speaker + microphone), so one process can
+serve many callers at once.
+"""
 import asyncio
-import gtts
-import playsound
-import speech_recognition as sr
-from datetime import datetime
-from firebase_client import FirebaseClient
+import hashlib
+import os
+import re
+import tempfile
+import threading
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
 from dotenv import load_dotenv
-import google.generativeai as genai
+from app.config import settings
+from app.dependencies import get_firebase
+from app.utils.gemini_client import get_gemini_client
 
 load_dotenv()
 
-class VoiceAssistant:
-    def __init__(self):
-        api_key = os.getenv("GOOGLE_API_KEY")
-        if not api_key:
-            raise Exception("GOOGLE_API_KEY environment variable not set")
-        genai.configure(api_key=api_key)
+PROMPTS = {
+    'start': "Do you want to start a return? Say 'yes' to begin.",
+    'order_id': "Please provide your order ID.",
+    'customer_name': "Your name?",
+    'customer_contact': "Your contact info?",
+    'product_name': "Product name?",
+    'Size': "Product size?",
+    'Colour': "Product colour?",
+    'SKU': "Product SKU?",
+    'Category': "Product category?",
+    'Price': "Product price?",
+    'date_of_purchase': "Purchase date?",
+    'return_reason': "Return reason? (Didn't fit, defective, changed mind, wardrobing)",
+    'user_submitted_notes': "Any notes on the product condition?",
+    'photos': "If you have photos of the product, please upload them via the app.",
+    'invalid_date': "Invalid date format. Please enter again.",
+    'submitted': "Your return request has been submitted.",
+    'declined': "Okay, let me know if you need help in the future.",
+}
+# Questions asked in order; product detail answers go under product_details
+QUESTIONS = [
+    'order_id', 'customer_name', 'customer_contact', 'product_name',
+    'Size', 'Colour', 'SKU', 'Category', 'Price',
+    'date_of_purchase', 'return_reason', 'user_submitted_notes',
+]
+PRODUCT_DETAILS = ('Size', 'Colour', 'SKU', 'Category', 'Price')
+DEFAULT_GREETING = (
+    "Hi! Thanks for calling. Returning items responsibly lets us resell, refurbish "
+    "or recycle them instead of sending them to landfill."
+)
+GREETING_PROMPT = (
+    "Short greeting and educate the user on the importance of responsible returns and recycling, "
+    "keeping it short and engaging. Do not use any emoji. "
+    'Respond as JSON: {"message": "the greeting"}'
+)
+
+DATE_FORMATS = (
+    "%Y-%m-%d", "%Y/%m/%d", "%m/%d/%Y", "%m-%d-%Y", "%m/%d/%y", "%d.%m.%Y",
+    "%B %d %Y", "%b %d %Y", "%d %B %Y", "%d %b %Y",
+)
+DATE_FORMATS_WITHOUT_YEAR = ("%B %d", "%b %d", "%d %B", "%d %b")
+ORDINAL_WORDS = {
+    'first': 1, 'second': 2, 'third': 3, 'fourth': 4, 'fifth': 5, 'sixth': 6, 'seventh': 7,
+    'eighth': 8, 'ninth': 9, 'tenth': 10, 'eleventh': 11, 'twelfth': 12, 'thirteenth': 13,
+    'fourteenth': 14, 'fifteenth': 15, 'sixteenth': 16, 'seventeenth': 17, 'eighteenth': 18,
+    'nineteenth': 19, 'twentieth': 20, 'thirtieth': 30,
+}
+NUMBER_WORDS = {'a': 1, 'one': 1, 'two': 2, 'three': 3, 'four': 4, 'five': 5, 'six': 6, 'seven': 7,
+                'eight': 8, 'nine': 9, 'ten': 10, 'twenty': 20, 'thirty': 30}
+RELATIVE_DATE = re.compile(r"^(\d+|[a-z]+) (day|week|month)s? ago$")
+
+
+def _replace_ordinal_words(text: str) -> str:
+    # "twenty first" -> "21", "fifth" -> "5"
+    text = re.sub(
+        r"\b(twenty|thirty)[ -](\w+)\b",
+        lambda m: str(NUMBER_WORDS[m.group(1)] + ORDINAL_WORDS[m.group(2)])
+        if ORDINAL_WORDS.get(m.group(2), 10) < 10 else m.group(0),
+        text
+    )
+    return re.sub(r"\b(\w+)\b", lambda m: str(ORDINAL_WORDS.get(m.group(1), m.group(1))), text)
+
+
+def parse_spoken_date(text: str, today: Optional[datetime] = None) -> Optional[str]:
+    """
+    Parse what speech recognition (or typing) gives for a date: "2024-03-05",
+    "3/5/2024", "March 5th", "the fifth of March 2024", "yesterday",
+    "two weeks ago". Returns YYYY-MM-DD, or None when it cannot tell.
+    """
+    today = today or datetime.now()
+    text = text.lower().strip().rstrip('.')
+    text = re.sub(r"\b(the|of|on)\b|,", " ", text)
+    text = re.sub(r"(\d+)(st|nd|rd|th)\b", r"\1", text)
+    text = " ".join(_replace_ordinal_words(text).split())
+
+    if text == "today":
+        return today.strftime("%Y-%m-%d")
+    if text == "yesterday":
+        return (today - timedelta(days=1)).strftime("%Y-%m-%d")
+    if text == "last week":
+        return (today - timedelta(weeks=1)).strftime("%Y-%m-%d")
+    relative = RELATIVE_DATE.match(text)
+    if relative:
+        count = int(relative.group(1)) if relative.group(1).isdigit() else NUMBER_WORDS.get(relative.group(1))
+        if count is None:
+            return None
+        days = {'day': 1, 'week': 7, 'month': 30}[relative.group(2)] * count
+        return (today - timedelta(days=days)).strftime("%Y-%m-%d")
+
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(text, date_format).strftime("%Y-%m-%d")
+        except ValueError:
+            pass
+    for date_format in DATE_FORMATS_WITHOUT_YEAR:
+        try:
+            parsed = datetime.strptime(f"{text} {today.year}", f"{date_format} %Y")
+        except ValueError:
+            continue
+        # A purchase date without a year is the most recent one that has passed
+        if parsed > today:
+            parsed = parsed.replace(year=today.year - 1)
+        return parsed.strftime("%Y-%m-%d")
+    return None
+
+
+class PhraseAudioCache:
+    """
+    gTTS audio per phrase, stored as <sha256 of language and text>.mp3 under
+    one directory and indexed in memory. Concurrent requests for a phrase
+    share one synthesis; files are written under a temporary name and
+    renamed, so another session or process never plays a partial file.
+    """
+
+    def __init__(self, directory: Optional[str] = None, language: str = "en"):
+        self.directory = directory or os.path.join(tempfile.gettempdir(), "return_assistant_tts")
+        os.makedirs(self.directory, exist_ok=True)
+        self.language = language
+        self._paths: Dict[str, str] = {}
+        self._pending: Dict[str, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def path_for(self, text: str) -> str:
+        digest = hashlib.sha256(f"{self.language}\0{text}".encode()).hexdigest()
+        return os.path.join(self.directory, f"{digest}.mp3")
 
-        self.gemini = genai.GenerativeModel('gemini-2.0-flash')
+    def _synthesize(self, text: str, path: str) -> None:
+        import gtts
+        partial = f"{path}.{os.getpid()}.{threading.get_ident()}.part"
+        gtts.gTTS(text, lang=self.language).save(partial)
+        os.replace(partial, path)
+
+    async def _load(self, text: str) -> str:
+        path = self.path_for(text)
+        if os.path.exists(path):
+            self.hits += 1
+        else:
+            self.misses += 1
+            await asyncio.to_thread(self._synthesize, text, path)
+        self._paths[text] = path
+        return path
+
+    async def get(self, text: str) -> str:
+        """Path of the phrase's audio file, synthesizing it on first use"""
+        path = self._paths.get(text)
+        if path is not None:
+            self.hits += 1
+            return path
+        pending = self._pending.get(text)
+        if pending is None:
+            pending = self._pending[text] = asyncio.ensure_future(self._load(text))
+            pending.add_done_callback(lambda _: self._pending.pop(text, None))
+        return await asyncio.shield(pending)
+
+    def prefetch(self, text: str) -> None:
+        """Start synthesizing a phrase in the background"""
+        if text not in self._paths and text not in self._pending:
+            task = asyncio.ensure_future(self.get(text))
+            task.add_done_callback(lambda t: t.cancelled() or t.exception() and print(
+                f"Text-to-speech prefetch failed: {str(t.exception())}"
+            ))
+
+    async def prewarm(self, phrases: List[str]) -> None:
+        results = await asyncio.gather(*[self.get(phrase) for phrase in phrases], return_exceptions=True)
+        failed = [result for result in results if isinstance(result, Exception)]
+        if failed:
+            print(f"Text-to-speech prewarm failed for {len(failed)} phrases: {str(failed[0])}")
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'phrases': len(self._paths),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+class LocalAudioChannel:
+    """This machine's speaker and microphone, with typed input as the fallback"""
+
+    def __init__(self, device_index: Optional[int] = None, listen_timeout: Optional[float] = None):
+        import speech_recognition as sr
+        self.sr = sr
         self.recognizer = sr.Recognizer()
-        self.firebase_client = FirebaseClient()
-
-    def text_to_speech(self, text: str):
-        """Convert text to speech using gTTS."""
-        filename = "output.mp3"
-        tts = gtts.gTTS(text)
-        tts.save(filename)
-        playsound.playsound(filename)
-        os.remove(filename)
-
-    def get_user_input(self, prompt: str) -> str:
-        """Get user input via voice first; if unsuccessful, fall back to text input."""
-        print(f"Assistant: {prompt}")
-        self.text_to_speech(prompt)
-
-        with sr.Microphone(device_index=0) as source:
+        self.device_index = settings.VOICE_MIC_DEVICE_INDEX if device_index is None else device_index
+        self.listen_timeout = listen_timeout or settings.VOICE_LISTEN_TIMEOUT
+
+    async def play(self, path: str) -> None:
+        import playsound
+        await asyncio.to_thread(playsound.playsound, path)
+
+    def _listen(self) -> str:
+        with self.sr.Microphone(device_index=self.device_index) as source:
             print("Listening... (speak now)")
             self.recognizer.adjust_for_ambient_noise(source)
-
             try:
-                audio = self.recognizer.listen(source, timeout=5)
-                user_input = self.recognizer.recognize_google(audio).strip()
-                print(f"User: {user_input}")
-                return user_input
-            except sr.UnknownValueError:
+                audio = self.recognizer.listen(source, timeout=self.listen_timeout)
+                return self.recognizer.recognize_google(audio).strip()
+            except self.sr.UnknownValueError:
                 print("Couldn't understand. Switching to text input.")
-            except sr.RequestError:
+            except self.sr.RequestError:
                 print("Voice recognition error. Switching to text input.")
-            except sr.WaitTimeoutError:
+            except self.sr.WaitTimeoutError:
                 print("No response detected. Switching to text input.")
+        return ""
+
+    async def listen(self) -> str:
+        """The caller's spoken answer, or "" when nothing usable was heard"""
+        return await asyncio.to_thread(self._listen)
 
-        user_input = input("Type your response: ").strip()
-        print(f"User: {user_input}")
-        return user_input
-    
-    def get_valid_date(self, prompt: str) -> str:
-        """Ensure user inputs a valid date format (YYYY-MM-DD)."""
+    async def read_text(self) -> str:
+        return (await asyncio.to_thread(input, "Type your response: ")).strip()
+
+
+class VoiceSession:
+    """One caller's conversation over a channel"""
+
+    def __init__(self, assistant: "VoiceAssistant", channel):
+        self.assistant = assistant
+        self.channel = channel
+
+    async def say(self, text: str) -> None:
+        print(f"Assistant: {text}")
+        await self.channel.play(await self.assistant.tts.get(text))
+
+    async def ask(self, prompt: str, next_prompt: Optional[str] = None) -> str:
+        """Speak a prompt and get the answer by voice, falling back to typed input"""
+        await self.say(prompt)
+        if next_prompt:
+            # Synthesized while the caller is answering
+            self.assistant.tts.prefetch(next_prompt)
+        answer = await self.channel.listen()
+        if not answer:
+            answer = await self.channel.read_text()
+        print(f"User: {answer}")
+        return answer
+
+    async def ask_date(self, prompt: str, next_prompt: Optional[str] = None) -> str:
+        """Ask until the answer parses as a date; returns YYYY-MM-DD"""
         while True:
-            user_input = self.get_user_input(prompt)
-            try:
-                date_transform = self.gemini.generate_content(
-                    f"Return this user input {user_input} as a valid output in this date format: %Y-%m-%d"
-                ).text
-                valid_date = datetime.strptime(date_transform, "%Y-%m-%d").strftime("%Y-%m-%d")
-                return valid_date
-            except ValueError:
-                print("Invalid date format. Please enter again (YYYY-MM-DD).")
-                self.text_to_speech("Invalid date format. Please enter again.")
-    
-    async def collect_return_info(self):
-        """Interact with user to collect return details."""       
-        order_id = self.get_user_input("Please provide your order ID.")
-        customer_name = self.get_user_input("Your name?")
-        customer_contact = self.get_user_input("Your contact info?")
-        product_name = self.get_user_input("Product name?")
-        product_details = {
-            "Size": self.get_user_input("Product size?"),
-            "Colour": self.get_user_input("Product colour?"),
-            "SKU": self.get_user_input("Product SKU?"),
-            "Category": self.get_user_input("Product category?"),
-            "Price": self.get_user_input("Product price?")
-        }
-        date_of_purchase = self.get_valid_date("Purchase date?") 
-        date_of_return = datetime.now().strftime("%Y-%m-%d")
-        return_reason = self.get_user_input("Return reason? (Didn't fit, defective, changed mind, wardrobing)")
-        
-        user_notes = self.get_user_input("Any notes on the product condition?")
-        
-        photos = []  # Placeholder for photo uploads
-        self.text_to_speech("If you have photos of the product, please upload them via the app.")
-        
+            answer = await self.ask(prompt, next_prompt)
+            date = parse_spoken_date(answer) or await self.assistant.parse_date_with_gemini(answer)
+            if date:
+                return date
+            print("Invalid date format. Please enter again (YYYY-MM-DD).")
+            await self.say(PROMPTS['invalid_date'])
+
+    async def collect_return_info(self) -> str:
+        """Interact with user to collect return details."""
+        answers = {}
+        for position, field in enumerate(QUESTIONS):
+            next_prompt = PROMPTS[QUESTIONS[position + 1]] if position + 1 < len(QUESTIONS) else PROMPTS['photos']
+            if field == 'date_of_purchase':
+                answers[field] = await self.ask_date(PROMPTS[field], next_prompt)
+            else:
+                answers[field] = await self.ask(PROMPTS[field], next_prompt)
+
+        await self.say(PROMPTS['photos'])
         return_data = {
-            "order_id": order_id,
-            "customer_name": customer_name,
-            "customer_contact": customer_contact,
-            "product_name": product_name,
-            "product_details": product_details,
-            "date_of_purchase": date_of_purchase,
-            "date_of_return": date_of_return,
-            "return_reason": return_reason,
-            "photos": photos,
-            "user_submitted_notes": user_notes
+            "order_id": answers['order_id'],
+            "customer_name": answers['customer_name'],
+            "customer_contact": answers['customer_contact'],
+            "product_name": answers['product_name'],
+            "product_details": {name: answers[name] for name in PRODUCT_DETAILS},
+            "date_of_purchase": answers['date_of_purchase'],
+            "date_of_return": datetime.now().strftime("%Y-%m-%d"),
+            "return_reason": answers['return_reason'],
+            "photos": [],  # Placeholder for photo uploads
+            "user_submitted_notes": answers['user_submitted_notes']
         }
-        
-        return_id = await self.firebase_client.save_return_request(return_data)
-        print(f"Assistent: Your return request has been submitted. Your return ID is {return_id}. It will be reviewed shortly.")
-        self.text_to_speech(f"Your return request has been submitted. Your return ID is {return_id}. It will be reviewed shortly.")
-    
-    async def run(self):
-        """Main assistant loop."""
-        recycling_message = self.gemini.generate_content(
-            "Short greeting and educate the user on the importance of responsible returns and recycling, keeping it short and engaging. Do not use any emoji."
-        ).text
-        print("Assistent: ", recycling_message)
-        self.text_to_speech(recycling_message)
-        start_return = self.get_user_input("Do you want to start a return? Say 'yes' to begin.")
-        if start_return.lower() in ["yes", "yeah", "sure"]:
+
+        return_id = await self.assistant.firebase.save_return_request(return_data)
+        await self.assistant.firebase.flush()
+        # The return ID part is synthesized while the fixed sentence plays
+        details = f"Your return ID is {return_id}. It will be reviewed shortly."
+        self.assistant.tts.prefetch(details)
+        await self.say(PROMPTS['submitted'])
+        await self.say(details)
+        return return_id
+
+    async def run(self) -> None:
+        await self.say(await self.assistant.greeting())
+        start_return = await self.ask(PROMPTS['start'], next_prompt=PROMPTS[QUESTIONS[0]])
+        if start_return.lower().strip(" .!") in ["yes", "yeah", "sure"]:
             await self.collect_return_info()
         else:
-            self.text_to_speech("Okay, let me know if you need help in the future.")
+            await self.say(PROMPTS['declined'])
 
-if __name__ == "__main__":
+
+class VoiceAssistant:
+    """Shared state for every voice session: phrase audio, Gemini and the return store"""
+
+    def __init__(self, tts: Optional[PhraseAudioCache] = None):
+        self.tts = tts or PhraseAudioCache(settings.VOICE_TTS_CACHE_DIR or None, settings.VOICE_LANGUAGE)
+        self.gemini = get_gemini_client()
+        self.firebase = get_firebase()
+        self._greeting: Optional[asyncio.Future] = None
+
+    async def greeting(self) -> str:
+        """Generated once per process and shared by every session"""
+        if self._greeting is None:
+            self._greeting = asyncio.ensure_future(self._generate_greeting())
+        return await asyncio.shield(self._greeting)
+
+    async def _generate_greeting(self) -> str:
+        result = await self.gemini.analyze_content(GREETING_PROMPT, prompt_name="voice.greeting")
+        if isinstance(result, dict) and result.get('message'):
+            return result['message']
+        return DEFAULT_GREETING
+
+    async def prewarm(self) -> None:
+        """Synthesize the greeting and every fixed prompt before the first caller"""
+        await self.tts.prewarm([await self.greeting(), *PROMPTS.values()])
+
+    async def parse_date_with_gemini(self, user_input: str) -> Optional[str]:
+        """Slow path for dates the local parser cannot read"""
+        result = await self.gemini.analyze_content(
+            f"Today is {datetime.now().strftime('%Y-%m-%d')}. Return this user input {user_input!r} "
+            'as a date. Respond as JSON: {"date": "YYYY-MM-DD"}, or {"date": null} if it is not a date.',
+            temperature=0.0,
+            prompt_name="voice.parse_date"
+        )
+        try:
+            return datetime.strptime(str(result.get('date')), "%Y-%m-%d").strftime("%Y-%m-%d")
+        except (AttributeError, ValueError):
+            return None
+
+    async def handle_call(self, channel) -> None:
+        try:
+            await VoiceSession(self, channel).run()
+        except Exception as e:
+            print(f"Voice session failed: {str(e)}")
+
+    async def serve(self, channels) -> None:
+        """Run one session per channel concurrently"""
+        await asyncio.gather(*[self.handle_call(channel) for channel in channels])
+
+    async def close(self) -> None:
+        await self.firebase.close()
+
+
+async def main():
     assistant = VoiceAssistant()
-    asyncio.run(assistant.run())
\ No newline at end of file
+    await assistant.prewarm()
+    try:
+        await assistant.handle_call(LocalAudioChannel())
+    finally:
+        await assistant.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,28 @@
+"""
+Standalone analysis worker that drains the local job queue.
+
+Run from the backend directory with `python -m app.worker`, and set
+JOB_WORKERS_IN_PROCESS=0 on the API so only this process consumes jobs.
+"""
+import asyncio
+from .config import settings
+from .dependencies import get_job_queue, peek
+from .main import process_analysis_job
+from .utils.job_queue import JobWorkerPool
+
+async def run_worker():
+    pool = JobWorkerPool(
+        get_job_queue(), process_analysis_job, settings.JOB_WORKER_CONCURRENCY,
+        lease_seconds=settings.JOB_LEASE_SECONDS
+    )
+    pool.start()
+    print(f"Analysis worker started with {settings.JOB_WORKER_CONCURRENCY} slots on {settings.JOB_QUEUE_PATH}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await pool.stop()
+        if peek('firebase') is not None:
+            await peek('firebase').close()
+
+if __name__ == "__main__":
+    asyncio.run(run_worker())
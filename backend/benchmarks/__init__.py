@@ -0,0 +1,14 @@
+"""
+Offline benchmark suite. Everything runs against local stand-ins, so the
+settings below only need to exist; they are set before `app` is imported.
+"""
+import os
+import tempfile
+
+os.environ.setdefault("GOOGLE_API_KEY", "benchmark")
+os.environ.setdefault("FIREBASE_CREDENTIALS", "benchmark")
+os.environ.setdefault("PERSISTENCE_BACKEND", "memory")
+os.environ.setdefault("JOB_QUEUE_PATH", ":memory:")
+os.environ.setdefault("JOB_WORKERS_IN_PROCESS", "0")
+os.environ.setdefault("RESPONSE_CACHE_ENABLED", "false")
+os.environ.setdefault("BLOB_STORE_PATH", tempfile.mkdtemp(prefix="benchmark-blobs-"))
@@ -0,0 +1,234 @@
+"""
+Local stand-ins for Gemini and Firestore with configurable latency,
+error rates and canned responses.
+
+FakeGeminiClient subclasses GeminiClient and only replaces the network call,
+so the response cache, scheduler, retries, token accounting and metrics are
+all exercised as in production. LatencyStore wraps the in-memory SQLite
+store with the same kind of latency/error injection for persistence.
+"""
+import asyncio
+import json
+import math
+import random
+import time
+from types import SimpleNamespace
+from typing import List, Optional, Tuple
+
+from google.api_core import exceptions as api_exceptions
+
+from app.utils.gemini_client import GeminiClient
+from app.utils.model_scheduler import ModelCallScheduler
+from app.utils.persistence import ReturnStore, SQLiteStore, Write
+
+
+class LatencyDistribution:
+    """
+    Lognormal latency given its median and p99 in seconds, which is how
+    model and database latencies are usually quoted. p99 == median gives a
+    fixed latency.
+    """
+
+    def __init__(self, median: float, p99: Optional[float] = None, rng: random.Random = None):
+        self.median = median
+        self.p99 = p99 if p99 is not None else median
+        self.rng = rng or random.Random()
+        self.sigma = 0.0
+        if self.median > 0 and self.p99 > self.median:
+            # The 99th percentile of a lognormal is median * exp(2.326 * sigma)
+            self.sigma = math.log(self.p99 / self.median) / 2.326
+
+    def sample(self) -> float:
+        if self.median <= 0:
+            return 0.0
+        if self.sigma == 0.0:
+            return self.median
+        return self.rng.lognormvariate(math.log(self.median), self.sigma)
+
+
+# Canned responses, picked by a marker of the response format in the prompt
+CANNED_RESPONSES: List[Tuple[str, dict]] = [
+    ('"final_outcome"', {
+        "final_outcome": "Resell",
+        "resale_details": {"platform": "eBay", "price": 42.0},
+        "product_description": "Lightly worn, no visible defects.",
+    }),
+    ('"product_description"', {"product_description": "Lightly worn, no visible defects."}),
+    ('"risk_category"', {
+        "risk_category": "Medium",
+        "risk_score": 45,
+        "flags": ["frequent_returns"],
+        "fraud_reason": "Several returns in the last 30 days.",
+        "previous_returns_count": 4,
+        "return_pattern_analysis": {
+            "frequent_returns": True,
+            "expensive_items_only": False,
+            "wardrobing_suspected": False,
+            "receipt_fraud_suspected": False,
+            "counterfeit_substitution_suspected": False,
+            "reselling_exploits_suspected": False,
+        },
+    }),
+    ('"observations"', {
+        "images": [{"index": 0, "grade": "Used - Good", "confidence": 0.86, "observations": ["light creasing"]}],
+        "grade": "Used - Good",
+        "confidence": 0.86,
+        "observations": ["light creasing"],
+    }),
+    ('"defects"', {
+        "product_category": "Shoes",
+        "images": [{
+            "index": 0,
+            "defects": ["scuffed toe"],
+            "condition_grade": "Used - Good",
+            "confidence_score": 0.84,
+            "condition_details": ["sole intact"],
+        }],
+        "defects": ["scuffed toe"],
+        "condition_grade": "Used - Good",
+        "confidence_score": 0.84,
+        "condition_details": ["sole intact"],
+        "estimated_value_retention": 70,
+        "recommended_action": "Resell",
+    }),
+    ('"product_category"', {"product_category": "Shoes"}),
+]
+
+
+def canned_response(prompt: str) -> dict:
+    for marker, response in CANNED_RESPONSES:
+        if marker in prompt:
+            return response
+    return {}
+
+
+class FakeGeminiClient(GeminiClient):
+    """GeminiClient whose model call is simulated locally."""
+
+    def __init__(
+        self,
+        latency: LatencyDistribution,
+        error_rate: float = 0.0,
+        scheduler: Optional[ModelCallScheduler] = None,
+        cache=None,
+        timeout: float = 30.0,
+        seed: int = 0
+    ):
+        # The real constructor configures the SDK; only set what analyze_content uses
+        self.model_name = "fake-gemini"
+        self.model = None
+        self.execution_mode = "native"
+        self.max_in_flight = 64
+        self.timeout = timeout
+        self._executor = None
+        self.scheduler = scheduler or ModelCallScheduler(
+            requests_per_minute=1_000_000,
+            tokens_per_minute=1_000_000_000,
+            max_in_flight=self.max_in_flight,
+            base_delay=0.01,
+            max_delay=0.05
+        )
+        self.cache = cache
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.calls = 0
+
+    async def _generate(self, contents, temperature: float):
+        self.calls += 1
+        prompt = contents[0] if isinstance(contents, list) else contents
+        await asyncio.sleep(self.latency.sample())
+        if self.rng.random() < self.error_rate:
+            raise api_exceptions.ServiceUnavailable("simulated model outage")
+        images = len(contents) - 1 if isinstance(contents, list) else 0
+        return SimpleNamespace(
+            text=json.dumps(canned_response(prompt)),
+            usage_metadata=SimpleNamespace(
+                prompt_token_count=len(prompt) // 4 + images * 258,
+                candidates_token_count=200,
+                total_token_count=len(prompt) // 4 + images * 258 + 200,
+            ),
+        )
+
+
+class LatencyStore(ReturnStore):
+    """In-memory SQLite store that sleeps like a remote database and can fail commits."""
+
+    def __init__(
+        self,
+        read_latency: LatencyDistribution,
+        write_latency: LatencyDistribution,
+        error_rate: float = 0.0,
+        seed: int = 0
+    ):
+        self.inner = SQLiteStore(":memory:")
+        self.read_latency = read_latency
+        self.write_latency = write_latency
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+
+    def _read(self) -> None:
+        time.sleep(self.read_latency.sample())
+
+    def _write(self) -> None:
+        time.sleep(self.write_latency.sample())
+        if self.rng.random() < self.error_rate:
+            raise RuntimeError("simulated store outage")
+
+    def new_return_id(self) -> str:
+        return self.inner.new_return_id()
+
+    def get_return(self, return_id: str) -> Optional[dict]:
+        self._read()
+        return self.inner.get_return(return_id)
+
+    def commit(self, writes: List[Write]) -> None:
+        self._write()
+        self.inner.commit(writes)
+
+    def returns_for_user(self, user_id: str):
+        self._read()
+        return self.inner.returns_for_user(user_id)
+
+    def image_hash_records(self):
+        self._read()
+        return self.inner.image_hash_records()
+
+    def get_aggregate(self, user_id: str) -> Optional[dict]:
+        self._read()
+        return self.inner.get_aggregate(user_id)
+
+    def set_aggregate(self, user_id: str, aggregate: dict) -> None:
+        self._write()
+        self.inner.set_aggregate(user_id, aggregate)
+
+    def update_aggregate(self, user_id: str, apply) -> dict:
+        self._write()
+        return self.inner.update_aggregate(user_id, apply)
+
+    def scan_returns(self, fields):
+        self._read()
+        return self.inner.scan_returns(fields)
+
+    def get_analytics_shards(self) -> List[dict]:
+        self._read()
+        return self.inner.get_analytics_shards()
+
+    def update_analytics_shard(self, shard: int, apply) -> dict:
+        self._write()
+        return self.inner.update_analytics_shard(shard, apply)
+
+    def replace_analytics(self, rollup: dict) -> None:
+        self._write()
+        self.inner.replace_analytics(rollup)
+
+
+def make_fake_firebase(
+    read_latency: LatencyDistribution,
+    write_latency: LatencyDistribution,
+    error_rate: float = 0.0,
+    seed: int = 0
+):
+    """A real FirebaseClient (write-behind, caches, aggregates) over a LatencyStore"""
+    from app.utils.firebase_client import FirebaseClient
+    return FirebaseClient(store=LatencyStore(read_latency, write_latency, error_rate, seed))
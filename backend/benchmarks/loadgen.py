@@ -0,0 +1,84 @@
+"""
+Closed-loop load generator: `concurrency` workers issue operations back to
+back until `total` have completed, while a monitor task measures how late
+the event loop wakes it up (event-loop lag, i.e. blocking work on the loop).
+"""
+import asyncio
+import time
+from typing import Awaitable, Callable, List
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+class EventLoopLagMonitor:
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.samples: List[float] = []
+        self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, time.perf_counter() - start - self.interval))
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+
+
+async def run_load(
+    operation: Callable[[int], Awaitable[bool]],
+    total: int,
+    concurrency: int
+) -> dict:
+    """
+    Run `operation(i)` for i in range(total) with at most `concurrency` in
+    flight. The operation returns False (or raises) to count as an error.
+    """
+    latencies: List[float] = []
+    errors = 0
+    next_index = 0
+
+    async def worker() -> None:
+        nonlocal errors, next_index
+        while next_index < total:
+            index = next_index
+            next_index += 1
+            start = time.perf_counter()
+            try:
+                ok = await operation(index)
+            except Exception as e:
+                print(f"Benchmark operation {index} failed: {str(e)}")
+                ok = False
+            latencies.append(time.perf_counter() - start)
+            if ok is False:
+                errors += 1
+
+    monitor = EventLoopLagMonitor()
+    monitor.start()
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - started
+    await monitor.stop()
+
+    return {
+        'requests': total,
+        'concurrency': concurrency,
+        'errors': errors,
+        'elapsed_s': round(elapsed, 3),
+        'throughput_rps': round(total / elapsed, 2) if elapsed else 0.0,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+        'loop_lag_p99_ms': round(percentile(monitor.samples, 99) * 1000, 2),
+        'loop_lag_max_ms': round(max(monitor.samples, default=0.0) * 1000, 2),
+    }
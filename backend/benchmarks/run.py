@@ -0,0 +1,133 @@
+"""
+Run the offline benchmarks and compare them with the recorded baselines.
+
+    python -m benchmarks.run                      # all scenarios, fail on regression
+    python -m benchmarks.run -s fraud_service     # one scenario
+    python -m benchmarks.run --record             # accept the current numbers as the baseline
+
+A scenario regresses when its throughput drops, or its p99 latency grows,
+by more than --tolerance (25% by default) against baselines.json; the
+`startup` scenario regresses when its median cold start grows. A change
+must also exceed --floor-ms (2 ms by default; throughput is compared as
+wall time per operation) so that scheduler jitter on sub-millisecond
+scenarios does not count. The exit status is 1 on any regression, so this
+can gate CI.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+
+from .loadgen import run_load
+
+BASELINES_PATH = os.path.join(os.path.dirname(__file__), "baselines.json")
+HIGHER_IS_BETTER = ('throughput_rps',)
+LOWER_IS_BETTER = ('p99_ms', 'cold_start_p50_ms')
+RECORDED_KEYS = (
+    'throughput_rps', 'p50_ms', 'p95_ms', 'p99_ms', 'loop_lag_p99_ms',
+    'import_p50_ms', 'cold_start_p50_ms',
+)
+
+
+def load_baselines() -> dict:
+    if not os.path.exists(BASELINES_PATH):
+        return {}
+    with open(BASELINES_PATH) as f:
+        return json.load(f)
+
+
+def compare(result: dict, baseline: dict, tolerance: float, floor_ms: float = 0.0) -> list:
+    problems = []
+    for key in HIGHER_IS_BETTER:
+        if key in result and key in baseline and result[key] < baseline[key] * (1 - tolerance):
+            # Milliseconds of wall time per operation, for the absolute floor
+            slower_ms = 1000 / max(result[key], 1e-9) - 1000 / baseline[key]
+            if slower_ms > floor_ms:
+                problems.append(f"{key} {result[key]} < baseline {baseline[key]}")
+    for key in LOWER_IS_BETTER:
+        if key in result and key in baseline and result[key] > baseline[key] * (1 + tolerance):
+            if result[key] - baseline[key] > floor_ms:
+                problems.append(f"{key} {result[key]} > baseline {baseline[key]}")
+    return problems
+
+
+def run_scenario(name: str) -> dict:
+    if name == 'startup':
+        from .startup import measure_startup
+        return measure_startup()
+    return asyncio.run(run_load_scenario(name))
+
+
+def format_result(name: str, result: dict) -> str:
+    if 'cold_start_p50_ms' in result:
+        return (
+            f"{name:<22} cold start p50 {result['cold_start_p50_ms']:>8.1f} ms  "
+            f"(import {result['import_p50_ms']:.1f} ms, lifespan {result['lifespan_p50_ms']:.1f} ms, "
+            f"first request {result['first_request_p50_ms']:.1f} ms)  max {result['cold_start_max_ms']:.1f} ms"
+        )
+    return (
+        f"{name:<22} {result['throughput_rps']:>9.1f} rps  "
+        f"p50 {result['p50_ms']:>8.1f} ms  p95 {result['p95_ms']:>8.1f} ms  p99 {result['p99_ms']:>8.1f} ms  "
+        f"loop lag p99 {result['loop_lag_p99_ms']:>6.1f} ms  errors {result['errors']}"
+    )
+
+
+async def run_load_scenario(name: str) -> dict:
+    from .scenarios import SCENARIOS
+    build, total, concurrency = SCENARIOS[name]
+    operation, teardown = await build()
+    try:
+        return await run_load(operation, total, concurrency)
+    finally:
+        if teardown is not None:
+            await teardown()
+
+
+def main(argv=None) -> int:
+    from .scenarios import SCENARIOS
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    names = ['startup', *SCENARIOS]
+    parser.add_argument("-s", "--scenario", action="append", choices=names)
+    parser.add_argument("--record", action="store_true", help="write the results as the new baselines")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--floor-ms", type=float, default=2.0,
+                        help="ignore changes smaller than this many milliseconds, however large relatively")
+    parser.add_argument("--json", action="store_true", help="print the raw results as JSON")
+    args = parser.parse_args(argv)
+
+    baselines = load_baselines()
+    results, regressions = {}, {}
+    for name in args.scenario or names:
+        try:
+            result = run_scenario(name)
+        except ImportError as e:
+            print(f"{name:<22} skipped: {str(e)}")
+            continue
+        results[name] = result
+        print(format_result(name, result))
+        if not args.record and name in baselines:
+            problems = compare(result, baselines[name], args.tolerance, args.floor_ms)
+            if problems:
+                regressions[name] = problems
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    if args.record:
+        baselines.update({
+            name: {key: result[key] for key in RECORDED_KEYS if key in result}
+            for name, result in results.items()
+        })
+        with open(BASELINES_PATH, "w") as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"Recorded baselines for {', '.join(results)}")
+        return 0
+
+    for name, problems in regressions.items():
+        print(f"REGRESSION {name}: " + "; ".join(problems))
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
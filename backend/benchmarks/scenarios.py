@@ -0,0 +1,270 @@
+"""
+Benchmark scenarios. Each builds its services over the local fakes and
+returns an async operation for the load generator plus a teardown.
+
+Simulated latencies are scaled down from production (Gemini ~50ms median
+here versus seconds live) so a full run takes seconds; what the baselines
+guard is how our own code queues, fans out and blocks around those calls.
+"""
+import io
+import json
+import random
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, Tuple
+
+from PIL import Image, ImageDraw
+
+from .fakes import FakeGeminiClient, LatencyDistribution, make_fake_firebase
+
+Operation = Callable[[int], Awaitable[bool]]
+SEED = 20240601
+
+GEMINI_LATENCY = (0.05, 0.2)  # median, p99 seconds
+GEMINI_ERROR_RATE = 0.02
+STORE_READ_LATENCY = (0.004, 0.02)
+STORE_WRITE_LATENCY = (0.008, 0.04)
+CATEGORIES = ["Shoes", "Shirt", "Jacket", "Pants", "Dress"]
+
+
+def make_gemini(seed: int = SEED) -> FakeGeminiClient:
+    rng = random.Random(seed)
+    return FakeGeminiClient(
+        LatencyDistribution(*GEMINI_LATENCY, rng=rng),
+        error_rate=GEMINI_ERROR_RATE,
+        seed=seed
+    )
+
+
+def make_firebase(seed: int = SEED):
+    rng = random.Random(seed)
+    return make_fake_firebase(
+        LatencyDistribution(*STORE_READ_LATENCY, rng=rng),
+        LatencyDistribution(*STORE_WRITE_LATENCY, rng=rng),
+        seed=seed
+    )
+
+
+def sample_image(size: Tuple[int, int] = (640, 480), seed: int = SEED) -> Image.Image:
+    """A distinct photo per seed: random blocks (so perceptual hashes differ) plus pixel noise"""
+    rng = random.Random(seed)
+    image = Image.new("RGB", size, (rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+    draw = ImageDraw.Draw(image)
+    for _ in range(12):
+        x, y = rng.randrange(size[0]), rng.randrange(size[1])
+        draw.rectangle(
+            [x, y, x + rng.randrange(40, 250), y + rng.randrange(40, 200)],
+            fill=(rng.randrange(256), rng.randrange(256), rng.randrange(256))
+        )
+    for _ in range(200):
+        x, y = rng.randrange(size[0]), rng.randrange(size[1])
+        image.putpixel((x, y), (rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+    return image
+
+
+def sample_jpeg(seed: int = SEED) -> bytes:
+    buffer = io.BytesIO()
+    sample_image(seed=seed).save(buffer, format="JPEG", quality=85)
+    return buffer.getvalue()
+
+
+def sample_return(index: int) -> dict:
+    rng = random.Random(SEED + index)
+    purchased = datetime(2024, 5, 1) + timedelta(days=rng.randrange(60))
+    return {
+        'user_id': f"user-{index % 50}",
+        'product_category': CATEGORIES[index % len(CATEGORIES)],
+        'original_price': round(rng.uniform(20, 400), 2),
+        'return_reason': rng.choice(["Too small", "Defective", "Changed mind", "Not as described"]),
+        'date_of_purchase': purchased.strftime("%Y-%m-%d"),
+        'date_of_return': (purchased + timedelta(days=rng.randrange(1, 40))).strftime("%Y-%m-%d"),
+    }
+
+
+def sample_history(index: int) -> dict:
+    rng = random.Random(SEED * 7 + index)
+    count = rng.randrange(0, 12)
+    recent = [
+        {
+            'date': (datetime(2024, 6, 1) - timedelta(days=rng.randrange(200))).strftime("%Y-%m-%d"),
+            'category': rng.choice(CATEGORIES),
+            'price': round(rng.uniform(20, 400), 2),
+            'days_until_return': rng.randrange(1, 40),
+            'fraud_flagged': rng.random() < 0.1,
+        }
+        for _ in range(min(count, 10))
+    ]
+    return {
+        'user_id': f"user-{index}",
+        'total_returns': count,
+        'total_value': round(sum(r['price'] for r in recent), 2),
+        'returns_30d': rng.randrange(0, min(count, 6) + 1),
+        'prior_fraud_flags': sum(r['fraud_flagged'] for r in recent),
+        'category_counts': {},
+        'recent_returns': recent,
+    }
+
+
+async def defect_service() -> Tuple[Operation, Callable]:
+    from app.services.defect_detection import DefectDetectionService
+    service = DefectDetectionService(make_gemini())
+    images = [sample_image(seed=SEED), sample_image(seed=SEED + 1)]
+
+    async def operation(index: int) -> bool:
+        result = await service.analyze_product_images(images, CATEGORIES[index % len(CATEGORIES)])
+        return bool(result.get("condition_grade"))
+
+    return operation, None
+
+
+async def condition_service() -> Tuple[Operation, Callable]:
+    from app.services.condition_grading import ConditionGradingService
+    service = ConditionGradingService(make_gemini())
+    images = [sample_image(seed=SEED), sample_image(seed=SEED + 1)]
+
+    async def operation(index: int) -> bool:
+        result = await service.grade_condition(images, CATEGORIES[index % len(CATEGORIES)])
+        return result.get("grade") != "Unknown"
+
+    return operation, None
+
+
+async def fraud_service() -> Tuple[Operation, Callable]:
+    from app.services.fraud_detection import FraudDetectionService
+    service = FraudDetectionService(make_gemini())
+
+    async def operation(index: int) -> bool:
+        result = await service.analyze_return_pattern(sample_return(index), sample_history(index))
+        return isinstance(result, dict) and bool(result)
+
+    return operation, None
+
+
+def sample_analyses(index: int) -> Tuple[dict, dict]:
+    rng = random.Random(SEED * 13 + index)
+    grade, action = rng.choice([
+        # recommended_action uses the defect prompt's vocabulary
+        ("Like New", "Resell"), ("Used - Good", "Resell"), ("Used - Good", "Refurbish"),
+        ("Used - Good", "Donate"), ("Salvage", "Recycle"), ("Salvage", "Disposal"),
+    ])
+    defect_analysis = {
+        'product_category': CATEGORIES[index % len(CATEGORIES)],
+        'condition_grade': grade,
+        'defects': [] if grade == "Like New" else ["scuffed toe"],
+        'condition_details': ["sole intact"],
+        'recommended_action': action,
+    }
+    risk = rng.choices(["Low", "Medium", "High"], weights=[70, 20, 10])[0]
+    fraud_analysis = {'risk_category': risk, 'is_fraudulent': risk == "High", 'previous_returns_count': rng.randrange(8)}
+    return defect_analysis, fraud_analysis
+
+
+POLICY_RULES = {
+    'Shoes': {'return_window': 30, 'final_sale': False},
+    'Dress': {'return_window': 15, 'final_sale': False},
+    'Jacket': {'return_window': 30, 'requires_original_box': True},
+}
+
+
+async def decision_service() -> Tuple[Operation, Callable]:
+    from app.services.return_decision import ReturnDecisionService
+    service = ReturnDecisionService(POLICY_RULES, make_gemini())
+
+    async def operation(index: int) -> bool:
+        defect_analysis, fraud_analysis = sample_analyses(index)
+        result = await service.determine_final_outcome(defect_analysis, fraud_analysis, sample_return(index))
+        return bool(result.get("final_outcome"))
+
+    return operation, None
+
+
+def sample_comparables(count: int, seed: int = SEED):
+    """Past resales: recovery by grade, shifted per category, with noise"""
+    from app.utils.comparables import ComparablesIndex
+    rng = random.Random(seed)
+    recovery = {"Like New": 0.8, "Used - Good": 0.55, "Salvage": 0.15}
+    demand = {category: 0.8 + 0.1 * position for position, category in enumerate(CATEGORIES)}
+    index = ComparablesIndex()
+    for _ in range(count):
+        category, grade = rng.choice(CATEGORIES), rng.choice(list(recovery))
+        price = round(rng.uniform(20, 400), 2)
+        index.add(category, grade, price, price * recovery[grade] * demand[category] * rng.uniform(0.85, 1.15),
+                  rng.randrange(1, 60) / demand[category])
+    return index
+
+
+async def pricing_service() -> Tuple[Operation, Callable]:
+    from app.services.pricing import PricingService
+    service = PricingService(sample_comparables(50000))
+    grades = ["Like New", "Used - Good", "Salvage"]
+
+    async def operation(index: int) -> bool:
+        return_data = sample_return(index)
+        result = await service.get_price_recommendation(
+            return_data['original_price'], grades[index % len(grades)], return_data['product_category']
+        )
+        return result['pricing_source'] == "comparables"
+
+    return operation, None
+
+
+async def persistence() -> Tuple[Operation, Callable]:
+    firebase = make_firebase()
+
+    async def operation(index: int) -> bool:
+        return_data = sample_return(index)
+        await firebase.get_user_history(return_data['user_id'])
+        return_id = await firebase.save_return_request(return_data)
+        await firebase.update_return_status(return_id, {'status': 'analyzed'})
+        return True
+
+    return operation, firebase.close
+
+
+async def analyze_return_http() -> Tuple[Operation, Callable]:
+    """POST /api/analyze-return end to end through the ASGI app, with every backend faked"""
+    import httpx
+    from app import dependencies, main
+    from app.services.condition_grading import ConditionGradingService
+    from app.services.defect_detection import DefectDetectionService
+    from app.services.fraud_detection import FraudDetectionService
+    from app.services.return_decision import ReturnDecisionService
+
+    gemini = make_gemini()
+    firebase = make_firebase()
+    dependencies.override('firebase', firebase)
+    dependencies.override('defect_service', DefectDetectionService(gemini))
+    dependencies.override('fraud_service', FraudDetectionService(gemini))
+    dependencies.override('condition_service', ConditionGradingService(gemini))
+    dependencies.override('decision_service', ReturnDecisionService(POLICY_RULES, gemini))
+    # Distinct photos per return, except every tenth return resubmits an
+    # earlier return's photos (near-duplicate match, defect analysis reused)
+    photo_sets = [[sample_jpeg(SEED + 2 * k), sample_jpeg(SEED + 2 * k + 1)] for k in range(100)]
+    client = httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://benchmark")
+
+    async def operation(index: int) -> bool:
+        photos = photo_sets[index // 2 if index % 10 == 9 else index % len(photo_sets)]
+        response = await client.post(
+            "/api/analyze-return",
+            data={'return_data': json.dumps(sample_return(index))},
+            files=[('images', (f"photo{i}.jpg", photo, "image/jpeg")) for i, photo in enumerate(photos)]
+        )
+        return response.status_code == 200
+
+    async def teardown() -> None:
+        await client.aclose()
+        await firebase.close()
+        dependencies.get_image_preprocessor().shutdown()
+
+    return operation, teardown
+
+
+# name -> (build, total operations, concurrency)
+SCENARIOS: Dict[str, Tuple[Callable, int, int]] = {
+    'defect_service': (defect_service, 200, 20),
+    'condition_service': (condition_service, 200, 20),
+    'fraud_service': (fraud_service, 400, 40),
+    'decision_service': (decision_service, 400, 40),
+    'pricing_service': (pricing_service, 400, 40),
+    'persistence': (persistence, 400, 40),
+    'analyze_return_http': (analyze_return_http, 100, 10),
+}
@@ -0,0 +1,56 @@
+"""
+Cold-start benchmark: each run is a fresh interpreter that imports app.main,
+enters the app lifespan and serves its first request, which is what a
+serverless or container cold start pays before it can answer traffic.
+"""
+import json
+import os
+import subprocess
+import sys
+
+from .loadgen import percentile
+
+CHILD = """
+import json, time
+started = time.perf_counter()
+import app.main
+imported = time.perf_counter()
+from fastapi.testclient import TestClient
+with TestClient(app.main.app) as client:
+    ready = time.perf_counter()
+    client.get("/")
+    served = time.perf_counter()
+print(json.dumps({
+    'import_ms': (imported - started) * 1000,
+    'lifespan_ms': (ready - imported) * 1000,
+    'first_request_ms': (served - ready) * 1000,
+    'cold_start_ms': (served - started) * 1000,
+}))
+"""
+
+
+def measure_startup(runs: int = 5) -> dict:
+    backend_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    samples = []
+    for _ in range(runs):
+        completed = subprocess.run(
+            [sys.executable, "-c", CHILD],
+            cwd=backend_dir,
+            env=dict(os.environ),
+            capture_output=True,
+            text=True,
+            check=True
+        )
+        samples.append(json.loads(completed.stdout.strip().splitlines()[-1]))
+
+    def p50(key: str) -> float:
+        return round(percentile([sample[key] for sample in samples], 50), 2)
+
+    return {
+        'runs': runs,
+        'import_p50_ms': p50('import_ms'),
+        'lifespan_p50_ms': p50('lifespan_ms'),
+        'first_request_p50_ms': p50('first_request_ms'),
+        'cold_start_p50_ms': p50('cold_start_ms'),
+        'cold_start_max_ms': round(max(sample['cold_start_ms'] for sample in samples), 2),
+    }
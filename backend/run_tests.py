@@ -57,8 +57,9 @@ async def run_tests():
     }
 
     return_decision_service = ReturnDecisionService(return_policy_rules)
-    return_decision_result = await return_decision_service.determine_final_outcome(defect_result, fraud_result)  # Fix: added `await`
+    return_decision_result = await return_decision_service.determine_final_outcome(defect_result, fraud_result, test_return_request)  # Fix: added `await`
     print(json.dumps(return_decision_result, indent=2))
+    print(json.dumps(return_decision_service.policy.stats(), indent=2))
 
 if __name__ == "__main__":
     asyncio.run(run_tests())
@@ -0,0 +1,41 @@
+"""
+Offline unit tests. Settings only need to exist, and everything runs against
+the local stand-ins in benchmarks/fakes.py, so no credentials or network are
+needed. Run from the backend directory with `python -m pytest -q tests`.
+"""
+from types import SimpleNamespace
+
+import benchmarks  # noqa: F401  (sets the offline environment before `app` is imported)
+import pytest
+
+from app import dependencies
+from benchmarks.fakes import FakeGeminiClient, LatencyDistribution, make_fake_firebase
+
+
+@pytest.fixture
+def gemini() -> FakeGeminiClient:
+    """A GeminiClient that answers instantly with the canned responses"""
+    return FakeGeminiClient(LatencyDistribution(0.0))
+
+
+@pytest.fixture
+def services(gemini):
+    """
+    The shared firebase and analysis services, swapped for ones backed by the
+    fakes for one test (the decision service with no policy rules). Close services.firebase inside the test's event loop.
+    """
+    from app.services.condition_grading import ConditionGradingService
+    from app.services.defect_detection import DefectDetectionService
+    from app.services.fraud_detection import FraudDetectionService
+    from app.services.return_decision import ReturnDecisionService
+
+    saved = dict(dependencies._instances)
+    firebase = make_fake_firebase(LatencyDistribution(0.0), LatencyDistribution(0.0))
+    dependencies.override('firebase', firebase)
+    dependencies.override('defect_service', DefectDetectionService(gemini))
+    dependencies.override('fraud_service', FraudDetectionService(gemini))
+    dependencies.override('condition_service', ConditionGradingService(gemini))
+    dependencies.override('decision_service', ReturnDecisionService({}, gemini))
+    yield SimpleNamespace(gemini=gemini, firebase=firebase)
+    dependencies._instances.clear()
+    dependencies._instances.update(saved)
@@ -0,0 +1,121 @@
+import asyncio
+import json
+
+import httpx
+from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
+
+from app import dependencies, main
+from app.utils.metrics import http_request_duration
+from app.services.condition_grading import ConditionGradingService
+from app.services.return_decision import ReturnDecisionService
+from benchmarks.scenarios import sample_jpeg, sample_return
+
+
+def post(path: str, photo: bytes) -> httpx.Response:
+    async def run() -> httpx.Response:
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://test") as client:
+            return await client.post(
+                path,
+                data={'return_data': json.dumps({'user_id': 'u1', 'return_reason': "Too small"})},
+                files=[('images', ("photo.jpg", photo, "image/jpeg"))]
+            )
+    try:
+        return asyncio.run(run())
+    finally:
+        dependencies.get_image_preprocessor().shutdown()
+
+
+def test_undecodable_photo_is_a_bad_request_on_the_sync_path():
+    response = post("/api/analyze-return", b"not a photo")
+    assert response.status_code == 400
+    assert response.json()['detail'].startswith("Could not read photo")
+
+
+def test_undecodable_photo_is_a_bad_request_on_the_stream_path():
+    response = post("/api/analyze-return/stream", b"not a photo")
+    assert response.status_code == 400
+    assert response.json()['detail'].startswith("Could not read photo")
+
+
+def test_a_return_without_a_category_is_graded_and_priced_with_the_detected_one(services):
+    graded = []
+
+    class RecordingGrader(ConditionGradingService):
+        async def grade_condition(self, images, product_category):
+            graded.append(product_category)
+            return await super().grade_condition(images, product_category)
+
+    dependencies.override('condition_service', RecordingGrader(services.gemini))
+    return_data = sample_return(3)
+    del return_data['product_category']
+
+    async def run() -> httpx.Response:
+        try:
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://test") as client:
+                return await client.post(
+                    "/api/analyze-return",
+                    data={'return_data': json.dumps(return_data)},
+                    files=[('images', ("photo.jpg", sample_jpeg(0), "image/jpeg"))]
+                )
+        finally:
+            await services.firebase.close()
+            dependencies.get_image_preprocessor().shutdown()
+
+    response = asyncio.run(run())
+    assert response.status_code == 200
+    body = response.json()
+    assert graded == ["Shoes"]  # the category the defect analysis identified
+    assert body['stage_status']['condition_grade'] == 'completed'
+    assert body['price_recommendation']['suggested_price'] > 0
+
+
+def test_streamed_responses_are_timed_until_the_body_is_sent():
+    app = FastAPI()
+    app.middleware("http")(main.instrument_request)
+
+    @app.get("/slow-stream")
+    async def slow_stream():
+        async def body():
+            yield b"first\n"
+            await asyncio.sleep(0.2)
+            yield b"second\n"
+        return StreamingResponse(body(), media_type="application/x-ndjson")
+
+    async def run() -> httpx.Response:
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+            return await client.get("/slow-stream")
+
+    response = asyncio.run(run())
+    assert response.text == "first\nsecond\n"
+    timing = http_request_duration._children[http_request_duration._key(
+        {'method': "GET", 'route': "/slow-stream", 'status': 200}
+    )]
+    assert timing.count == 1 and timing.sum >= 0.2
+
+
+def test_the_policy_rules_decide_the_outcome_of_an_analyzed_return(services):
+    dependencies.override('decision_service', ReturnDecisionService({'shoes': {'final_sale': True}}, services.gemini))
+    return_data = {**sample_return(3), 'product_category': "Shoes"}
+
+    async def run() -> httpx.Response:
+        try:
+            async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://test") as client:
+                return await client.post(
+                    "/api/analyze-return",
+                    data={'return_data': json.dumps(return_data)},
+                    files=[('images', ("photo.jpg", sample_jpeg(0), "image/jpeg"))]
+                )
+        finally:
+            await services.firebase.close()
+            dependencies.get_image_preprocessor().shutdown()
+
+    response = asyncio.run(run())
+    assert response.status_code == 200
+    body = response.json()
+    assert body['stage_status']['return_decision'] == 'completed'
+    assert body['return_decision']['final_outcome'] == "Deny"
+    assert body['return_decision']['decided_by'] == 'rules'
+    assert body['return_decision']['matched_rule'] == "shoes.final_sale"
+    saved = services.firebase.store.get_return(body['return_id'])
+    assert saved['return_decision']['final_outcome'] == "Deny"
@@ -0,0 +1,39 @@
+import json
+
+from benchmarks import run
+from benchmarks.run import compare
+
+
+def test_relative_regression_is_reported():
+    baseline = {'throughput_rps': 100.0, 'p99_ms': 200.0}
+    result = {'throughput_rps': 60.0, 'p99_ms': 300.0}
+    assert len(compare(result, baseline, 0.25, floor_ms=2.0)) == 2
+
+
+def test_sub_millisecond_jitter_is_below_the_floor():
+    baseline = {'throughput_rps': 2305.81, 'p99_ms': 0.59}
+    result = {'throughput_rps': 1516.97, 'p99_ms': 1.03}
+    assert compare(result, baseline, 0.25, floor_ms=2.0) == []
+    assert len(compare(result, baseline, 0.25, floor_ms=0.0)) == 2
+
+
+def test_improvements_never_regress():
+    assert compare({'throughput_rps': 400.0, 'p99_ms': 150.0}, {'throughput_rps': 49.0, 'p99_ms': 7596.0}, 0.25) == []
+
+
+def test_the_gate_passes_on_the_recorded_baseline_and_fails_on_a_regression(tmp_path, monkeypatch, capsys):
+    baselines = tmp_path / "baselines.json"
+    monkeypatch.setattr(run, "BASELINES_PATH", str(baselines))
+    # decision_service runs against the fake model client
+    assert run.main(["-s", "decision_service", "--record"]) == 0
+    recorded = json.loads(baselines.read_text())['decision_service']
+    assert recorded['throughput_rps'] > 0
+
+    assert run.main(["-s", "decision_service", "--tolerance", "0.9"]) == 0
+    assert "REGRESSION" not in capsys.readouterr().out
+
+    # The fake model calls keep p99 far above the 2 ms floor
+    recorded['p99_ms'] /= 10
+    baselines.write_text(json.dumps({'decision_service': recorded}))
+    assert run.main(["-s", "decision_service"]) == 1
+    assert "REGRESSION decision_service: p99_ms" in capsys.readouterr().out
@@ -0,0 +1,28 @@
+from app.services.condition_grading import merge_grades
+
+
+def test_worst_photo_grade_overrides_a_better_model_grade():
+    merged = merge_grades(
+        [
+            {'grade': "Like New", 'confidence': 0.9},
+            {'grade': "Salvage", 'confidence': 0.8, 'recommended_action': "Recycle"},
+        ],
+        {'grade': "Like New", 'confidence': 0.9, 'observations': [], 'recommended_action': "Resell"}
+    )
+    assert merged['grade'] == "Salvage"
+    assert merged['recommended_action'] == "Recycle"
+
+
+def test_model_grade_stands_when_it_is_already_the_worse():
+    merged = merge_grades([{'grade': "Like New"}, {'grade': "Used - Good"}], {'grade': "Salvage"})
+    assert merged['grade'] == "Salvage"
+
+
+def test_missing_fields_are_derived_from_the_photos():
+    merged = merge_grades([
+        {'grade': "Used - Good", 'confidence': 0.7, 'observations': ["creased"]},
+        {'grade': "Like New", 'confidence': 0.9, 'observations': ["clean"]},
+    ])
+    assert merged['grade'] == "Used - Good" and merged['confidence'] == 0.7
+    assert merged['observations'] == ["creased", "clean"] and len(merged['images']) == 2
+    assert merge_grades([{'observations': []}])['grade'] == "Unknown"
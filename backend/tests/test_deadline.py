@@ -0,0 +1,150 @@
+import asyncio
+import contextvars
+import time
+
+from app import dependencies, main
+from app.config import settings
+from app.utils.deadline import Deadline, budget_exhausted, capped_timeout, request_deadline
+from app.utils.stage_graph import COMPLETED, SKIPPED, TIMED_OUT, StageGraph, StageTimingStats
+from benchmarks.fakes import LatencyDistribution
+from benchmarks.scenarios import sample_image, sample_return
+
+
+def test_timeouts_are_capped_by_the_request_deadline():
+    def within(seconds: float):
+        request_deadline.set(Deadline(seconds))
+        return capped_timeout(30.0), capped_timeout(None), budget_exhausted()
+
+    assert capped_timeout(30.0) == 30.0 and not budget_exhausted()
+    capped, unbounded, exhausted = contextvars.copy_context().run(within, 5.0)
+    assert capped <= 5.0 and unbounded <= 5.0 and not exhausted
+    assert contextvars.copy_context().run(within, 0.0)[2]
+
+
+def test_a_client_may_only_shorten_the_budget():
+    def budget(requested):
+        return main.start_deadline(requested).budget
+
+    assert contextvars.copy_context().run(budget, 1.5) == 1.5
+    assert contextvars.copy_context().run(budget, 10_000) == settings.ANALYSIS_DEADLINE_SECONDS
+    assert contextvars.copy_context().run(budget, 0) == settings.ANALYSIS_DEADLINE_SECONDS
+
+
+def test_stages_still_running_at_the_deadline_time_out_with_their_dependents():
+    async def fast():
+        return "done"
+
+    async def slow():
+        await asyncio.sleep(1)
+
+    graph = (
+        StageGraph(stats=StageTimingStats())
+        .add_stage("fast", fast)
+        .add_stage("slow", slow)
+        .add_stage("after_slow", fast, ["slow"])
+    )
+    started = time.perf_counter()
+    results = asyncio.run(graph.run(Deadline(0.05)))
+    assert time.perf_counter() - started < 0.5
+    assert results == {"fast": "done", "slow": None, "after_slow": None}
+    assert graph.statuses == {"fast": COMPLETED, "slow": TIMED_OUT, "after_slow": TIMED_OUT}
+
+
+def test_model_calls_stop_at_the_deadline(gemini):
+    gemini.latency = LatencyDistribution(1.0)
+
+    async def timed_out(started: float) -> float:
+        try:
+            await gemini.analyze_content('"product_category"', prompt_name="test.deadline")
+        except asyncio.TimeoutError:
+            return time.perf_counter() - started
+
+    async def call():
+        request_deadline.set(Deadline(0.05))
+        return await timed_out(time.perf_counter()), await timed_out(time.perf_counter())
+
+    first, second = asyncio.run(call())
+    assert first is not None and first < 0.5
+    # Once the budget is spent no further call is attempted
+    assert second is not None and gemini.calls == 1
+
+
+def test_a_model_call_cut_off_by_the_deadline_times_out_its_stage(gemini):
+    deadline = Deadline(0.05)
+
+    async def model_stage():
+        time.sleep(0.06)  # e.g. decoding photos, which holds the loop past the deadline
+        return await gemini.analyze_content('"product_category"', prompt_name="test.deadline")
+
+    async def after_model():
+        return "never run"
+
+    async def run():
+        request_deadline.set(deadline)
+        graph = (
+            StageGraph(stats=StageTimingStats())
+            .add_stage("model", model_stage)
+            .add_stage("after_model", after_model, ["model"])
+        )
+        return await graph.run(deadline), graph.statuses
+
+    results, statuses = asyncio.run(run())
+    assert results == {"model": None, "after_model": None}
+    assert statuses == {"model": TIMED_OUT, "after_model": TIMED_OUT}
+
+
+def test_analysis_returns_partial_results_at_the_deadline(services):
+    services.gemini.latency = LatencyDistribution(1.0)
+
+    async def analyze():
+        try:
+            return await main.run_return_analysis(sample_return(1), [sample_image()], deadline=Deadline(0.1))
+        finally:
+            await services.firebase.close()
+
+    analysis_result, _ = asyncio.run(analyze())
+    status = analysis_result['stage_status']
+    assert status['image_matches'] == COMPLETED and status['user_history'] == COMPLETED
+    assert status['condition_grade'] == TIMED_OUT and status['price_recommendation'] == TIMED_OUT
+    assert analysis_result['price_recommendation'] is None
+
+
+def test_manual_review_skips_grading_and_pricing(services):
+    class ManualReview:
+        async def analyze_return_pattern(self, return_data, user_history, image_matches):
+            return {'risk_category': 'High', 'is_fraudulent': True}
+
+    dependencies.override('fraud_service', ManualReview())
+    services.gemini.latency = LatencyDistribution(2.0)
+
+    async def analyze():
+        try:
+            return await main.run_return_analysis(sample_return(2), [sample_image()], deadline=Deadline(5.0))
+        finally:
+            await services.firebase.close()
+
+    analysis_result, _ = asyncio.run(analyze())
+    status = analysis_result['stage_status']
+    assert status['fraud_analysis'] == COMPLETED
+    assert status['defect_analysis'] == SKIPPED and status['condition_grade'] == SKIPPED
+    assert status['price_recommendation'] == SKIPPED
+
+
+def test_admission_wait_times_out_and_a_cancelled_wait_leaks_no_slot():
+    from app.utils.model_scheduler import ModelCallScheduler
+
+    async def scenario():
+        scheduler = ModelCallScheduler(requests_per_minute=1000, tokens_per_minute=1_000_000, max_in_flight=1)
+        await scheduler.acquire(1, 0)
+        try:
+            await scheduler.acquire(1, 0, timeout=0.01)
+        except asyncio.TimeoutError:
+            timed_out = True
+        waiter = asyncio.create_task(scheduler.acquire(1, 0))
+        await asyncio.sleep(0)
+        scheduler.release()  # grants the waiter its slot...
+        waiter.cancel()  # ...in the same tick as it is cancelled
+        await asyncio.gather(waiter, return_exceptions=True)
+        return timed_out, waiter.cancelled(), scheduler.in_flight
+
+    assert asyncio.run(scenario()) == (True, True, 0)
@@ -0,0 +1,35 @@
+from app.services.defect_detection import merge_image_findings
+
+
+def test_worst_photo_grade_overrides_a_better_model_grade():
+    merged = merge_image_findings(
+        [
+            {'condition_grade': "Like New", 'recommended_action': "Resell"},
+            {'condition_grade': "Salvage", 'recommended_action': "Recycle"},
+        ],
+        {'condition_grade': "Like New", 'recommended_action': "Resell", 'defects': []}
+    )
+    assert merged['condition_grade'] == "Salvage"
+    assert merged['recommended_action'] == "Recycle"
+
+
+def test_model_grade_stands_when_it_is_already_the_worse():
+    merged = merge_image_findings(
+        [{'condition_grade': "Like New", 'recommended_action': "Resell"}],
+        {'condition_grade': "Used - Good", 'recommended_action': "Refurbish"}
+    )
+    assert merged['condition_grade'] == "Used - Good"
+    assert merged['recommended_action'] == "Refurbish"
+
+
+def test_missing_fields_are_derived_from_the_photos():
+    merged = merge_image_findings([
+        {'product_category': "Shoes", 'defects': ["scuff"], 'condition_grade': "Used - Good", 'confidence_score': 0.9},
+        {'defects': ["scuff", "tear"], 'condition_grade': "Like New", 'confidence_score': 0.7},
+        "not a finding",
+    ])
+    assert merged['product_category'] == "Shoes"
+    assert merged['defects'] == ["scuff", "tear"]
+    assert merged['condition_grade'] == "Used - Good"
+    assert merged['confidence_score'] == 0.7
+    assert len(merged['images']) == 2
@@ -0,0 +1,48 @@
+from app.services.fraud_scoring import FraudPreScorer
+
+QUIET_HISTORY = {'total_returns': 0, 'returns_30d': 0, 'prior_fraud_flags': 0, 'recent_returns': []}
+RETURN = {
+    'user_id': 'u1',
+    'product_category': 'Shoes',
+    'original_price': 40.0,
+    'date_of_purchase': '2024-05-01',
+    'date_of_return': '2024-05-20',
+}
+
+
+def match(user_id: str, distance: int) -> dict:
+    return {'image': 0, 'return_id': 'r0', 'user_id': user_id, 'distance': distance}
+
+
+def scorer() -> FraudPreScorer:
+    return FraudPreScorer(low_threshold=0.2, high_threshold=0.7, frequency_threshold=5, copied_photo_distance=4)
+
+
+def test_clean_return_is_decided_low_locally():
+    assert scorer().score(RETURN, QUIET_HISTORY)['decision'] == "Low"
+
+
+def test_identical_photo_from_another_customer_is_high():
+    prescore = scorer().score(RETURN, QUIET_HISTORY, [match('u2', 1)])
+    assert prescore['decision'] == "High"
+    assert scorer().to_fraud_check(prescore)['return_pattern_analysis']['copied_photos_suspected']
+
+
+def test_similar_photo_from_another_customer_goes_to_the_model():
+    # e.g. two sellers' product shots on the same plain background
+    prescore = scorer().score(RETURN, QUIET_HISTORY, [match('u2', 9)])
+    assert prescore['decision'] is None
+    assert prescore['features']['_photos_from_other_users'] == 1
+    assert prescore['features']['_photos_copied_from_other_users'] == 0
+
+
+def test_own_earlier_photo_rules_out_low_only():
+    assert scorer().score(RETURN, QUIET_HISTORY, [match('u1', 0)])['decision'] is None
+
+
+def test_stats_count_local_decisions():
+    pre_scorer = scorer()
+    pre_scorer.score(RETURN, QUIET_HISTORY)
+    pre_scorer.score(RETURN, QUIET_HISTORY, [match('u2', 9)])
+    stats = pre_scorer.stats()
+    assert (stats['decided_low'], stats['escalated_to_llm']) == (1, 1)
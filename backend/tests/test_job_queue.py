@@ -0,0 +1,145 @@
+import asyncio
+import json
+import time
+
+import httpx
+
+from app import dependencies, main
+from app.utils.job_queue import JobQueue, JobWorkerPool
+from benchmarks.scenarios import sample_jpeg, sample_return
+
+
+def test_jobs_are_claimed_oldest_first_and_only_once():
+    queue = JobQueue(":memory:")
+    first = queue.enqueue("r1", {'n': 1}, images=[b"a", b"b"])
+    queue.enqueue("r2", {'n': 2})
+    job = queue.claim()
+    assert (job['id'], job['payload'], job['images'], job['attempts']) == (first, {'n': 1}, [b"a", b"b"], 1)
+    assert queue.claim()['return_id'] == "r2"
+    assert queue.claim() is None
+    queue.complete(first)
+    assert queue.counts() == {'done': 1, 'running': 1}
+    assert queue.conn.execute("SELECT COUNT(*) FROM job_images").fetchone() == (0,)
+
+
+def test_failed_jobs_retry_until_max_attempts():
+    queue = JobQueue(":memory:", max_attempts=2)
+    job_id = queue.enqueue("r1", {})
+    queue.claim()
+    assert queue.fail(job_id, "model down") == 'queued'
+    assert queue.claim()['attempts'] == 2
+    assert queue.fail(job_id, "model down") == 'failed'
+    assert queue.claim() is None
+
+
+def test_released_and_stale_jobs_go_back_in_the_queue(tmp_path):
+    path = str(tmp_path / "jobs.db")
+    queue = JobQueue(path)
+    released, stale = queue.enqueue("r1", {}), queue.enqueue("r2", {})
+    queue.claim(), queue.claim()
+    queue.release(released)
+    assert queue.claim()['attempts'] == 1  # a shutdown does not count as an attempt
+    queue.close()
+
+    # Another process (or the next start) finds the jobs left running
+    reopened = JobQueue(path)
+    time.sleep(0.01)
+    assert reopened.requeue_stale(0.0) == 2
+    assert {reopened.claim()['id'], reopened.claim()['id']} == {released, stale}
+
+
+def test_a_job_whose_worker_dies_is_requeued_while_live_jobs_keep_their_lease(tmp_path):
+    path = str(tmp_path / "jobs.db")
+    dead = JobQueue(path)
+    orphan = dead.enqueue("orphan", {})
+    dead.claim()  # this worker dies without finishing or renewing the job
+    dead.close()
+
+    queue = JobQueue(path)
+    long_job = queue.enqueue("long", {})
+    handled = []
+
+    async def handler(job):
+        handled.append(job['return_id'])
+        if job['return_id'] == "long":
+            await asyncio.sleep(0.5)  # several leases, renewed by the heartbeat
+
+    async def scenario():
+        pool = JobWorkerPool(queue, handler, concurrency=1, poll_interval=0.01, lease_seconds=0.15)
+        pool.start()
+        deadline = time.monotonic() + 5
+        while queue.counts() != {'done': 2} and time.monotonic() < deadline:
+            await asyncio.sleep(0.02)
+        await pool.stop()
+        return pool.requeued
+
+    assert asyncio.run(scenario()) == 1
+    assert handled == ["long", "orphan"]
+    attempts = dict(queue.conn.execute("SELECT id, attempts FROM jobs"))
+    assert attempts == {orphan: 2, long_job: 1}
+
+
+def test_a_job_that_keeps_losing_its_worker_fails():
+    queue = JobQueue(":memory:", max_attempts=1)
+    job_id = queue.enqueue("r1", {})
+    queue.claim()
+    time.sleep(0.01)
+    assert queue.requeue_stale(0.0) == 1
+    assert queue.conn.execute("SELECT status, error FROM jobs WHERE id = ?", (job_id,)).fetchone() == (
+        'failed', 'worker stopped responding')
+
+
+def test_worker_pool_completes_fails_and_releases_jobs():
+    queue = JobQueue(":memory:", max_attempts=1)
+    ok, bad, slow = queue.enqueue("ok", {}), queue.enqueue("bad", {}), queue.enqueue("slow", {})
+    slow_started = asyncio.Event()
+
+    async def handler(job):
+        if job['return_id'] == "bad":
+            raise RuntimeError("boom")
+        if job['return_id'] == "slow":
+            slow_started.set()
+            await asyncio.sleep(10)
+
+    async def scenario():
+        pool = JobWorkerPool(queue, handler, concurrency=2, poll_interval=0.01)
+        pool.start()
+        await asyncio.wait_for(slow_started.wait(), timeout=5)
+        await asyncio.sleep(0.05)
+        await pool.stop()
+
+    asyncio.run(scenario())
+    status = dict(queue.conn.execute("SELECT return_id, status FROM jobs"))
+    assert status == {'ok': 'done', 'bad': 'failed', 'slow': 'queued'}
+
+
+def test_async_analysis_is_queued_and_processed_from_the_queue(services):
+    async def scenario():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://test") as client:
+            response = await client.post(
+                "/api/analyze-return?mode=async",
+                data={'return_data': json.dumps(sample_return(1))},
+                files=[('images', ("photo.jpg", sample_jpeg(), "image/jpeg"))]
+            )
+        assert response.status_code == 202
+        return_id = response.json()['return_id']
+        # Committed to the store itself, not just buffered, before the job is queued
+        committed = services.firebase.store.get_return(return_id)
+        queued = await services.firebase.get_return(return_id)
+        job = dependencies.get_job_queue().claim()
+        await main.run_analysis_job(job)
+        analyzed = await services.firebase.get_return(return_id)
+        await services.firebase.close()
+        return job, committed, queued, analyzed
+
+    try:
+        job, committed, queued, analyzed = asyncio.run(scenario())
+    finally:
+        dependencies.get_image_preprocessor().shutdown()
+    assert committed is not None and committed['status'] == 'queued'
+    assert queued['status'] == 'queued' and set(queued['stages'].values()) == {'pending'}
+    # The job carries photo references, not the photos
+    assert job['images'] == [] and job['payload']['photos'][0]['sha256']
+    assert analyzed['status'] == 'analyzed'
+    assert set(analyzed['stages'].values()) == {'completed'}
+    assert analyzed['condition_grade']['grade'] == "Used - Good"
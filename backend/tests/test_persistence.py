@@ -0,0 +1,207 @@
+import asyncio
+import time
+
+from app.utils.firebase_client import FirebaseClient
+from app.utils.metrics import stage_duration, write_behind_write_latency
+from app.utils.persistence import SQLiteStore, WriteBehindBuffer, apply_field_update
+
+
+class RecordingCommit:
+    """Commit callback that records batches, sleeps and fails as scripted"""
+
+    def __init__(self, delays=(), failures=0):
+        self.delays = list(delays)
+        self.failures = failures
+        self.batches = []
+
+    async def __call__(self, writes):
+        if self.delays:
+            await asyncio.sleep(self.delays.pop(0))
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError("store unavailable")
+        self.batches.append(list(writes))
+
+
+def test_apply_field_update_sets_dotted_paths():
+    document = {'status': 'queued', 'stages': {'defect_analysis': 'pending'}}
+    apply_field_update(document, {'stages.condition_grade': 'completed', 'status': 'analyzed'})
+    assert document == {'status': 'analyzed', 'stages': {'defect_analysis': 'pending', 'condition_grade': 'completed'}}
+
+
+def test_add_does_not_wait_for_the_commit():
+    async def scenario():
+        commit = RecordingCommit(delays=[0.3])
+        buffer = WriteBehindBuffer(commit, flush_size=2, flush_interval=10)
+        start = time.perf_counter()
+        await buffer.add('set', 'a', {})
+        await buffer.add('set', 'b', {})  # reaches flush_size
+        elapsed = time.perf_counter() - start
+        assert buffer.has_pending('a')
+        assert await buffer.flush() == 2
+        return elapsed, commit.batches, buffer.has_pending('a')
+
+    elapsed, batches, still_pending = asyncio.run(scenario())
+    assert elapsed < 0.1
+    assert batches == [[('set', 'a', {}), ('set', 'b', {})]]
+    assert not still_pending
+
+
+def test_commit_latency_is_recorded_where_the_buffer_commits():
+    def observed(histogram, **labels):
+        child = histogram._children.get(histogram._key(labels))
+        return (child.count, child.sum) if child else (0, 0.0)
+
+    async def scenario():
+        buffer = WriteBehindBuffer(RecordingCommit(delays=[0.05]), flush_size=100, flush_interval=10)
+        await buffer.add('set', 'a', {})
+        await buffer.add('set', 'b', {})
+        await buffer.flush()
+
+    commits_before, commit_time_before = observed(stage_duration, pipeline="analyze_return", stage="firestore_commit")
+    writes_before, write_time_before = observed(write_behind_write_latency)
+    asyncio.run(scenario())
+    commits, commit_time = observed(stage_duration, pipeline="analyze_return", stage="firestore_commit")
+    writes, write_time = observed(write_behind_write_latency)
+    assert commits - commits_before == 1 and commit_time - commit_time_before >= 0.05
+    assert writes - writes_before == 2 and write_time - write_time_before >= 0.1
+
+
+def test_flush_interval_commits_a_partial_batch():
+    async def scenario():
+        commit = RecordingCommit()
+        buffer = WriteBehindBuffer(commit, flush_size=100, flush_interval=0.01)
+        await buffer.add('set', 'a', {})
+        await asyncio.sleep(0.05)
+        return commit.batches
+
+    assert asyncio.run(scenario()) == [[('set', 'a', {})]]
+
+
+def test_writes_to_one_return_land_in_order_across_batches():
+    async def scenario():
+        # The first batch is slow; the second touches the same return and must wait for it
+        commit = RecordingCommit(delays=[0.1, 0.0, 0.0])
+        buffer = WriteBehindBuffer(commit, flush_size=1, flush_interval=10)
+        await buffer.add('set', 'a', {'status': 'queued'})
+        await buffer.add('update', 'b', {'status': 'queued'})
+        await buffer.add('update', 'a', {'status': 'analyzed'})
+        await buffer.flush()
+        return commit.batches
+
+    batches = asyncio.run(scenario())
+    order_for_a = [data['status'] for batch in batches for _, return_id, data in batch if return_id == 'a']
+    assert order_for_a == ['queued', 'analyzed']
+    # The unrelated batch did not wait behind the slow one
+    assert batches[0][0][1] == 'b'
+
+
+def test_failed_commit_is_retried_in_order():
+    async def scenario():
+        commit = RecordingCommit(failures=1)
+        buffer = WriteBehindBuffer(commit, flush_size=1, flush_interval=0.01)
+        await buffer.add('set', 'a', {'n': 1})
+        await buffer.add('update', 'a', {'n': 2})
+        await asyncio.sleep(0.01)
+        await buffer.flush()
+        for _ in range(50):
+            if not buffer.has_pending('a'):
+                break
+            await asyncio.sleep(0.01)
+        return commit.batches, buffer.stats()
+
+    batches, stats = asyncio.run(scenario())
+    assert [data['n'] for batch in batches for _, _, data in batch] == [1, 2]
+    assert stats['pending'] == 0
+
+
+def test_a_write_that_never_commits_does_not_block_the_others():
+    async def scenario():
+        client = FirebaseClient(store=SQLiteStore(":memory:"), write_behind=True)
+        buffer = client.write_buffer
+        buffer.flush_interval, buffer.max_attempts = 0.01, 3
+        # An update to a return that was never saved: SQLiteStore raises KeyError
+        await client.update_return_status("missing", {'status': 'analyzed'})
+        ids = []
+        for round_ in range(4):
+            ids.append(await client.save_return_request({'user_id': 'u1', 'original_price': 10 + round_}))
+            await client.update_return_status(ids[-1], {'status': 'analyzed'})
+            await buffer.flush()
+            await asyncio.sleep(0.02)
+        await buffer.flush()
+        documents = [await client.get_return(return_id) for return_id in ids]
+        stats = buffer.stats()
+        await client.close()
+        return buffer, documents, stats
+
+    buffer, documents, stats = asyncio.run(scenario())
+    assert [document['status'] for document in documents] == ['analyzed'] * 4
+    assert stats['committed_writes'] == 8 and stats['pending'] == 0
+    assert [return_id for _, return_id, _ in buffer.dead_letters] == ["missing"]
+
+
+def test_writes_behind_a_failed_write_to_the_same_return_keep_their_order():
+    class FailsOnce:
+        def __init__(self):
+            self.batches, self.failed = [], False
+
+        async def __call__(self, writes):
+            if not self.failed and any(data.get('n') == 1 for _, _, data in writes):
+                self.failed = True
+                raise RuntimeError("transient")
+            self.batches.append(list(writes))
+
+    async def scenario():
+        commit = FailsOnce()
+        buffer = WriteBehindBuffer(commit, flush_size=10, flush_interval=0.01)
+        for n, return_id in enumerate(['a', 'a', 'b', 'a']):
+            await buffer.add('update', return_id, {'n': n})
+        await buffer.flush()
+        await asyncio.sleep(0.05)
+        await buffer.flush()
+        return commit.batches
+
+    committed = [(return_id, data['n']) for batch in asyncio.run(scenario()) for _, return_id, data in batch]
+    assert [n for return_id, n in committed if return_id == 'a'] == [0, 1, 3]
+    assert ('b', 2) in committed
+
+
+def test_reads_see_buffered_writes():
+    async def scenario():
+        client = FirebaseClient(store=SQLiteStore(":memory:"), write_behind=True)
+        return_id = await client.save_return_request({'user_id': 'u1', 'original_price': 10})
+        await client.update_return_status(return_id, {'status': 'analyzed'})
+        document = await client.get_return(return_id)
+        await client.close()
+        return document
+
+    assert asyncio.run(scenario())['status'] == 'analyzed'
+
+
+def test_aggregate_failure_does_not_commit_the_batch_twice():
+    class CountingStore(SQLiteStore):
+        commits = 0
+
+        def commit(self, writes):
+            CountingStore.commits += 1
+            super().commit(writes)
+
+    async def scenario():
+        client = FirebaseClient(store=CountingStore(":memory:"), write_behind=True)
+
+        def broken_aggregates(writes):
+            raise RuntimeError("aggregate store unavailable")
+
+        client._apply_aggregates = broken_aggregates
+        await client.save_return_request({'user_id': 'u1', 'original_price': 10})
+        await client.flush()
+        await asyncio.sleep(client.write_buffer.flush_interval * 2)
+        analytics = await client.get_analytics()
+        stats = client.write_buffer.stats()
+        await client.close()
+        return stats, analytics
+
+    stats, analytics = asyncio.run(scenario())
+    assert CountingStore.commits == 1
+    assert stats['pending'] == 0 and stats['committed_writes'] == 1
+    assert analytics['total'] == 1
@@ -0,0 +1,134 @@
+import asyncio
+
+from app.services.policy_rules import PolicyEngine
+from app.services.return_decision import ReturnDecisionService
+
+RETURN = {'product_category': 'Shoes', 'date_of_purchase': '2024-05-01', 'date_of_return': '2024-05-10'}
+LOW_RISK = {'risk_category': 'Low', 'is_fraudulent': False, 'previous_returns_count': 1}
+
+
+def defects(grade: str, action: str, found=("scuffed toe",)) -> dict:
+    return {'product_category': 'Shoes', 'condition_grade': grade, 'defects': list(found), 'recommended_action': action}
+
+
+def outcome(engine: PolicyEngine, return_data=RETURN, defect_analysis=None, fraud_analysis=LOW_RISK):
+    decision = engine.evaluate(return_data, defect_analysis or defects("Used - Good", "Resell"), fraud_analysis)
+    return None if decision is None else (decision.rule, decision.outcome)
+
+
+def test_used_good_rules_fire_on_the_defect_prompt_vocabulary():
+    engine = PolicyEngine()
+    assert outcome(engine, defect_analysis=defects("Used - Good", "Resell")) == ("condition.used_good.resell", "Resell")
+    assert outcome(engine, defect_analysis=defects("Used - Good", "Refurbish")) == ("condition.used_good.refurbish", "Refurbish")
+    # Any other action is left to the LLM
+    assert outcome(engine, defect_analysis=defects("Used - Good", "Donate")) is None
+
+
+def test_like_new_low_risk_resells_and_salvage_recycles():
+    engine = PolicyEngine()
+    assert outcome(engine, defect_analysis=defects("Like New", "Resell", found=()))[1] == "Resell"
+    assert outcome(engine, defect_analysis=defects("Salvage", "Recycle")) == ("condition.salvage_recycle", "Recycle")
+
+
+def test_suspected_fraud_goes_to_manual_review():
+    high = {'risk_category': 'High', 'is_fraudulent': True}
+    assert outcome(PolicyEngine(), fraud_analysis=high) == ("fraud.suspected", "Pending")
+
+
+def test_category_policy_denies_only_on_a_shown_violation():
+    engine = PolicyEngine({'shoes': {'return_window': 5, 'requires_original_box': True}})
+    assert outcome(engine) == ("shoes.return_window", "Deny")
+    in_window = {**RETURN, 'date_of_return': '2024-05-03'}
+    assert outcome(engine, return_data={**in_window, 'original_packaging': False}) == ("shoes.requires_original_box", "Deny")
+    # Packaging unknown: not denied on that rule, falls through to disposition
+    assert outcome(engine, return_data=in_window)[1] == "Resell"
+
+
+def test_canvas_flow_compiles_conditions_and_actions():
+    flow = {
+        'id': 'flow',
+        'nodes': [
+            {'id': 't', 'type': 'trigger'},
+            {'id': 'c', 'type': 'condition', 'data': {'id': 'condition_days', 'config': {'days': 7}}},
+            {'id': 'ok', 'type': 'action', 'data': {'id': 'action_approve'}},
+            {'id': 'no', 'type': 'action', 'data': {'id': 'action_reject', 'title': 'Too late'}},
+        ],
+        'edges': [
+            {'source': 't', 'sourceHandle': 'output', 'target': 'c'},
+            {'source': 'c', 'sourceHandle': 'yes', 'target': 'ok'},
+            {'source': 'c', 'sourceHandle': 'no', 'target': 'no'},
+        ],
+    }
+    engine = PolicyEngine({'flows': [flow]})
+    assert outcome(engine) == ("flow.action_reject", "Deny")
+    assert outcome(engine, return_data={**RETURN, 'date_of_return': '2024-05-03'})[1] == "Resell"
+
+
+def test_unknown_canvas_condition_and_missing_facts_are_left_to_the_llm():
+    flow = {
+        'id': 'flow',
+        'nodes': [{'id': 't', 'type': 'trigger'}, {'id': 'c', 'type': 'condition', 'data': {'id': 'condition_weather'}}],
+        'edges': [{'source': 't', 'sourceHandle': 'output', 'target': 'c'}],
+    }
+    assert outcome(PolicyEngine({'flows': [flow]})) is None
+    assert PolicyEngine().evaluate(RETURN, {}, {}) is None
+
+
+def test_stats_count_rule_decisions_and_fallbacks():
+    engine = PolicyEngine()
+    outcome(engine)
+    outcome(engine, defect_analysis=defects("Used - Good", "Donate"))
+    stats = engine.stats()
+    assert (stats['decided_by_rules'], stats['llm_fallbacks'], stats['rule_hit_ratio']) == (1, 1, 0.5)
+
+
+def test_decision_service_asks_gemini_only_when_undecided(gemini):
+    service = ReturnDecisionService({}, gemini)
+    decided = asyncio.run(service.determine_final_outcome(defects("Used - Good", "Resell"), LOW_RISK, RETURN))
+    assert decided['decided_by'] == 'rules' and gemini.calls == 0
+    assert decided['product_description'].startswith("Shoes in Used - Good condition.")
+    fallback = asyncio.run(service.determine_final_outcome(defects("Used - Good", "Donate"), LOW_RISK, RETURN))
+    assert fallback['decided_by'] == 'llm' and gemini.calls == 1
+
+
+def flow(condition: dict, yes: dict, flow_id='flow', **extra) -> dict:
+    return {
+        'id': flow_id,
+        'nodes': [
+            {'id': 't', 'type': 'trigger'},
+            {'id': 'c', 'type': 'condition', 'data': condition},
+            {'id': 'a', 'type': 'action', 'data': yes},
+        ],
+        'edges': [
+            {'source': 't', 'sourceHandle': 'output', 'target': 'c'},
+            {'source': 'c', 'sourceHandle': 'yes', 'target': 'a'},
+        ],
+        **extra,
+    }
+
+
+def test_final_sale_and_the_default_policy_apply_by_category():
+    engine = PolicyEngine({'Shoes': {'final_sale': True}, 'default': {'return_window': 5}})
+    assert outcome(engine) == ("Shoes.final_sale", "Deny")
+    assert outcome(engine, return_data={**RETURN, 'product_category': 'Bags'}) == ("default.return_window", "Deny")
+
+
+def test_canvas_outcome_and_review_actions():
+    excessive = {'id': 'condition_excessive', 'config': {'threshold': 3}}
+    review = PolicyEngine({'flows': [flow(excessive, {'id': 'action_review'})]})
+    assert outcome(review, fraud_analysis={**LOW_RISK, 'previous_returns_count': 5}) == ("flow.action_review", "Pending")
+    # Condition false with no "no" branch: the flow ends and the disposition rules decide
+    assert outcome(review)[1] == "Resell"
+    donate = {'id': 'action_outcome', 'config': {'outcome': 'donate'}}
+    assert outcome(PolicyEngine({'flows': [flow({'id': 'condition_unused'}, donate)]}), defect_analysis=defects("Like New", "Resell", found=())) == ("flow.action_outcome", "Donate")
+
+
+def test_inactive_looping_and_triggerless_flows():
+    reject = {'id': 'action_reject'}
+    inactive = flow({'id': 'condition_days', 'config': {'days': 1}}, reject, isActive=False)
+    assert outcome(PolicyEngine({'flows': [inactive]}))[1] == "Resell"
+    looping = flow({'id': 'condition_days', 'config': {'days': 1}}, reject)
+    looping['edges'].append({'source': 'c', 'sourceHandle': 'no', 'target': 'c'})
+    assert outcome(PolicyEngine({'flows': [looping]})) is None
+    triggerless = {'id': 'flow', 'nodes': [{'id': 'a', 'type': 'action', 'data': reject}], 'edges': []}
+    assert outcome(PolicyEngine({'flows': [triggerless]}))[1] == "Resell"
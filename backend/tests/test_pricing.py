@@ -0,0 +1,79 @@
+import asyncio
+import json
+
+from app import dependencies
+from app.config import settings
+from app.services.pricing import PricingService
+from app.utils.comparables import ComparablesIndex, read_records
+
+
+def sales(category: str, grade: str, recovery: float, count: int, days: float = 10) -> list:
+    return [
+        {'category': category, 'grade': grade, 'original_price': 100 + i, 'sale_price': (100 + i) * recovery, 'days_to_sell': days}
+        for i in range(count)
+    ]
+
+
+def test_query_takes_medians_over_the_nearest_priced_sales_of_the_grade():
+    index = ComparablesIndex(capacity=4)  # also exercises growing the columns
+    index.extend(sales("Shoes", "Like New", 0.8, 5) + sales("Bags", "Like New", 0.6, 5) + sales("Shoes", "Salvage", 0.1, 5))
+    found = index.query("shoes", "Like New", 102, k=25)
+    assert found['grade_comparables'] == 10 and found['category_comparables'] == 5
+    assert round(found['category_recovery'], 4) == 0.8
+    assert round(found['grade_recovery'], 4) == 0.7
+    assert index.query("Shoes", "Mint", 100, k=25) is None
+
+
+def test_rows_with_unknown_grade_or_price_are_skipped():
+    index = ComparablesIndex()
+    assert not index.add("Shoes", "Mint", 100, 50, 3)
+    assert not index.add("Shoes", "Like New", 0, 50, 3)
+    assert not index.add("Shoes", "Like New", "n/a", 50, 3)
+    assert len(index) == 0
+
+
+def test_pricing_falls_back_to_static_factors_without_enough_comparables():
+    service = PricingService(ComparablesIndex())
+    price = asyncio.run(service.get_price_recommendation(100, "Used - Good", "Shoes"))
+    assert price['pricing_source'] == "static" and price['suggested_price'] == 60.0
+
+
+def test_pricing_by_comparables_applies_category_demand():
+    index = ComparablesIndex()
+    index.extend(sales("Shoes", "Like New", 0.9, 5) + sales("Bags", "Like New", 0.5, 5))
+    price = asyncio.run(PricingService(index).get_price_recommendation(102, "Like New", "Shoes"))
+    assert price['pricing_source'] == "comparables"
+    assert price['condition_factor'] == 0.7
+    assert round(price['market_demand_factor'], 2) == round(0.9 / 0.7, 2)
+
+
+def test_recorded_sales_are_appended_to_the_log_and_reloaded(tmp_path, monkeypatch):
+    seed, snapshot, log = tmp_path / "seed.json", tmp_path / "seed.npz", tmp_path / "sales.jsonl"
+    seed.write_text(json.dumps(sales("Shoes", "Like New", 0.8, 3)))
+    monkeypatch.setattr(settings, 'PRICING_COMPARABLES_PATH', str(seed))
+    monkeypatch.setattr(settings, 'PRICING_SNAPSHOT_PATH', str(snapshot))
+    monkeypatch.setattr(settings, 'PRICING_SALES_LOG_PATH', str(log))
+
+    first = PricingService(dependencies.load_comparables(), sales_log=str(log))
+    assert snapshot.exists() and len(first.comparables) == 3
+    assert first.record_sale("Shoes", "Like New", 120, 90, 4)
+    assert not first.record_sale("Shoes", "Mint", 120, 90, 4)
+    assert len(list(read_records(str(log)))) == 1
+
+    # Another worker, or the next start: seed from the snapshot plus the log, counted once
+    assert len(dependencies.load_comparables()) == 4
+
+
+def test_a_torn_line_in_the_sales_log_is_skipped(tmp_path):
+    log = tmp_path / "sales.jsonl"
+    log.write_text(json.dumps(sales("Shoes", "Like New", 0.8, 1)[0]) + "\n" + '{"category": "Sho')
+    assert len(list(read_records(str(log)))) == 1
+
+
+def test_snapshot_round_trip(tmp_path):
+    index = ComparablesIndex()
+    index.extend(sales("Shoes", "Like New", 0.8, 5))
+    index.save(str(tmp_path / "index.npz"))
+    loaded = ComparablesIndex.load(str(tmp_path / "index.npz"))
+    assert loaded.query("Shoes", "Like New", 102, 25) == index.query("Shoes", "Like New", 102, 25)
+    assert [path.name for path in tmp_path.iterdir()] == ["index.npz"]
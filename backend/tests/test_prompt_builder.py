@@ -0,0 +1,64 @@
+import contextvars
+
+from app.utils.prompt_builder import PromptTokenStats, token_usage_scope
+
+
+def record_in_scope(stats: PromptTokenStats, scope: str, prompt_name: str, **usage) -> None:
+    def record():
+        token_usage_scope.set(scope)
+        stats.record(prompt_name, 100, 50, **usage)
+    contextvars.copy_context().run(record)
+
+
+def test_token_stats_keep_scopes_that_contain_colons():
+    stats = PromptTokenStats()
+    record_in_scope(stats, "job:analyze-return", "fraud.pattern", input_tokens=90, output_tokens=40, latency=0.2)
+    record_in_scope(stats, "POST /api/analyze-return", "fraud.pattern", cached=True)
+    summary = stats.summary()
+    assert set(summary) == {"job:analyze-return", "POST /api/analyze-return"}
+    job = summary["job:analyze-return"]["fraud.pattern"]
+    assert (job['calls'], job['input_tokens'], job['avg_latency_ms']) == (1, 90, 200.0)
+    assert summary["POST /api/analyze-return"]["fraud.pattern"]['cache_hits'] == 1
+
+
+from app.utils.prompt_builder import PromptBuilder, compact_value, halve_longest_list
+
+
+def test_compact_value_applies_the_whitelist_and_drops_empties():
+    value = {'a': 1.23456, 'b': None, 'c': [], 'd': {'keep': 'x', 'drop': 'y'}, 'secret': 'z'}
+    assert compact_value(value, {'a': None, 'b': None, 'c': None, 'd': {'keep': None}}) == {'a': 1.235, 'd': {'keep': 'x'}}
+
+
+def test_halving_keeps_a_running_count_of_dropped_items():
+    payload = {'returns': list(range(8))}
+    assert halve_longest_list(payload)
+    assert str(payload['returns'][-1]) == "+4 more"
+    assert halve_longest_list(payload)
+    assert payload['returns'][:-1] == [0, 1] and str(payload['returns'][-1]) == "+6 more"
+
+
+def test_strings_that_look_like_the_marker_are_ordinary_items():
+    payload = {'notes': ["+ a few more", "+3 more", "x", "y"]}
+    assert halve_longest_list(payload)
+    assert payload['notes'][:-1] == ["+ a few more", "+3 more"] and str(payload['notes'][-1]) == "+2 more"
+    prompt = PromptBuilder(20).add_payload("Notes", {'notes': ["+ a few more"] * 40}, priority=1).build()
+    assert "more" in prompt
+
+
+def test_budget_trims_lowest_priority_payloads_first():
+    builder = (
+        PromptBuilder(60)
+        .add_text("Instructions that are never trimmed.")
+        .add_payload("History", {'returns': [{'id': i, 'note': 'lorem ipsum'} for i in range(50)]}, priority=1)
+        .add_payload("Current", {'id': 'r1', 'reason': 'Too small'}, priority=3)
+    )
+    prompt = builder.build()
+    assert builder.truncated
+    assert prompt.startswith("Instructions that are never trimmed.")
+    assert 'Current: {"id":"r1","reason":"Too small"}' in prompt
+    assert "more" in prompt.split("\n")[1]
+
+
+def test_prompt_within_budget_is_untouched():
+    builder = PromptBuilder(1000).add_text("Hello").add_payload("Data", {'items': [1, 2, 3]})
+    assert builder.build() == 'Hello\nData: {"items":[1,2,3]}' and not builder.truncated
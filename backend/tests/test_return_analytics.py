@@ -0,0 +1,111 @@
+import asyncio
+from datetime import datetime, timedelta
+
+from app.utils.firebase_client import FirebaseClient
+from app.utils.persistence import SQLiteStore
+from app.utils.return_analytics import (
+    analytics_record,
+    combine_shards,
+    fraud_band,
+    merge_rollup,
+    new_rollup,
+    record_delta,
+    summarize_rollup,
+    value_series,
+)
+
+NOW = datetime(2024, 6, 12)  # a Wednesday
+
+
+def document(day: str, price=100.0, **extra) -> dict:
+    return {'date_of_return': day, 'original_price': price, 'return_reason': "Too small", 'product_category': "Shoes", **extra}
+
+
+def delta_of(old, new) -> dict:
+    delta = new_rollup()
+    record_delta(delta, old, new)
+    return delta
+
+
+def test_record_labels_and_fraud_bands():
+    record = analytics_record(document("2024-06-10", "$1,000", return_reason="  " + "x" * 80, resale={'sale_price': 600}))
+    assert record['date'] == "2024-06-10" and record['value'] == 1000.0 and record['recovered'] == 600.0
+    assert record['reason'] == "x" * 60 and record['outcome'] == "Pending" and record['grade'] == "Ungraded"
+    assert [fraud_band(f) for f in ({'risk_category': 'High'}, {'risk_score': 0.5}, {'risk_score': 0.1}, None)] == ["High", "Medium", "Low", "Unknown"]
+
+
+def test_a_changed_return_moves_between_buckets_and_unchanged_ones_do_not_count():
+    old = analytics_record(document("2024-06-10"))
+    new = analytics_record(document("2024-06-10", final_outcome="Resell", resale={'sale_price': 40}))
+    delta = new_rollup()
+    assert not record_delta(delta, old, old)
+    assert record_delta(delta, old, new)
+    rollup = merge_rollup(new_rollup(), delta_of(None, old), 30, NOW)
+    merge_rollup(rollup, delta, 30, NOW)
+    assert rollup['total'] == 1 and rollup['recovered'] == 40.0
+    # Counters that reach zero are dropped rather than kept as zeros
+    assert rollup['counts']['outcome'] == {"Resell": 1}
+
+
+def test_shards_sum_even_when_one_holds_negative_counts():
+    record = analytics_record(document("2024-06-10"))
+    added = merge_rollup(new_rollup(), delta_of(None, record), 30, NOW)
+    retracted = merge_rollup(new_rollup(), delta_of(record, None), 30, NOW)
+    assert retracted['counts']['reason'] == {"Too small": -1}
+    combined = combine_shards([added, retracted, added], 30)
+    assert combined['total'] == 1 and combined['value'] == 100.0
+
+
+def test_retention_drops_old_days_but_keeps_totals():
+    rollup = merge_rollup(new_rollup(), delta_of(None, analytics_record(document("2024-01-01"))), 30, NOW)
+    assert rollup['daily'] == {} and rollup['total'] == 1
+
+
+def test_summary_breakdowns_are_largest_first_with_percentages():
+    delta = new_rollup()
+    for reason in ("Too small", "Too small", "Defective"):
+        record_delta(delta, None, analytics_record(document("2024-06-10", return_reason=reason)))
+    summary = summarize_rollup(merge_rollup(new_rollup(), delta, 30, NOW))
+    assert summary['total'] == 3 and summary['total_value'] == 300.0
+    assert summary['by_reason'] == [
+        {'reason': "Too small", 'count': 2, 'percentage': 66.7},
+        {'reason': "Defective", 'count': 1, 'percentage': 33.3},
+    ]
+
+
+def test_value_series_by_day_and_by_week():
+    delta = new_rollup()
+    for day, price in (("2024-06-12", 10), ("2024-06-10", 20), ("2024-06-09", 40), ("2024-06-13", 80)):
+        record_delta(delta, None, analytics_record(document(day, price)))
+    rollup = merge_rollup(new_rollup(), delta, 30, NOW)
+    days = value_series(rollup, "day", 3, NOW)
+    assert [(row['period_start'], row['count'], row['value']) for row in days] == [
+        ("2024-06-10", 1, 20.0), ("2024-06-11", 0, 0.0), ("2024-06-12", 1, 10.0)
+    ]
+    weeks = value_series(rollup, "week", 2, NOW)
+    # Weeks start on Monday
+    assert [(row['period_start'], row['count'], row['value']) for row in weeks] == [("2024-06-03", 1, 40.0), ("2024-06-10", 3, 110.0)]
+
+
+def test_incremental_rollups_match_a_rebuild_through_the_write_path():
+    today = datetime.now().strftime("%Y-%m-%d")
+
+    async def scenario():
+        client = FirebaseClient(store=SQLiteStore(":memory:"))
+        ids = [
+            await client.save_return_request(document(today, 10 * (index + 1), return_reason=["Too small", "Defective"][index % 2]))
+            for index in range(6)
+        ]
+        await client.update_return_status(ids[0], {'final_outcome': "Resell", 'resale': {'sale_price': 7.5}})
+        await client.update_return_status(ids[1], {'condition_grade': {'grade': "Like New"}})
+        await client.update_return_status(ids[2], {'stages.defect_analysis': "completed"})  # no analytics field
+        await client.flush()
+        incremental = summarize_rollup(await client.get_analytics())
+        rebuilt = summarize_rollup(await asyncio.get_running_loop().run_in_executor(None, client.rebuild_analytics))
+        await client.close()
+        return incremental, rebuilt
+
+    incremental, rebuilt = asyncio.run(scenario())
+    assert incremental == rebuilt
+    assert incremental['total'] == 6 and incremental['total_value'] == 210.0 and incremental['value_recovered'] == 7.5
+    assert {row['outcome']: row['count'] for row in incremental['by_outcome']} == {"Pending": 5, "Resell": 1}
@@ -0,0 +1,115 @@
+import asyncio
+from datetime import datetime
+
+from app.utils.firebase_client import FirebaseClient
+from app.utils.persistence import SQLiteStore
+from app.utils.return_history import (
+    apply_return,
+    apply_status_update,
+    new_aggregate,
+    slim_return_record,
+    summarize_aggregate,
+    to_float,
+)
+
+NOW = datetime(2024, 6, 30)
+
+
+def record(return_id: str, date_of_return: str, price, category="Shoes", purchased="2024-01-01", **extra) -> dict:
+    return slim_return_record(return_id, {
+        'product_category': category,
+        'original_price': price,
+        'date_of_purchase': purchased,
+        'date_of_return': date_of_return,
+        **extra,
+    })
+
+
+def test_slim_record_parses_prices_dates_and_fraud_flags():
+    slim = record("r1", "2024-01-11", "$1,200.50", fraud_analysis={'risk_category': 'High', 'risk_score': 80})
+    assert slim['price'] == 1200.5 and slim['days_until_return'] == 10 and slim['date'] == "2024-01-11"
+    assert slim['fraud_flagged'] and slim['fraud_risk_score'] == 80
+    assert to_float(None) == 0.0 and to_float("n/a") == 0.0
+
+
+def test_rolling_windows_and_days_to_return():
+    aggregate = new_aggregate("u1")
+    for return_id, day, price in [("a", "2024-06-20", 10), ("b", "2024-05-01", 20.25), ("c", "2024-01-02", 30), ("d", "2023-01-21", 40)]:
+        apply_return(aggregate, record(return_id, day, price, purchased=day[:8] + "01"), now=NOW)
+    summary = summarize_aggregate(aggregate, now=NOW)
+    assert summary['total_returns'] == 4 and summary['total_value'] == 100.25
+    assert (summary['returns_30d'], summary['returns_90d'], summary['returns_365d']) == (1, 2, 3)
+    assert (summary['value_30d'], summary['value_90d'], summary['value_365d']) == (10.0, 30.25, 60.25)
+    # The 2023 return falls outside the longest window and was pruned from the daily buckets
+    assert "2023-01-01" not in aggregate['daily']
+    assert summary['days_to_return'] == {'mean': 10.0, 'min': 0, 'max': 20}
+    assert summary['category_counts'] == {"Shoes": 4}
+
+
+def test_recent_returns_are_capped_and_fraud_flags_counted_once():
+    aggregate = new_aggregate("u1")
+    for index in range(5):
+        apply_return(aggregate, record(f"r{index}", "2024-06-01", 10), recent_limit=3, now=NOW)
+    assert [r['return_id'] for r in aggregate['recent_returns']] == ["r2", "r3", "r4"]
+    apply_status_update(aggregate, "r4", {'status': "Denied"}, recent_limit=3)
+    apply_status_update(aggregate, "r4", {'fraud_analysis': {'is_fraudulent': True, 'risk_score': 90}}, recent_limit=3)
+    assert aggregate['prior_fraud_flags'] == 1
+    assert aggregate['recent_returns'][-1]['status'] == "Denied"
+    assert aggregate['recent_returns'][-1]['fraud_risk_score'] == 90
+
+
+def test_incremental_aggregate_matches_a_rebuild_from_the_returns():
+    async def scenario():
+        client = FirebaseClient(store=SQLiteStore(":memory:"))
+        ids = []
+        for index in range(12):
+            ids.append(await client.save_return_request({
+                'user_id': "u1",
+                'product_category': ["Shoes", "Bags"][index % 2],
+                'original_price': 10 + index,
+                'date_of_purchase': "2024-01-01",
+                'date_of_return': datetime.now().strftime("%Y-%m-%d"),
+            }))
+        await client.update_return_status(ids[3], {'status': "Fraud"})
+        await client.update_return_status(ids[3], {'stages.defect_analysis': "completed"})
+        await client.flush()
+        incremental = await client.get_user_history("u1")
+        rebuilt = summarize_aggregate(client.rebuild_user_aggregate("u1"))
+        await client.close()
+        return incremental, rebuilt
+
+    incremental, rebuilt = asyncio.run(scenario())
+    assert incremental['total_returns'] == 12 and incremental['total_value'] == 186.0
+    assert incremental['returns_30d'] == 12
+    assert incremental['prior_fraud_flags'] == 1
+    for field in ("total_returns", "total_value", "returns_30d", "value_30d", "category_counts", "days_to_return", "prior_fraud_flags"):
+        assert incremental[field] == rebuilt[field]
+
+
+def test_a_saved_return_can_be_left_out_of_its_own_history():
+    today = datetime.now().strftime("%Y-%m-%d")
+
+    def return_data(price, **extra):
+        return {'user_id': "u1", 'product_category': "Shoes", 'original_price': price,
+                'date_of_purchase': "2024-01-01", 'date_of_return': today, **extra}
+
+    async def scenario():
+        client = FirebaseClient(store=SQLiteStore(":memory:"))
+        await client.save_return_request(return_data(10))
+        await client.save_return_request(return_data(20, product_category="Bags"))
+        await client.flush()
+        before = await client.get_user_history("u1")
+        # Async mode: the return is saved before its analysis reads the history
+        return_id = await client.save_return_request(
+            return_data(300, fraud_analysis={'risk_category': 'High'}), durable=True
+        )
+        excluded = await client.get_user_history("u1", exclude_return_id=return_id)
+        included = await client.get_user_history("u1")
+        await client.close()
+        return before, excluded, included
+
+    before, excluded, included = asyncio.run(scenario())
+    assert included['total_returns'] == 3 and included['prior_fraud_flags'] == 1
+    for field in ("total_returns", "total_value", "returns_30d", "value_30d", "category_counts", "prior_fraud_flags", "recent_returns"):
+        assert excluded[field] == before[field]
+    assert excluded['days_to_return']['mean'] == before['days_to_return']['mean']
@@ -0,0 +1,109 @@
+import asyncio
+
+import pytest
+
+from app.utils.stage_graph import COMPLETED, SKIPPED, StageGraph, StageTimingStats
+
+
+def run(graph: StageGraph, deadline=None) -> dict:
+    return asyncio.run(graph.run(deadline))
+
+
+def value(result, delay: float = 0.0):
+    async def stage(*dependencies):
+        await asyncio.sleep(delay)
+        return (result, dependencies)
+    return stage
+
+
+def test_stages_get_their_dependency_results_in_declaration_order():
+    graph = (
+        StageGraph(stats=StageTimingStats())
+        .add_stage("b", value("b"))
+        .add_stage("c", value("c", 0.01))
+        .add_stage("d", value("d"), depends_on=["c", "b"])
+    )
+    results = run(graph)
+    assert results["d"] == ("d", (("c", ()), ("b", ())))
+    assert graph.statuses == {"b": COMPLETED, "c": COMPLETED, "d": COMPLETED}
+    assert set(graph.timings) == {"b", "c", "d", "total"}
+
+
+def test_independent_stages_run_concurrently():
+    graph = StageGraph(stats=StageTimingStats())
+    for name in "abcde":
+        graph.add_stage(name, value(name, 0.05))
+    run(graph)
+    assert graph.timings["total"]["duration_ms"] < 200
+
+
+def test_cycles_unknown_dependencies_and_duplicates_are_rejected():
+    with pytest.raises(ValueError, match="cycle"):
+        run(StageGraph().add_stage("a", value(1), ["b"]).add_stage("b", value(2), ["a"]))
+    with pytest.raises(ValueError, match="Unknown"):
+        run(StageGraph().add_stage("a", value(1), ["missing"]))
+    with pytest.raises(ValueError, match="already defined"):
+        StageGraph().add_stage("a", value(1)).add_stage("a", value(2))
+
+
+def test_a_failing_stage_cancels_the_rest_and_raises():
+    async def fail():
+        raise RuntimeError("boom")
+
+    slow_finished = []
+
+    async def slow():
+        await asyncio.sleep(1)
+        slow_finished.append(True)
+
+    graph = StageGraph(stats=StageTimingStats()).add_stage("fail", fail).add_stage("slow", slow)
+    with pytest.raises(RuntimeError, match="boom"):
+        run(graph)
+    assert not slow_finished
+
+
+def test_progress_callback_sees_every_completed_stage_and_its_failures_are_contained():
+    seen = []
+
+    async def on_stage_done(name, result):
+        seen.append(name)
+        raise RuntimeError("callback failure does not fail the graph")
+
+    graph = StageGraph(stats=StageTimingStats(), on_stage_done=on_stage_done)
+    graph.add_stage("a", value(1)).add_stage("b", value(2), ["a"])
+    assert run(graph)["b"][0] == 2
+    assert sorted(seen) == ["a", "b"]
+
+
+def test_skip_when_cancels_moot_stages_and_their_dependents():
+    graph = (
+        StageGraph(stats=StageTimingStats())
+        .add_stage("fraud", value("High"))
+        .add_stage("grading", value("graded", 1.0))
+        .add_stage("pricing", value("priced"), ["grading"])
+        .skip_when("fraud", lambda result: result[0] == "High", ["grading"])
+    )
+    results = run(graph)
+    assert results["grading"] is None and results["pricing"] is None
+    assert graph.statuses == {"fraud": COMPLETED, "grading": SKIPPED, "pricing": SKIPPED}
+
+
+def test_optional_dependencies_are_waited_for_and_given_as_none_when_skipped():
+    graph = (
+        StageGraph(stats=StageTimingStats())
+        .add_stage("fraud", value("High"))
+        .add_stage("grading", value("graded", 1.0))
+        .add_stage("pricing", value("priced", 0.01))
+        .add_stage("decision", value("decided"), ["fraud"], optional=["grading", "pricing"])
+        .skip_when("fraud", lambda result: result[0] == "High", ["grading"])
+    )
+    results = run(graph)
+    assert results["decision"] == ("decided", (("High", ()), None, ("priced", ())))
+    assert graph.statuses["grading"] == SKIPPED and graph.statuses["decision"] == COMPLETED
+
+
+def test_timing_stats_report_percentiles_per_stage():
+    stats = StageTimingStats(window=3)
+    for seconds in (0.5, 0.001, 0.002, 0.003):
+        stats.record("pipeline.a", seconds)
+    assert stats.summary() == {"pipeline.a": {'count': 3, 'p50_ms': 2.0, 'p99_ms': 3.0}}